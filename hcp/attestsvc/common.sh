@@ -24,7 +24,15 @@ if [[ -z "$HCP_USER" || ! -d "/home/$HCP_USER" ]]; then
 	echo "Error, HCP_USER (\"$HCP_USER\") is not a valid user" >&2
 	exit 1
 fi
-if [[ -z "$HCP_ATTESTSVC_REMOTE_REPO" ]]; then
+# With HCP_ATTESTSVC_STORE=sqlite, the enrollments are replicated into a single
+# file (see sbin/enroll_store.py) by pulling deltas from the enrollment
+# service's change notifier, rather than into git clones.
+if [[ $HCP_ATTESTSVC_STORE == sqlite ]]; then
+	if [[ -z "$HCP_ATTESTSVC_REMOTE_NOTIFY" ]]; then
+		echo "Error, HCP_ATTESTSVC_REMOTE_NOTIFY must be set for HCP_ATTESTSVC_STORE=sqlite" >&2
+		exit 1
+	fi
+elif [[ -z "$HCP_ATTESTSVC_REMOTE_REPO" ]]; then
 	echo "Error, HCP_ATTESTSVC_REMOTE_REPO (\"$HCP_ATTESTSVC_REMOTE_REPO\") must be set" >&2
 	exit 1
 fi
@@ -62,6 +70,9 @@ if [[ `whoami` == "root" ]]; then
 	echo "HCP_ATTESTSVC_STATE_PREFIX=$HCP_ATTESTSVC_STATE_PREFIX" >> /etc/environment
 	echo "HCP_ATTESTSVC_REMOTE_REPO=$HCP_ATTESTSVC_REMOTE_REPO" >> /etc/environment
 	echo "HCP_ATTESTSVC_UPDATE_TIMER=$HCP_ATTESTSVC_UPDATE_TIMER" >> /etc/environment
+	echo "HCP_ATTESTSVC_REMOTE_NOTIFY=$HCP_ATTESTSVC_REMOTE_NOTIFY" >> /etc/environment
+	echo "HCP_ATTESTSVC_STORE=$HCP_ATTESTSVC_STORE" >> /etc/environment
+	echo "HCP_ATTESTSVC_SHARD_DIGITS=$HCP_ATTESTSVC_SHARD_DIGITS" >> /etc/environment
 	echo "SAFEBOOT_UWSGI=$SAFEBOOT_UWSGI" >> /etc/environment
 	echo "SAFEBOOT_UWSGI_FLAGS=$SAFEBOOT_UWSGI_FLAGS" >> /etc/environment
 	echo "SAFEBOOT_UWSGI_PORT=$SAFEBOOT_UWSGI_PORT" >> /etc/environment
@@ -76,13 +87,64 @@ echo "                    HCP_USER=$HCP_USER" >&2
 echo "  HCP_ATTESTSVC_STATE_PREFIX=$HCP_ATTESTSVC_STATE_PREFIX" >&2
 echo "   HCP_ATTESTSVC_REMOTE_REPO=$HCP_ATTESTSVC_REMOTE_REPO" >&2
 echo "  HCP_ATTESTSVC_UPDATE_TIMER=$HCP_ATTESTSVC_UPDATE_TIMER" >&2
+echo " HCP_ATTESTSVC_REMOTE_NOTIFY=$HCP_ATTESTSVC_REMOTE_NOTIFY" >&2
+echo "         HCP_ATTESTSVC_STORE=$HCP_ATTESTSVC_STORE" >&2
+echo "  HCP_ATTESTSVC_SHARD_DIGITS=$HCP_ATTESTSVC_SHARD_DIGITS" >&2
 echo "              SAFEBOOT_UWSGI=$SAFEBOOT_UWSGI" >&2
 echo "        SAFEBOOT_UWSGI_FLAGS=$SAFEBOOT_UWSGI_FLAGS" >&2
 echo "         SAFEBOOT_UWSGI_PORT=$SAFEBOOT_UWSGI_PORT" >&2
 echo "      SAFEBOOT_UWSGI_OPTIONS=$SAFEBOOT_UWSGI_OPTIONS" >&2
 
+# The replica, with HCP_ATTESTSVC_STORE=sqlite
+STORE_PATH=$HCP_ATTESTSVC_STATE_PREFIX/enrolldb.sqlite
+echo "                  STORE_PATH=$STORE_PATH" >&2
+
+# If the enrollment database is sharded (HCP_RUN_ENROLL_SHARD_DIGITS, see
+# hcp/enrollsvc/shards.py), HCP_ATTESTSVC_SHARD_DIGITS must match. Each shard
+# is then replicated on its own, into a directory (shard-<prefix>) of the same
+# form as HCP_ATTESTSVC_STATE_PREFIX is otherwise, from the repo named as
+# HCP_ATTESTSVC_REMOTE_REPO with "-<prefix>" on the end.
+SHARD_DIGITS=${HCP_ATTESTSVC_SHARD_DIGITS:-0}
+if [[ ! $SHARD_DIGITS =~ ^[0-2]$ ]]; then
+	echo "Error, HCP_ATTESTSVC_SHARD_DIGITS must be 0, 1 or 2" >&2
+	exit 1
+fi
+if [[ $HCP_ATTESTSVC_STORE == sqlite ]]; then
+	SHARD_DIGITS=0
+fi
+echo "                SHARD_DIGITS=$SHARD_DIGITS" >&2
+
 # Basic functions
 
+function using_store {
+	[[ $HCP_ATTESTSVC_STORE == sqlite ]]
+}
+
+function enroll_store {
+	python3 /safeboot/sbin/enroll_store.py $STORE_PATH "$@"
+}
+
+function sharded {
+	[[ $SHARD_DIGITS != 0 ]]
+}
+
+function shard_prefixes {
+	local i
+	for ((i = 0; i < 16 ** SHARD_DIGITS; i++)); do
+		printf "%0${SHARD_DIGITS}x\n" $i
+	done
+}
+
+# Usage: shard_dir <prefix>
+function shard_dir {
+	echo "$HCP_ATTESTSVC_STATE_PREFIX/shard-$1"
+}
+
+# Usage: shard_remote <prefix>
+function shard_remote {
+	echo "${HCP_ATTESTSVC_REMOTE_REPO%.git}-$1"
+}
+
 function expect_root {
 	if [[ `whoami` != "root" ]]; then
 		echo "Error, running as \"`whoami`\" rather than \"root\"" >&2
@@ -8,15 +8,40 @@ cd $HCP_ATTESTSVC_STATE_PREFIX
 
 echo "$HCP_VER" > version
 
-if [[ -d A || -d B || -h current || -h next || -h thirdwheel ]]; then
-	echo "Error, updater state half-baked?"
-	exit 1
+# A store replica needs no clones, only its first (full) pull, which the
+# updater retries if this one fails
+if using_store; then
+	echo "First-time initialization of $STORE_PATH."
+	enroll_store pull $HCP_ATTESTSVC_REMOTE_NOTIFY || true
+	exit 0
 fi
 
-echo "First-time initialization of $HCP_ATTESTSVC_STATE_PREFIX. Two clones and two symlinks."
-git clone $HCP_ATTESTSVC_REMOTE_REPO A
-git clone $HCP_ATTESTSVC_REMOTE_REPO B
-ln -s A current
-ln -s B next
-(cd A && git remote add twin ../B && git fetch twin)
-(cd B && git remote add twin ../A && git fetch twin)
+# Usage: init_clones <directory> <remote repo>
+function init_clones {
+	cd $1
+	if [[ -d A || -d B || -h current || -h next || -h thirdwheel ]]; then
+		echo "Error, updater state half-baked?"
+		exit 1
+	fi
+
+	echo "First-time initialization of $1. Two clones and two symlinks."
+	git clone $2 A
+	git clone $2 B
+	ln -s A current
+	ln -s B next
+	(cd A && git remote add twin ../B && git fetch twin)
+	(cd B && git remote add twin ../A && git fetch twin)
+	(cd A && attest-verify prepare .)
+	(cd B && attest-verify prepare . ../A)
+}
+
+# Each shard of a sharded enrollment database gets clones of its own
+if sharded; then
+	for prefix in `shard_prefixes`; do
+		mkdir `shard_dir $prefix`
+		init_clones `shard_dir $prefix` `shard_remote $prefix`
+	done
+	exit 0
+fi
+
+init_clones $HCP_ATTESTSVC_STATE_PREFIX $HCP_ATTESTSVC_REMOTE_REPO
@@ -11,6 +11,37 @@ function datetime_log {
 	echo "$d: $1"
 }
 
+# Wait until there's something new to fetch. If the enrollment service's change
+# notifier is configured (HCP_ATTESTSVC_REMOTE_NOTIFY), we block on it until
+# its HEAD moves on from the commit we last merged, so a new enrollment is
+# picked up as soon as it lands, and an idle replica doesn't fetch at all.
+# Otherwise (or if the notifier can't be reached) we just sleep for
+# HCP_ATTESTSVC_UPDATE_TIMER seconds and let the caller fetch regardless.
+#
+# Usage: wait_for_changes [<directory of the clones> [<shard>]]
+function wait_for_changes {
+	if [[ -z "$HCP_ATTESTSVC_REMOTE_NOTIFY" ]]; then
+		datetime_log "sleeping for $HCP_ATTESTSVC_UPDATE_TIMER seconds"
+		sleep $HCP_ATTESTSVC_UPDATE_TIMER
+		return
+	fi
+	if using_store; then
+		since=`enroll_store upstream`
+	else
+		since=`git -C $1/current rev-parse origin/master`
+	fi
+	datetime_log "waiting for changes since $since"
+	while /bin/true; do
+		if ! head=`python3 /hcp/attestsvc/wait_head.py \
+				"$HCP_ATTESTSVC_REMOTE_NOTIFY" $since 60 $2`; then
+			datetime_log "sleeping for $HCP_ATTESTSVC_UPDATE_TIMER seconds"
+			sleep $HCP_ATTESTSVC_UPDATE_TIMER
+			return
+		fi
+		[[ $head == $since ]] || return 0
+	done
+}
+
 # By discipline and convention, we do all our bash with "-e", so make sure to
 # sponge up any errors that aren't bugs or irrecoverable conditions.
 #
@@ -26,34 +57,88 @@ function datetime_log {
 # complexity - and new ways for things to go wrong - and is more likely to
 # "bury the lede" when someone sifts through the wreckage later trying to
 # figure out what happened.)
-while /bin/true; do
-	cd $HCP_ATTESTSVC_STATE_PREFIX
-	cd next
-	datetime_log "updating"
-	if (git fetch twin && git fetch origin && git merge origin/master); then
-		cd $HCP_ATTESTSVC_STATE_PREFIX
-		cp -P current thirdwheel
-		cp -T -P next current
-		mv -T thirdwheel next
-		datetime_log "sleeping for $HCP_ATTESTSVC_UPDATE_TIMER seconds"
-		sleep $HCP_ATTESTSVC_UPDATE_TIMER
-	else
-		# TODO: we should alert that the fetch/merge failed. Such
-		# failures would (likely) point to a problem with the db we're
-		# replicating from, meaning the same failures are likely being
-		# reported by other instances that replicate from the same db.
-		# "We" can't provide much information about the db, beyond
-		# signaling the existence of an issue, so keep it concise.
-		# TODO: on the other hand, if the transient error handling and
-		# recovery steps below fail for any reason, that is a different
-		# matter entirely, and it means an operator needs to look at
-		# this node, irrespective of whether our troubles were caused
-		# by a db failure. I.e. we need error-handling around our
-		# error-handling, to raise a different kind of alert.
-		datetime_log "Transient error. Trying to revert from incomplete update."
-		git reset --hard
-		git clean -f -d -x
-		datetime_log "sleeping for $BACKOFF_TIMER seconds"
-		sleep $BACKOFF_TIMER
-	fi
-done
+#
+# Each clone is prepared (see "attest-verify prepare") before it is swapped
+# in: its enrollment index is rebuilt (from the current clone's, for the
+# enrollments that haven't changed) and checked against it, and everything
+# the index refers to is read, so that the first attestations against it don't
+# pay for cold caches. The secrets for each enrollment are tarred up into a
+# bundle here too (or taken from the current clone's bundles, if unchanged),
+# rather than for each attestation. The attestation server's workers notice
+# that the index behind "current" is a new file and switch to it on their next
+# request. If the clone can't be prepared, it isn't swapped in, and we keep
+# serving the one we have until the next update succeeds.
+#
+# A store replica (HCP_ATTESTSVC_STORE=sqlite) is simpler; each pull applies
+# the delta since the last one in a single transaction, which the attestation
+# server sees as soon as it commits, or not at all if the pull fails. The
+# enrollments are prepared (their golden PCRs parsed and their secrets
+# bundled) as the delta is applied.
+#
+# If the enrollment database is sharded, each shard's clones are updated by a
+# loop of their own (as a background job), independently of the others', and
+# the attestation server uses the "current" clone of the shard that each
+# ekpubhash belongs in. If any of the loops dies, so do we.
+if using_store; then
+	while /bin/true; do
+		datetime_log "updating"
+		if ! enroll_store pull $HCP_ATTESTSVC_REMOTE_NOTIFY; then
+			datetime_log "unable to pull changes"
+			datetime_log "sleeping for $BACKOFF_TIMER seconds"
+			sleep $BACKOFF_TIMER
+			continue
+		fi
+		wait_for_changes
+	done
+fi
+
+# Usage: update_clones <directory of the clones> [<shard>]
+function update_clones {
+	while /bin/true; do
+		cd $1
+		cd next
+		datetime_log "updating"
+		if (git fetch twin && git fetch origin && git merge origin/master); then
+			if ! attest-verify prepare . $1/current; then
+				datetime_log "unable to prepare enrollments, not swapping"
+				datetime_log "sleeping for $BACKOFF_TIMER seconds"
+				sleep $BACKOFF_TIMER
+				continue
+			fi
+			cd $1
+			cp -P current thirdwheel
+			cp -T -P next current
+			mv -T thirdwheel next
+			wait_for_changes $1 $2
+		else
+			# TODO: we should alert that the fetch/merge failed. Such
+			# failures would (likely) point to a problem with the db we're
+			# replicating from, meaning the same failures are likely being
+			# reported by other instances that replicate from the same db.
+			# "We" can't provide much information about the db, beyond
+			# signaling the existence of an issue, so keep it concise.
+			# TODO: on the other hand, if the transient error handling and
+			# recovery steps below fail for any reason, that is a different
+			# matter entirely, and it means an operator needs to look at
+			# this node, irrespective of whether our troubles were caused
+			# by a db failure. I.e. we need error-handling around our
+			# error-handling, to raise a different kind of alert.
+			datetime_log "Transient error. Trying to revert from incomplete update."
+			git reset --hard
+			git clean -f -d -x
+			datetime_log "sleeping for $BACKOFF_TIMER seconds"
+			sleep $BACKOFF_TIMER
+		fi
+	done
+}
+
+if sharded; then
+	for prefix in `shard_prefixes`; do
+		update_clones `shard_dir $prefix` $prefix &
+	done
+	wait -n
+	datetime_log "an updater exited, giving up"
+	exit 1
+fi
+
+update_clones $HCP_ATTESTSVC_STATE_PREFIX
@@ -0,0 +1,33 @@
+# Wait for the enrollment database to move on from a given commit, by
+# long-polling the enrollment service's change notifier (see
+# hcp/enrollsvc/repl_notify.py). Used by updater_loop.sh.
+#
+# Usage: wait_head.py <notify URL> <commit> <seconds> [<shard>]
+#
+# Prints the enrollment database's HEAD (or that of the given shard of it),
+# which is <commit> if nothing changed within <seconds>. Exits non-zero if the
+# notifier couldn't be reached.
+
+import json
+import sys
+import urllib.parse
+import urllib.request
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5):
+        print("Usage: wait_head.py <notify URL> <commit> <seconds> [<shard>]",
+              file=sys.stderr)
+        sys.exit(1)
+    url, since, wait = sys.argv[1:4]
+    args = { 'since': since, 'wait': wait }
+    if len(sys.argv) == 5:
+        args['shard'] = sys.argv[4]
+    query = urllib.parse.urlencode(args)
+    try:
+        with urllib.request.urlopen(f"{url}/v1/head?{query}",
+                                    timeout=float(wait) + 30) as r:
+            head = json.load(r)['head']
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error, unable to wait for changes: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(head)
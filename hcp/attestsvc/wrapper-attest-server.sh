@@ -13,5 +13,12 @@ cd $DIR
 
 # Steer attest-server (and attest-verify) towards our source of truth
 export SAFEBOOT_DB_DIR="$HCP_ATTESTSVC_STATE_PREFIX/current"
+if sharded; then
+	export SAFEBOOT_DB_DIR="`shard_dir '{shard}'`/current"
+	export SAFEBOOT_DB_SHARD_DIGITS=$SHARD_DIGITS
+fi
+if using_store; then
+	export SAFEBOOT_DB_STORE="$STORE_PATH"
+fi
 
 attest-server 8080
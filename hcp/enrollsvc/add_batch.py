@@ -0,0 +1,347 @@
+# Bulk enrollment, run as DB_USER by op_add_batch.sh.
+#
+# op_add.sh enrolls one TPM at a time; it runs attest-enroll, then takes the
+# repo lock, updates hn2ek, and makes a git commit. Enrolling a pallet of
+# machines that way serializes everything (including the asset generation,
+# which needs no lock at all) and leaves one commit per machine for the
+# attestation services to replicate.
+#
+# Here, instead;
+# - attest-enroll is run for all of the entries in parallel, each into its own
+#   temporary directory (as op_add.sh does, via the cb_checkout.sh hook), with
+#   no lock held,
+# - the lock is taken once, the generated entries are moved into the ekpubhash
+#   tree, the hn2ek table is updated with a single merge, and a single git
+#   commit is made,
+# - the results are reported per entry; an entry that fails (bad hostname,
+#   attest-enroll failure, already enrolled, ...) doesn't stop the others, but
+#   if the commit itself fails, the repo is rolled back (as in op_add.sh) and
+#   every entry is reported as failed.
+#
+# The manifest given to us lists one entry per line;
+#    <path to ek.pub/ek.pem> <hostname>
+# and the JSON output looks like;
+#    {
+#        "returncode": 0,
+#        "entries": [
+#            { "hostname": "a.b.c", "returncode": 0, "ekpubhash": "abbaf00d..." },
+#            { "hostname": "d.e.f", "returncode": 1, "error": "already enrolled" }
+#        ]
+#    }
+#
+# With a single-file store (see sbin/enroll_store.py), the entries go into the
+# store in a single transaction instead, and no lock is taken.
+#
+# If the repo is sharded (see shards.py), the entries are split between the
+# shards by ekpubhash, and each shard's are committed (under that shard's lock)
+# in parallel with the others.
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import hn2ek
+import shards
+
+sys.path.append('/safeboot/sbin')
+import enroll_store
+
+# Same constraint as check_hostname in common_defs.sh
+re_hostname = re.compile(r'^[0-9a-zA-Z._-]*$')
+
+# Seconds between touches of the lockfile, which other lockers otherwise
+# consider stale after 30 seconds (see repo_cmd_lock in common.sh)
+LOCK_KEEPALIVE = 10
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+class EntryError(Exception):
+    pass
+
+class Entry:
+    def __init__(self, ekpub, hostname):
+        self.ekpub = ekpub
+        self.hostname = hostname
+        self.outdir = None
+        self.ekpubhash = None
+        self.error = None
+
+    def result(self):
+        r = { 'hostname': self.hostname,
+              'returncode': 0 if self.error is None else 1 }
+        if self.ekpubhash is not None:
+            r['ekpubhash'] = self.ekpubhash
+        if self.error is not None:
+            r['error'] = self.error
+        return r
+
+def read_manifest(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            ekpub, _, hostname = line.rpartition(' ')
+            entries.append(Entry(ekpub, hostname))
+    return entries
+
+# Run attest-enroll for one entry, into a temporary directory of its own.
+# 'genprog_jobs' (if given) limits how many of the entry's assets attest-enroll
+# generates at once, which otherwise is as many as there are CPUs. 'config' is
+# any other attest-enroll configuration (VAR=VAL), e.g. that of the secret pools
+# (see secret_pool.py).
+def generate(entry, safeboot, hooks, genprog_jobs=None, config=()):
+    if not entry.ekpub or not re_hostname.match(entry.hostname):
+        raise EntryError("malformed entry")
+    outdir = tempfile.mkdtemp()
+    os.rmdir(outdir)
+    env = dict(os.environ, EPHEMERAL_ENROLL=outdir)
+    jobs = [ '-V', f"GENPROG_JOBS={genprog_jobs}" ] if genprog_jobs else []
+    for v in config:
+        jobs += [ '-V', v ]
+    c = subprocess.run([ './sbin/attest-enroll',
+                         '-V', f"CHECKOUT={hooks}/cb_checkout.sh",
+                         '-V', f"COMMIT={hooks}/cb_commit.sh" ] + jobs +
+                       [ '-I', entry.ekpub, entry.hostname ],
+                       cwd=safeboot, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    entry.outdir = outdir
+    if c.returncode != 0:
+        log(c.stderr)
+        raise EntryError("attest-enroll failed")
+    try:
+        with open(os.path.join(outdir, 'ek.pub'), 'rb') as f:
+            entry.ekpubhash = hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        raise EntryError("ek.pub file not where it is expected")
+
+# The entries are generated 'jobs' at a time, and the CPUs are shared between
+# them rather than each attest-enroll running as many asset generators as
+# there are CPUs.
+def generate_all(entries, safeboot, hooks, jobs, config=()):
+    genprog_jobs = max(1, (os.cpu_count() or 1) // jobs)
+    def one(entry):
+        try:
+            generate(entry, safeboot, hooks, genprog_jobs, config)
+        except EntryError as e:
+            entry.error = str(e)
+        except Exception as e:
+            log(f"Error, generating {entry.hostname}: {e!r}")
+            entry.error = "attest-enroll failed"
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        list(pool.map(one, entries))
+
+# The equivalent of repo_cmd_lock/repo_cmd_unlock in common.sh, except that
+# the lockfile is kept fresh for as long as we hold it, as a large batch can
+# take longer to commit than the lockfile's timeout.
+class RepoLock:
+    def __init__(self, path):
+        self.path = path
+        self.stop = threading.Event()
+
+    def acquire(self):
+        if os.path.exists(self.path):
+            log("Warning, lockfile contention")
+        subprocess.run([ 'lockfile', '-1', '-r', '5', '-l', '30', '-s', '5', self.path ],
+                       check=True)
+        self.keepalive = threading.Thread(target=self.touch, daemon=True)
+        self.keepalive.start()
+
+    def touch(self):
+        while not self.stop.wait(LOCK_KEEPALIVE):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    # Stop keeping the lock fresh, but leave it in place
+    def abandon(self):
+        self.stop.set()
+        self.keepalive.join()
+
+    def release(self):
+        self.abandon()
+        os.unlink(self.path)
+
+def git(repo_path, *args):
+    subprocess.run([ 'git' ] + list(args), cwd=repo_path, check=True,
+                   stdout=sys.stderr)
+
+# The per-TPM directory for an ekpubhash, per ply_path_add in common_defs.sh
+def ply_path(ek_path, ekpubhash):
+    return os.path.join(ek_path, ekpubhash[0:2], ekpubhash[0:6], ekpubhash[0:32])
+
+# Move a generated entry into the ekpubhash tree. Must be called with the repo
+# lock held. Returns False (with entry.error set) if it couldn't be.
+def install_entry(repo_path, entry):
+    fpath = ply_path(os.path.join(repo_path, 'ekpubhash'), entry.ekpubhash)
+    # Exclusive enrollment, as in op_add.sh, which also catches the same
+    # TPM appearing twice in the batch
+    if os.path.exists(fpath):
+        entry.error = "already enrolled"
+        return False
+    try:
+        os.makedirs(fpath)
+        with open(os.path.join(fpath, 'ekpubhash'), 'w') as f:
+            f.write(entry.ekpubhash + '\n')
+        for name in os.listdir(entry.outdir):
+            if name.startswith('.'):
+                continue
+            src = os.path.join(entry.outdir, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, os.path.join(fpath, name), symlinks=True)
+            else:
+                shutil.copy2(src, fpath, follow_symlinks=False)
+    except OSError as e:
+        log(f"Error, installing {entry.hostname}: {e!r}")
+        shutil.rmtree(fpath, ignore_errors=True)
+        entry.error = "install failed"
+        return False
+    return True
+
+# Commit everything in the working tree. The commit (objects and the branch
+# ref) is fsync()d before git returns, so that once we report success, it
+# sticks. (core.fsync needs git 2.36 or later, older versions ignore it.)
+def commit(repo_path, message):
+    git(repo_path, 'add', '-A', '.')
+    git(repo_path, '-c', 'core.fsync=committed,reference',
+        'commit', '-q', '-m', message)
+
+# Same recovery as op_add.sh. Raises CalledProcessError if it fails, in which
+# case the caller must leave the repo locked, to force an intervention.
+def rollback(repo_path):
+    git(repo_path, 'reset', '--hard')
+    git(repo_path, 'clean', '-f', '-d', '-x')
+
+# Install the generated entries, update hn2ek and commit. Must be called with
+# the repo lock held. Returns the entries that made it into the commit.
+def install(repo_path, entries):
+    installed = [ e for e in entries if install_entry(repo_path, e) ]
+    if not installed:
+        return installed
+    hn2ek.Hn2ek(repo_path).add_many(
+        (e.hostname[::-1], e.ekpubhash[0:32]) for e in installed)
+    commit(repo_path, f"map {len(installed)} entries (batch of {len(entries)})")
+    return installed
+
+# The same as install(), into a store
+def install_store(store, entries):
+    installed = []
+    with store.write() as w:
+        for e in entries:
+            if w.put_dir(e.ekpubhash, e.hostname, e.outdir):
+                installed.append(e)
+            else:
+                e.error = "already enrolled"
+    return installed
+
+# Take the lock, install() and release the lock (or, if that fails, roll back
+# and then release it). Returns 0 on success, or 1 if nothing was committed.
+def install_locked(repo_path, lock_path, todo):
+    lock = RepoLock(lock_path)
+    try:
+        lock.acquire()
+    except subprocess.CalledProcessError:
+        log("Error, failed to lock repo")
+        for entry in todo:
+            entry.error = "failed to lock repo"
+        return 1
+    try:
+        installed = install(repo_path, todo)
+    except Exception as e:
+        log(f"Failure ({e!r}), attempting recovery")
+        for entry in todo:
+            if entry.error is None:
+                entry.error = "commit failed"
+        try:
+            rollback(repo_path)
+        except subprocess.CalledProcessError:
+            log("Error, recovery failed, leaving the repo locked")
+            lock.abandon()
+            return 1
+        lock.release()
+        return 1
+    lock.release()
+    log(f"Committed {len(installed)} entries")
+    return 0
+
+# Returns 0 if the batch was processed (even if some of its entries failed,
+# see their results), or 1 if nothing (or, if sharded, nothing in one of the
+# shards) could be committed.
+def add_batch(repo_path, lock_path, entries, safeboot='/safeboot',
+              hooks='/hcp/enrollsvc', jobs=None, config=(), store=None,
+              shard_digits=0):
+    log(f"Generating {len(entries)} entries")
+    generate_all(entries, safeboot, hooks, jobs or os.cpu_count(), config)
+    todo = [ e for e in entries if e.error is None ]
+    try:
+        if not todo:
+            return 0
+        if store is not None:
+            try:
+                installed = install_store(store, todo)
+            except Exception as e:
+                log(f"Failure ({e!r}), nothing was committed")
+                for entry in todo:
+                    entry.error = "commit failed"
+                return 1
+            log(f"Committed {len(installed)} entries")
+            return 0
+        by_shard = {}
+        for e in todo:
+            by_shard.setdefault(shards.shard_of(shard_digits, e.ekpubhash), []).append(e)
+        work = [ (repo, lock, by_shard[prefix])
+                 for prefix, repo, lock in shards.shard_paths(repo_path, lock_path,
+                                                              shard_digits)
+                 if prefix in by_shard ]
+        workers = min(len(work), jobs or os.cpu_count())
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            rcs = list(pool.map(lambda w: install_locked(*w), work))
+        return max(rcs)
+    finally:
+        for entry in entries:
+            if entry.outdir is not None:
+                shutil.rmtree(entry.outdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='enrollsvc bulk enrollment')
+    parser.add_argument('--repo', required=True,
+                        help='path of the enrollment database (REPO_PATH)')
+    parser.add_argument('--lock', required=True,
+                        help='path of the repo lockfile (REPO_LOCKPATH)')
+    parser.add_argument('--store',
+                        help='path of the single-file store (STORE_PATH), used instead of the repo')
+    parser.add_argument('--shard-digits', type=int, default=0,
+                        help='hex digits of ekpubhash the repo is sharded by (see shards.py)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of attest-enroll runs at a time')
+    parser.add_argument('--pool-dir',
+                        help='directory of pre-generated secrets to use (see secret_pool.py)')
+    parser.add_argument('--pool-key',
+                        help='key that the pre-generated secrets are encrypted in')
+    parser.add_argument('manifest',
+                        help='file of "<ekpub path> <hostname>" lines')
+    args = parser.parse_args()
+
+    entries = read_manifest(args.manifest)
+    config = []
+    if args.pool_dir:
+        config.append(f"GENPROG_POOL={args.pool_dir}")
+    if args.pool_key:
+        config.append(f"GENPROG_POOL_KEY={args.pool_key}")
+    store = enroll_store.Store(args.store) if args.store else None
+    rc = add_batch(args.repo, args.lock, entries, jobs=args.jobs, config=config,
+                   store=store, shard_digits=shards.check_digits(args.shard_digits))
+    print(json.dumps({ 'returncode': rc,
+                       'entries': [ e.result() for e in entries ] }))
+    sys.exit(rc)
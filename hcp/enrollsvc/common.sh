@@ -114,6 +114,15 @@ if [[ `whoami` == "root" ]]; then
 	echo "HCP_RUN_ENROLL_UWSGI_OPTIONS=$HCP_RUN_ENROLL_UWSGI_OPTIONS" >> /etc/environment
 	echo "HCP_RUN_ENROLL_GITDAEMON=$HCP_RUN_ENROLL_GITDAEMON" >> /etc/environment
 	echo "HCP_RUN_ENROLL_GITDAEMON_FLAGS=$HCP_RUN_ENROLL_GITDAEMON_FLAGS" >> /etc/environment
+	echo "HCP_RUN_ENROLL_COMMIT_WINDOW=$HCP_RUN_ENROLL_COMMIT_WINDOW" >> /etc/environment
+	echo "HCP_RUN_ENROLL_COMMIT_MAX=$HCP_RUN_ENROLL_COMMIT_MAX" >> /etc/environment
+	echo "HCP_RUN_ENROLL_CACHE_MAX=$HCP_RUN_ENROLL_CACHE_MAX" >> /etc/environment
+	echo "HCP_RUN_ENROLL_POOL=$HCP_RUN_ENROLL_POOL" >> /etc/environment
+	echo "HCP_RUN_ENROLL_POOL_LOW=$HCP_RUN_ENROLL_POOL_LOW" >> /etc/environment
+	echo "HCP_RUN_ENROLL_POOL_HIGH=$HCP_RUN_ENROLL_POOL_HIGH" >> /etc/environment
+	echo "HCP_RUN_ENROLL_NOTIFY_PORT=$HCP_RUN_ENROLL_NOTIFY_PORT" >> /etc/environment
+	echo "HCP_RUN_ENROLL_STORE=$HCP_RUN_ENROLL_STORE" >> /etc/environment
+	echo "HCP_RUN_ENROLL_SHARD_DIGITS=$HCP_RUN_ENROLL_SHARD_DIGITS" >> /etc/environment
 	echo "HCP_ENVIRONMENT_SET=1" >> /etc/environment
 fi
 
@@ -131,6 +140,15 @@ echo "     HCP_RUN_ENROLL_UWSGI_FLAGS=$HCP_RUN_ENROLL_UWSGI_FLAGS" >&2
 echo "   HCP_RUN_ENROLL_UWSGI_OPTIONS=$HCP_RUN_ENROLL_UWSGI_OPTIONS" >&2
 echo "       HCP_RUN_ENROLL_GITDAEMON=$HCP_RUN_ENROLL_GITDAEMON" >&2
 echo " HCP_RUN_ENROLL_GITDAEMON_FLAGS=$HCP_RUN_ENROLL_GITDAEMON_FLAGS" >&2
+echo "   HCP_RUN_ENROLL_COMMIT_WINDOW=$HCP_RUN_ENROLL_COMMIT_WINDOW" >&2
+echo "      HCP_RUN_ENROLL_COMMIT_MAX=$HCP_RUN_ENROLL_COMMIT_MAX" >&2
+echo "       HCP_RUN_ENROLL_CACHE_MAX=$HCP_RUN_ENROLL_CACHE_MAX" >&2
+echo "            HCP_RUN_ENROLL_POOL=$HCP_RUN_ENROLL_POOL" >&2
+echo "        HCP_RUN_ENROLL_POOL_LOW=$HCP_RUN_ENROLL_POOL_LOW" >&2
+echo "       HCP_RUN_ENROLL_POOL_HIGH=$HCP_RUN_ENROLL_POOL_HIGH" >&2
+echo "     HCP_RUN_ENROLL_NOTIFY_PORT=$HCP_RUN_ENROLL_NOTIFY_PORT" >&2
+echo "           HCP_RUN_ENROLL_STORE=$HCP_RUN_ENROLL_STORE" >&2
+echo "    HCP_RUN_ENROLL_SHARD_DIGITS=$HCP_RUN_ENROLL_SHARD_DIGITS" >&2
 
 # Derive more configuration using these constants
 REPO_NAME=enrolldb.git
@@ -138,6 +156,48 @@ EK_BASENAME=ekpubhash
 REPO_PATH=$HCP_ENROLLSVC_STATE_PREFIX/$REPO_NAME
 EK_PATH=$REPO_PATH/$EK_BASENAME
 REPO_LOCKPATH=$HCP_ENROLLSVC_STATE_PREFIX/lock-$REPO_NAME
+BASE_REPO_PATH=$REPO_PATH
+BASE_REPO_LOCKPATH=$REPO_LOCKPATH
+# The Unix socket that db_worker.py (as DB_USER) listens on for requests from
+# the flask app (as FLASK_USER). Exported for the benefit of mgmt_api.py.
+DB_SOCKET_DIR=/run/hcp-enrollsvc
+export DB_SOCKET=$DB_SOCKET_DIR/db.sock
+# The pools of pre-generated secrets (see secret_pool.py). The key they're
+# encrypted in is kept in the container, not in the state directory, so the
+# pools are no use to anyone with a copy of the latter (and are emptied when
+# the container is restarted).
+POOL_PATH=$HCP_ENROLLSVC_STATE_PREFIX/pool
+POOL_KEY=/home/$DB_USER/pool.key
+# With HCP_RUN_ENROLL_STORE=sqlite, the enrollments are kept in this single
+# file (see sbin/enroll_store.py) rather than in the repo's ekpubhash tree and
+# hn2ek table, which are then left empty. The repo is still made, for the
+# version and common_defs.sh.
+STORE_PATH=$HCP_ENROLLSVC_STATE_PREFIX/enrolldb.sqlite
+# With HCP_RUN_ENROLL_SHARD_DIGITS set to 1 or 2, the enrollments are split
+# between 16 or 256 repos by that many leading hex digits of their ekpubhash,
+# each with a lock of its own (see shards.py). REPO_PATH is still made, for the
+# version and common_defs.sh. This is chosen when the state is first set up
+# (and recorded in SHARD_DIGITS_PATH), and can't be changed afterwards. It
+# doesn't apply to the single-file store. NB: as each shard is replicated as a
+# repo of its own, a tofu_pcrs file has to be put in each of them.
+SHARD_DIGITS=${HCP_RUN_ENROLL_SHARD_DIGITS:-0}
+SHARD_DIGITS_PATH=$HCP_ENROLLSVC_STATE_PREFIX/shard_digits
+if [[ ! $SHARD_DIGITS =~ ^[0-2]$ ]]; then
+	echo "Error, HCP_RUN_ENROLL_SHARD_DIGITS must be 0, 1 or 2" >&2
+	exit 1
+fi
+if [[ $HCP_RUN_ENROLL_STORE == sqlite && $SHARD_DIGITS != 0 ]]; then
+	echo "Warning, HCP_RUN_ENROLL_SHARD_DIGITS is ignored with the single-file store" >&2
+	SHARD_DIGITS=0
+fi
+if [[ -z "$DB_IN_SETUP" && -f $HCP_ENROLLSVC_STATE_PREFIX/version ]]; then
+	state_digits=0
+	[[ -f $SHARD_DIGITS_PATH ]] && state_digits=`cat $SHARD_DIGITS_PATH`
+	if [[ $state_digits != $SHARD_DIGITS ]]; then
+		echo "Error, the state is sharded by $state_digits digits, not $SHARD_DIGITS" >&2
+		exit 1
+	fi
+fi
 
 # Print the additional configuration
 echo "                      REPO_NAME=$REPO_NAME" >&2
@@ -145,6 +205,11 @@ echo "                    EK_BASENAME=$EK_BASENAME" >&2
 echo "                      REPO_PATH=$REPO_PATH" >&2
 echo "                        EK_PATH=$EK_PATH" >&2
 echo "                  REPO_LOCKPATH=$REPO_LOCKPATH" >&2
+echo "                      DB_SOCKET=$DB_SOCKET" >&2
+echo "                      POOL_PATH=$POOL_PATH" >&2
+echo "                       POOL_KEY=$POOL_KEY" >&2
+echo "                     STORE_PATH=$STORE_PATH" >&2
+echo "                   SHARD_DIGITS=$SHARD_DIGITS" >&2
 echo "               SIGNING_KEY_PRIV=$SIGNING_KEY_PRIV" >&2
 echo "                SIGNING_KEY_PUB=$SIGNING_KEY_PUB" >&2
 
@@ -202,24 +267,74 @@ function repo_cmd_unlock {
 
 . /hcp/enrollsvc/common_defs.sh
 
-# Except ... we also provide a reverse-lookup (hostname to ekpubhash) in a
-# single file that the attestation service itself isn't supposed to need. We
-# put the relevant definitions here (rather than in common_defs.h) to emphasize
-# this point.
+# Except ... we also provide a reverse-lookup (hostname to ekpubhash) table
+# that the attestation service itself isn't supposed to need. We put the
+# relevant definitions here (rather than in common_defs.h) to emphasize this
+# point.
 #
-# TODO: we could do much better than the following. As the size of the dataset
-# grows, the adds and deletes to the reverse-lookup table will dominate, as
-# will memory and file-system thrashing (due to the need to copy and filter
-# copies of the table inside the critical section). As with elsewhere, we make
-# do with a simple but easy-to-validate solution for now, and mark this for a
-# smarter implementation when there is enough time and focus to not make a mess
-# of it (and once things are running at a scale that can detect problems).
-#
-# Each line of this file is a space-separated 2-tuple of;
+# Each entry of this table is a space-separated 2-tuple of;
 # - the reversed hostname (per 'rev')
 # - the ekpubhash (truncated to 32 characters if appropriate, i.e. to match the
 #   name of the per-TPM sub-sub-sub-drectory in the ekpubhash/ directory tree).
+#
+# The table is kept sorted, split into bounded chunks under the hn2ek.d/
+# directory, along with a manifest of the chunks, so that an add or delete
+# only rewrites (and commits) one small file, and a hostname-suffix search
+# only reads the chunks that can match. hn2ek.py implements this, see there.
+# Repos created before this have a single flat "hn2ek" file instead, which
+# hn2ek.py converts on the first add or delete (and reads until then).
 
-# The initially-empty file
 HN2EK_BASENAME=hn2ek
 HN2EK_PATH=$REPO_PATH/$HN2EK_BASENAME
+HN2EK_DIR=$REPO_PATH/$HN2EK_BASENAME.d
+
+# Usage: hn2ek {add <revhn> <ekpubhash>|remove|find <hostname_suffix>|migrate}
+# (The caller must hold the repo lock for anything other than 'find'.)
+function hn2ek {
+	python3 /hcp/enrollsvc/hn2ek.py $REPO_PATH "$@"
+}
+
+# Usage: enroll_store {create|add <ekpubhash> <hostname> <dir>|query <ekpubhash>|
+#                      delete <ekpubhash>|find <hostname_suffix>|head}
+# (The store does its own locking.)
+function enroll_store {
+	python3 /safeboot/sbin/enroll_store.py $STORE_PATH "$@"
+}
+
+function using_store {
+	[[ $HCP_RUN_ENROLL_STORE == sqlite ]]
+}
+
+# Shards, see shards.py (which names them the same way)
+
+function sharded {
+	[[ $SHARD_DIGITS != 0 ]]
+}
+
+# Usage: shard_prefixes [<ekpubhash prefix>]
+# The prefixes of the shards that entries matching the ekpubhash prefix (if
+# given) can be in, in order
+function shard_prefixes {
+	local i
+	for ((i = 0; i < 16 ** SHARD_DIGITS; i++)); do
+		printf "%0${SHARD_DIGITS}x\n" $i
+	done | grep "^${1:0:$SHARD_DIGITS}"
+}
+
+# Usage: shard_repo <prefix>
+function shard_repo {
+	echo "${BASE_REPO_PATH%.git}-$1.git"
+}
+
+# Usage: use_shard <ekpubhash>
+# Point REPO_PATH (and everything derived from it) at the shard the ekpubhash
+# belongs to. The shard's lock is then taken by repo_cmd_lock, as usual.
+function use_shard {
+	sharded || return 0
+	local prefix=${1:0:$SHARD_DIGITS}
+	REPO_PATH=`shard_repo $prefix`
+	EK_PATH=$REPO_PATH/$EK_BASENAME
+	REPO_LOCKPATH=${BASE_REPO_LOCKPATH%.git}-$prefix.git
+	HN2EK_PATH=$REPO_PATH/$HN2EK_BASENAME
+	HN2EK_DIR=$REPO_PATH/$HN2EK_BASENAME.d
+}
@@ -0,0 +1,146 @@
+# Offline conversion of the enrollment database between the directory layout
+# (the ekpubhash tree and hn2ek table of the git repo, see common_defs.sh) and
+# the single-file store (see sbin/enroll_store.py);
+#    convert_store.py --repo <REPO_PATH> --store <STORE_PATH> to-store
+#    convert_store.py --repo <REPO_PATH> --store <STORE_PATH> to-repo
+#
+# Stop the enrollment service (and set HCP_RUN_ENROLL_STORE to match) around a
+# conversion. to-store copies every enrollment (and tofu_pcrs) into the store,
+# creating it if need be, in a single transaction; the repo is left as it is.
+# to-repo does the reverse, under the repo lock, adding the enrollments to the
+# ekpubhash tree and hn2ek table and making a single commit. Either way, an
+# enrollment that is already at the destination is an error, and nothing is
+# converted. The attestation services have to be switched over too; a store
+# replica is filled by its first pull, and a git clone by its next fetch.
+#
+# A store has no `pcrsets` directory of golden PCR sets (see
+# sbin/enroll_index.py), so to-store gives an enrollment that refers to one a
+# copy of the set as its `pcrs` (a set is a `pcrs` file itself), and to-repo
+# leaves it that way.
+#
+# With --shard-digits, the repo is sharded (see shards.py); to-store reads all
+# of the shards, and to-repo writes each enrollment to its shard (taking all of
+# the shards' locks, and making a commit in each shard).
+
+import argparse
+import hashlib
+import os
+import sys
+
+import add_batch
+import db_worker
+import hn2ek
+import shards
+
+sys.path.append('/safeboot/sbin')
+import enroll_store
+
+# Enrollments between progress reports
+PROGRESS = 10000
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+# The files of an enrolled directory, with the golden PCR set it refers to (if
+# it has no `pcrs` of its own) in place of the reference
+def read_entry(repo_path, path):
+    files = enroll_store.read_dir(path)
+    refs = [ data for name, _, data in files if name == 'pcrset' ]
+    if not refs or any(name == 'pcrs' for name, _, _ in files):
+        return files
+    digest = refs[0].decode().strip()
+    if len(digest) != 64 or digest.strip('0123456789abcdef'):
+        raise enroll_store.StoreError(f"{path}: bad golden PCR set digest {digest!r}")
+    with open(os.path.join(repo_path, 'pcrsets', digest), 'rb') as f:
+        pcrs = f.read()
+    if hashlib.sha256(pcrs).hexdigest() != digest:
+        raise enroll_store.StoreError(f"{path}: golden PCR set {digest} does not match its digest")
+    return [ (name, mode, data) for name, mode, data in files if name != 'pcrset' ] + \
+        [ ('pcrs', 0o644, pcrs) ]
+
+def to_store(repo_path, store, digits=0):
+    n = 0
+    with store.write() as w:
+        for _, shard_path, _ in shards.shard_paths(repo_path, None, digits):
+            db = db_worker.EnrollDB(shard_path)
+            for path in db.ply_walk(''):
+                e = db.entry(path)
+                if not w.put(e['ekpubhash'], e['hostname'], read_entry(shard_path, path)):
+                    raise enroll_store.StoreError(f"{e['ekpubhash']} is already in the store")
+                n += 1
+                if n % PROGRESS == 0:
+                    log(f"Converted {n} enrollments")
+        # (every shard has the same tofu_pcrs, if any)
+        tofu = os.path.join(shards.shard_path(repo_path, shards.prefixes(digits)[0]),
+                            'tofu_pcrs')
+        if os.path.exists(tofu):
+            with open(tofu) as f:
+                w.set_tofu_pcrs(f.read())
+    return n
+
+def to_repo(repo_path, store, digits=0):
+    paths = { p: path for p, path, _ in shards.shard_paths(repo_path, None, digits) }
+    db = store.conn()
+    added = { p: [] for p in paths }
+    n = 0
+    with enroll_store.transaction(db, 'DEFERRED'):
+        for key, ekpubhash, hostname in store.select(db, ''):
+            shard = shards.shard_of(digits, ekpubhash)
+            ek_path = os.path.join(paths[shard], 'ekpubhash')
+            fpath = add_batch.ply_path(ek_path, ekpubhash)
+            if os.path.exists(fpath):
+                raise enroll_store.StoreError(f"{ekpubhash} is already in the repo")
+            os.makedirs(fpath)
+            enroll_store.write_dir(fpath, store.files(db, key))
+            added[shard].append((hostname[::-1], key))
+            n += 1
+            if n % PROGRESS == 0:
+                log(f"Converted {n} enrollments")
+        tofu = store.read_tofu_pcrs(db)
+    for shard, path in paths.items():
+        if not added[shard] and tofu is None:
+            continue
+        if tofu is not None:
+            with open(os.path.join(path, 'tofu_pcrs'), 'w') as f:
+                f.write(tofu)
+        hn2ek.Hn2ek(path).add_many(added[shard])
+        add_batch.commit(path, f"convert {len(added[shard])} entries from {store.path}")
+    return n
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='enrollsvc store conversion')
+    parser.add_argument('--repo', required=True,
+                        help='path of the enrollment database (REPO_PATH)')
+    parser.add_argument('--store', required=True,
+                        help='path of the single-file store (STORE_PATH)')
+    parser.add_argument('--lock',
+                        help='path of the repo lockfile (REPO_LOCKPATH), for to-repo')
+    parser.add_argument('--shard-digits', type=int, default=0,
+                        help='hex digits of ekpubhash the repo is sharded by (see shards.py)')
+    parser.add_argument('direction', choices=[ 'to-store', 'to-repo' ])
+    args = parser.parse_args()
+
+    digits = shards.check_digits(args.shard_digits)
+    if args.direction == 'to-store':
+        store = enroll_store.Store(args.store, 'rwc', wal=True)
+        n = to_store(args.repo, store, digits)
+        log(f"Converted {n} enrollments into {args.store}, now at {store.head()}")
+        sys.exit(0)
+
+    store = enroll_store.Store(args.store, 'ro')
+    repos = shards.shard_paths(args.repo, args.lock, digits)
+    locks = [ add_batch.RepoLock(lock) for _, _, lock in repos if lock ]
+    for lock in locks:
+        lock.acquire()
+    try:
+        n = to_repo(args.repo, store, digits)
+    except Exception as e:
+        log(f"Failure ({e!r}), attempting recovery")
+        for _, path, _ in repos:
+            add_batch.rollback(path)
+        for lock in locks:
+            lock.release()
+        sys.exit(1)
+    for lock in locks:
+        lock.release()
+    log(f"Converted {n} enrollments into {args.repo}")
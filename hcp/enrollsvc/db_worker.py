@@ -0,0 +1,662 @@
+# This is the DB_USER side of the enrollsvc-mgmt privilege separation. It is a
+# long-lived process (started by run_mgmt.sh, via db_worker.sh) that listens on
+# a Unix socket for requests from the flask app (mgmt_api.py, running as
+# FLASK_USER), rather than the flask app forking "sudo -u $DB_USER op_<verb>.sh"
+# for each request.
+#
+# The same security properties are preserved;
+# - only FLASK_USER (as established by SO_PEERCRED, not by anything the caller
+#   says) may connect,
+# - the caller has no way to influence our environment, only the arguments of
+#   the request, and
+# - every request is validated against a strict schema (the same checks as
+#   common_defs.sh) before anything is done with it.
+#
+# The protocol is one JSON object per line in each direction. A request looks
+# like;
+#    { "op": "query", "ekpubhash": "abbaf00d" }
+# and the response is either;
+#    { "returncode": 0, "result": { ... } }
+# or;
+#    { "returncode": 1, "error": "..." }
+# where "result" is the JSON that the op_<verb>.sh script would have printed.
+#
+# The read-only operations (query and find) are implemented here directly.
+# Adds and deletes are too, when the worker is given the repo lock's path;
+# they are queued for group commit (see group_commit.py), so that concurrent
+# writes share a single take of the lock and a single git commit. Otherwise,
+# and for add_batch (which is already a single commit), they are handed to the
+# op_<verb>.sh scripts, which take the repo lock, commit, and roll back on
+# failure.
+#
+# The worker keeps metrics (see sbin/safeboot_metrics.py) of the time taken by
+# each op and by the stages of a write (attest-enroll, waiting for the group
+# commit, waiting for the repo lock, and the git commit), the ops in flight and
+# the failures. The "metrics" op returns them in the Prometheus text format,
+# for GET /metrics on the flask app.
+#
+# If given a pool directory, the worker keeps pools of pre-generated secrets
+# for new enrollments topped up (see secret_pool.py), and adds take from them.
+#
+# If given a single-file store (see sbin/enroll_store.py), the enrollments are
+# kept there rather than in the repo's ekpubhash tree, and every op is done on
+# the store. Group commit still applies, each group being one transaction.
+#
+# If the repo is sharded (see shards.py), each shard has a group committer (and
+# a lock) of its own, an add goes to the shard of its ekpubhash, and queries
+# and deletes that could match more than one shard are done on each of them in
+# parallel.
+
+import argparse
+import base64
+import collections
+import concurrent.futures
+import json
+import os
+import pwd
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+import add_batch
+import group_commit
+import hn2ek
+import secret_pool
+import shards
+
+# Shared with the attestation server
+sys.path.append('/safeboot/sbin')
+import enroll_store
+import safeboot_metrics
+
+# The same constraints as check_ekpubhash_prefix, check_hostname and
+# check_hostname_suffix in common_defs.sh
+re_ekpubhash_prefix = re.compile(r'^[0-9a-f]*$')
+re_hostname = re.compile(r'^[0-9a-zA-Z._-]*$')
+
+# Largest request we'll read (this is dominated by add_batch, whose entries
+# each carry a base64-encoded ek.pub of no more than a couple of KiB)
+MAX_REQUEST = 16 * 1024 * 1024
+
+# Most entries allowed in an add_batch request
+MAX_BATCH = 4096
+
+# Most entries returned in a page of query results
+MAX_PAGE = 1000
+
+# Most shards queried (or deleted from) at once
+MAX_FANOUT = 32
+
+# The environment the op_<verb>.sh scripts run with; as with sudo, nothing is
+# inherited, common.sh picks up the rest from /etc/environment.
+SCRIPT_ENV = {
+    'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+    'LANG': 'C',
+}
+
+class RequestError(Exception):
+    pass
+
+metrics = safeboot_metrics.registry
+op_names = [ 'add', 'add_batch', 'query', 'query_page', 'delete', 'find',
+             'stats' ]
+op_seconds = metrics.histogram('safeboot_enroll_op_seconds',
+                               'Time spent handling each op of the DB worker',
+                               'op', op_names)
+op_failures = metrics.counter('safeboot_enroll_op_failures_total',
+                              'Ops that failed (or were rejected), by op',
+                              'op', op_names + [ 'invalid' ])
+ops_in_flight = metrics.gauge('safeboot_enroll_ops_in_flight',
+                              'Ops being handled by the DB worker', 'op', op_names)
+stage_seconds = metrics.histogram('safeboot_enroll_stage_seconds',
+                                  'Time spent in each stage of enrolling or deleting',
+                                  'stage', [ 'attest_enroll', 'commit_queue',
+                                             'lock_wait', 'git_commit',
+                                             'store_commit' ])
+
+# Each operation is described by the fields it requires, and a validator for
+# each field. Requests with missing or extra fields are rejected.
+def field_ekpubhash_prefix(v):
+    if not isinstance(v, str) or not re_ekpubhash_prefix.match(v):
+        raise RequestError("malformed ekpubhash")
+    return v
+
+def field_hostname(v):
+    if not isinstance(v, str) or not re_hostname.match(v):
+        raise RequestError("malformed hostname")
+    return v
+
+def field_ekpub(v):
+    if not isinstance(v, str):
+        raise RequestError("malformed ekpub")
+    try:
+        return base64.b64decode(v, validate=True)
+    except ValueError:
+        raise RequestError("malformed ekpub")
+
+re_cursor = re.compile(r'^([0-9a-f]{32})?$')
+
+def field_cursor(v):
+    if not isinstance(v, str) or not re_cursor.match(v):
+        raise RequestError("malformed cursor")
+    return v
+
+def field_limit(v):
+    if not isinstance(v, int) or v < 1 or v > MAX_PAGE:
+        raise RequestError("malformed limit")
+    return v
+
+def field_batch(v):
+    if not isinstance(v, list) or len(v) == 0 or len(v) > MAX_BATCH:
+        raise RequestError("malformed batch")
+    entries = []
+    for e in v:
+        if not isinstance(e, dict) or set(e.keys()) != { 'ekpub', 'hostname' }:
+            raise RequestError("malformed batch")
+        entries.append((field_ekpub(e['ekpub']), field_hostname(e['hostname'])))
+    return entries
+
+ops = {}
+
+def op(name, **fields):
+    def register(fn):
+        ops[name] = (fn, fields)
+        return fn
+    return register
+
+def validate(req):
+    if not isinstance(req, dict) or not isinstance(req.get('op'), str):
+        raise RequestError("malformed request")
+    if req['op'] not in ops:
+        raise RequestError("unknown op")
+    fn, fields = ops[req['op']]
+    args = set(req.keys()) - { 'op' }
+    if args != set(fields.keys()):
+        raise RequestError("wrong fields for op")
+    return fn, { k: fields[k](req[k]) for k in fields }
+
+# The commit checked out in the repo, read without forking git (the same
+# logic as enroll_index.head_commit on the attestation side)
+def head_commit(repo_path):
+    git = os.path.join(repo_path, '.git')
+    try:
+        with open(os.path.join(git, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[5:]
+        try:
+            with open(os.path.join(git, ref)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        with open(os.path.join(git, 'packed-refs')) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+# Results of the read-only operations, which can only change when the repo
+# gets a new commit. Entries are keyed by the operation and its arguments, and
+# are only good for the commit they were produced from; when HEAD moves (or a
+# write is made, see group_commit.py), the cache is emptied. Least-recently
+# used entries are evicted to keep the total size (of the JSON) under
+# max_bytes. 'head' reads HEAD (or the head of the store).
+class ResultCache:
+    def __init__(self, head, max_bytes):
+        self.head_fn = head
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.head = None
+        # bumped by clear(), so that results produced across it are dropped
+        self.generation = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.head = None
+            self.generation += 1
+
+    def get(self, key, fn):
+        head = self.head_fn()
+        with self.lock:
+            if head is not None and head == self.head and key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            generation = self.generation
+        result = fn()
+        if head is None or self.max_bytes == 0:
+            return result
+        size = len(json.dumps(result))
+        with self.lock:
+            if generation != self.generation or size > self.max_bytes:
+                return result
+            if head != self.head:
+                self.entries.clear()
+                self.bytes = 0
+                self.head = head
+            if key not in self.entries:
+                self.entries[key] = (result, size)
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+        return result
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses,
+                     'entries': len(self.entries), 'bytes': self.bytes,
+                     'max_bytes': self.max_bytes, 'head': self.head }
+
+class EnrollDB:
+    def __init__(self, repo_path, scripts='/hcp/enrollsvc', safeboot='/safeboot',
+                 committer=None, cache_bytes=0, pool=None, store=None):
+        self.repo_path = repo_path
+        self.pool = pool
+        self.store = store
+        if store is not None:
+            self.cache = ResultCache(store.head, cache_bytes)
+        else:
+            self.cache = ResultCache(lambda: head_commit(repo_path), cache_bytes)
+        self.safeboot = safeboot
+        self.committer = committer
+        self.ek_path = os.path.join(repo_path, 'ekpubhash')
+        self.hn2ek = hn2ek.Hn2ek(repo_path)
+        self.scripts = scripts
+
+    # The per-TPM directories matching an ekpubhash prefix, in the same
+    # order as "ls -d $FPATH" (see ply_path_get in common_defs.sh), which is
+    # also ekpubhash order. If 'after' is given (a 32-character directory
+    # name), only the directories that sort after it are produced, and the
+    # parts of the tree that sort before it aren't read at all.
+    def ply_walk(self, prefix, after=''):
+        def ls(path, want, skip):
+            try:
+                names = os.listdir(path)
+            except FileNotFoundError:
+                return []
+            return sorted(n for n in names if want(n) and n >= skip)
+        for ply1 in ls(self.ek_path, lambda n: n.startswith(prefix[0:2]) and len(n) == 2,
+                       after[0:2]):
+            p1 = os.path.join(self.ek_path, ply1)
+            for ply2 in ls(p1, lambda n: n.startswith(prefix[0:6]), after[0:6]):
+                p2 = os.path.join(p1, ply2)
+                for ply3 in ls(p2, lambda n: n.startswith(prefix[0:32]) and n != after,
+                               after):
+                    yield os.path.join(p2, ply3)
+
+    def ply_dirs(self, prefix):
+        return list(self.ply_walk(prefix))
+
+    # The JSON of an entry, as built by op_query.sh
+    def entry(self, path):
+        with open(os.path.join(path, 'ekpubhash')) as f:
+            ekp = f.readline().strip()
+        with open(os.path.join(path, 'hostname')) as f:
+            hn = f.readline().strip()
+        others = [ n for n in sorted(os.listdir(path))
+                   if 'ekpubhash' not in n and 'hostname' not in n ]
+        return { 'ekpubhash': ekp, 'hostname': hn, 'others': others }
+
+    def query(self, ekpubhash):
+        if self.store is not None:
+            return self.store.query(ekpubhash)
+        entries = []
+        for path in self.ply_dirs(ekpubhash):
+            try:
+                entries.append(self.entry(path))
+            except FileNotFoundError:
+                # deleted underneath us
+                continue
+        return { 'entries': entries }
+
+    # A page of query results, of no more than 'limit' entries, starting
+    # after the entry named 'after' (see ply_walk). The cursor is where the
+    # next page starts, or None if this is the last page.
+    def query_page(self, ekpubhash, limit, after):
+        if self.store is not None:
+            return self.store.query_page(ekpubhash, limit, after)
+        entries = []
+        cursor = None
+        for path in self.ply_walk(ekpubhash, after):
+            if len(entries) == limit:
+                cursor = after
+                break
+            after = os.path.basename(path)
+            try:
+                entries.append(self.entry(path))
+            except FileNotFoundError:
+                continue
+        return { 'entries': entries, 'cursor': cursor }
+
+    # The reverse-lookup table's files are replaced atomically by the
+    # add/delete logic, so reading it needs no lock (see hn2ek.py).
+    def find(self, hostname_suffix):
+        if self.store is not None:
+            found = self.store.find(hostname_suffix)
+        else:
+            found = self.hn2ek.find(hostname_suffix)
+        return { 'hostname_suffix': hostname_suffix, 'ekpubhashes': found }
+
+    def script(self, name, args):
+        c = subprocess.run([ os.path.join(self.scripts, name) ] + args,
+                           stdout=subprocess.PIPE, text=True,
+                           env=SCRIPT_ENV, cwd='/')
+        return c.returncode, c.stdout
+
+    def add(self, ekpub, hostname):
+        # The ek.pub goes into a private temporary directory, as
+        # attest-enroll (and op_add.sh) want a path to it.
+        with tempfile.TemporaryDirectory() as td:
+            p = os.path.join(td, 'ek.pub')
+            with open(p, 'wb') as f:
+                f.write(ekpub)
+            if self.committer is None:
+                rc, out = self.script('op_add.sh', [ p, hostname ])
+                sys.stdout.write(out)
+                return rc, None
+            entry = add_batch.Entry(p, hostname)
+            config = self.pool.config() if self.pool is not None else []
+            try:
+                with stage_seconds.time('attest_enroll'):
+                    add_batch.generate(entry, self.safeboot, self.scripts,
+                                       config=config)
+                committer = self.shard(entry.ekpubhash).committer
+                rc, _ = committer.submit(group_commit.Add(entry))
+            except add_batch.EntryError as e:
+                print(f"Error, {e}", file=sys.stderr)
+                rc = 1
+            finally:
+                if self.pool is not None:
+                    self.pool.poke()
+                if entry.outdir is not None:
+                    shutil.rmtree(entry.outdir, ignore_errors=True)
+        return rc, None
+
+    # As add(), but the ek.pubs go into one temporary directory, along with
+    # the manifest that op_add_batch.sh wants.
+    def add_batch(self, entries):
+        with tempfile.TemporaryDirectory() as td:
+            manifest = os.path.join(td, 'manifest')
+            with open(manifest, 'w') as m:
+                for i, (ekpub, hostname) in enumerate(entries):
+                    p = os.path.join(td, f"{i}.pub")
+                    with open(p, 'wb') as f:
+                        f.write(ekpub)
+                    m.write(f"{p} {hostname}\n")
+            rc, out = self.script('op_add_batch.sh', [ manifest ])
+        return rc, json.loads(out)
+
+    def delete(self, ekpubhash):
+        if self.committer is not None:
+            return self.committer.submit(group_commit.Delete(ekpubhash))
+        rc, out = self.script('op_delete.sh', [ ekpubhash ])
+        if rc != 0:
+            return rc, None
+        return rc, json.loads(out)
+
+    # The database (shard) that an ekpubhash belongs in
+    def shard(self, ekpubhash):
+        return self
+
+# A repo split into shards (see shards.py), each an EnrollDB of its own. They
+# share the result cache, which any shard's commit empties, and whose entries
+# are good for as long as none of the shards' HEADs move. 'committer' is set
+# (to the committers of the shards) by start_group_commit().
+class ShardedDB(EnrollDB):
+    def __init__(self, repo_path, digits, cache_bytes=0, **kwargs):
+        super().__init__(repo_path, **kwargs)
+        self.digits = digits
+        self.shards = {}
+        for prefix, path, _ in shards.shard_paths(repo_path, None, digits):
+            self.shards[prefix] = EnrollDB(path, scripts=self.scripts,
+                                           safeboot=self.safeboot, pool=self.pool)
+        paths = [ db.repo_path for db in self.shards.values() ]
+        self.cache = ResultCache(lambda: tuple(head_commit(p) for p in paths),
+                                 cache_bytes)
+        for db in self.shards.values():
+            db.cache = self.cache
+        self.fanout = concurrent.futures.ThreadPoolExecutor(min(len(self.shards),
+                                                                MAX_FANOUT))
+
+    def start_group_commit(self, lock_path, window, max_ops, stage_seconds=None):
+        self.committer = []
+        for prefix, _, lock in shards.shard_paths(self.repo_path, lock_path, self.digits):
+            db = self.shards[prefix]
+            db.committer = group_commit.GroupCommitter(db, lock, window, max_ops,
+                                                       stage_seconds)
+            self.committer.append(db.committer)
+
+    def shard(self, ekpubhash):
+        return self.shards[shards.shard_of(self.digits, ekpubhash)]
+
+    # Call fn on each shard that can have entries matching the prefix, in
+    # parallel, returning the results in shard (which is ekpubhash) order
+    def each(self, ekpubhash, fn):
+        dbs = [ self.shards[p] for p in shards.matching(self.digits, ekpubhash) ]
+        return list(self.fanout.map(fn, dbs))
+
+    def query(self, ekpubhash):
+        results = self.each(ekpubhash, lambda db: db.query(ekpubhash))
+        return { 'entries': [ e for r in results for e in r['entries'] ] }
+
+    # The shards are read in turn, from the one the cursor is in, until the
+    # page is full. A page that fills up at the end of a shard only has a
+    # cursor if a later shard has more (which a limit of 0 tells us).
+    def query_page(self, ekpubhash, limit, after):
+        entries = []
+        start = shards.shard_of(self.digits, after)
+        for prefix in shards.matching(self.digits, ekpubhash):
+            if prefix < start:
+                continue
+            page = self.shards[prefix].query_page(ekpubhash, limit - len(entries),
+                                                  after if prefix == start else '')
+            entries += page['entries']
+            if page['cursor'] is not None:
+                cursor = page['cursor'] if page['entries'] else entries[-1]['ekpubhash'][0:32]
+                return { 'entries': entries, 'cursor': cursor }
+        return { 'entries': entries, 'cursor': None }
+
+    def find(self, hostname_suffix):
+        paths = [ db.repo_path for db in self.shards.values() ]
+        return { 'hostname_suffix': hostname_suffix,
+                 'ekpubhashes': hn2ek.find_many(paths, hostname_suffix) }
+
+    # Each shard commits its own deletions, so one shard failing doesn't undo
+    # the others. The result lists what was deleted either way, and (when rc
+    # is non-zero) the prefixes of the shards that failed, which can simply
+    # be retried.
+    def delete(self, ekpubhash):
+        if self.committer is None:
+            return super().delete(ekpubhash)
+        prefixes = shards.matching(self.digits, ekpubhash)
+        results = self.each(ekpubhash, lambda db: db.delete(ekpubhash))
+        entries = []
+        failed = []
+        for prefix, (rc, r) in zip(prefixes, results):
+            if rc != 0:
+                failed.append(prefix)
+            if r is not None:
+                entries += r['entries']
+        if failed:
+            print(f"Error, delete of {ekpubhash} failed in shards {failed} "
+                  f"({len(entries)} entries were deleted)", file=sys.stderr)
+            return 1, { 'entries': entries, 'failed_shards': failed }
+        return 0, { 'entries': entries }
+
+@op('add', ekpub=field_ekpub, hostname=field_hostname)
+def do_add(db, ekpub, hostname):
+    return db.add(ekpub, hostname)
+
+@op('add_batch', entries=field_batch)
+def do_add_batch(db, entries):
+    return db.add_batch(entries)
+
+@op('query', ekpubhash=field_ekpubhash_prefix)
+def do_query(db, ekpubhash):
+    return 0, db.cache.get(('query', ekpubhash), lambda: db.query(ekpubhash))
+
+@op('query_page', ekpubhash=field_ekpubhash_prefix, limit=field_limit,
+    after=field_cursor)
+def do_query_page(db, ekpubhash, limit, after):
+    return 0, db.cache.get(('query_page', ekpubhash, limit, after),
+                           lambda: db.query_page(ekpubhash, limit, after))
+
+@op('delete', ekpubhash=field_ekpubhash_prefix)
+def do_delete(db, ekpubhash):
+    return db.delete(ekpubhash)
+
+@op('find', hostname_suffix=field_hostname)
+def do_find(db, hostname_suffix):
+    return 0, db.cache.get(('find', hostname_suffix),
+                           lambda: db.find(hostname_suffix))
+
+@op('stats')
+def do_stats(db):
+    return 0, { 'cache': db.cache.stats() }
+
+# (handled by Handler.process, this is only for validate)
+@op('metrics')
+def do_metrics(db):
+    return 0, metrics.render()
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        if uid not in self.server.allowed_uids:
+            print(f"Rejecting connection from uid {uid}", file=sys.stderr)
+            return
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if not line:
+                return
+            self.wfile.write(json.dumps(self.process(line)).encode() + b'\n')
+            self.wfile.flush()
+
+    def process(self, line):
+        try:
+            if len(line) > MAX_REQUEST or not line.endswith(b'\n'):
+                raise RequestError("request too large")
+            try:
+                req = json.loads(line)
+            except ValueError:
+                raise RequestError("malformed request")
+            fn, args = validate(req)
+        except RequestError as e:
+            print(f"Bad request: {e}", file=sys.stderr)
+            op_failures.inc('invalid')
+            return { 'returncode': 1, 'error': str(e) }
+        op = req['op']
+        if op == 'metrics':
+            # (not counted, nor logged, as it is polled)
+            return { 'returncode': 0, 'result': metrics.render() }
+        print(f"Running {op}", file=sys.stderr)
+        try:
+            with ops_in_flight.track(op), op_seconds.time(op):
+                rc, result = fn(self.server.db, **args)
+        except Exception as e:
+            print(f"Error, {op} failed: {e!r}", file=sys.stderr)
+            op_failures.inc(op)
+            return { 'returncode': 1, 'error': f"{op} failed" }
+        if rc != 0:
+            op_failures.inc(op)
+        resp = { 'returncode': rc }
+        if result is not None:
+            resp['result'] = result
+        return resp
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, db, allowed_uids):
+        self.db = db
+        self.allowed_uids = allowed_uids
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, Handler)
+        # access control is by SO_PEERCRED, not by file permissions
+        os.chmod(path, 0o666)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='enrollsvc DB worker')
+    parser.add_argument('--socket', required=True,
+                        help='path of the Unix socket to listen on')
+    parser.add_argument('--repo', required=True,
+                        help='path of the enrollment database (REPO_PATH)')
+    parser.add_argument('--allow-user', action='append', default=[],
+                        help='account allowed to connect (repeatable)')
+    parser.add_argument('--lock',
+                        help='path of the repo lockfile (REPO_LOCKPATH), enables group commit')
+    parser.add_argument('--store',
+                        help='path of the single-file store (STORE_PATH), used instead of the repo')
+    parser.add_argument('--shard-digits', type=int, default=0,
+                        help='hex digits of ekpubhash the repo is sharded by (see shards.py)')
+    parser.add_argument('--commit-window', type=int, default=20,
+                        help='milliseconds to gather writes for a group commit')
+    parser.add_argument('--commit-max', type=int, default=64,
+                        help='most writes in a group commit')
+    parser.add_argument('--cache-max', type=int, default=64,
+                        help='MiB of query/find results to cache (0 to disable)')
+    parser.add_argument('--pool', action='append', default=[],
+                        help='genprog to keep pre-generated secrets for (repeatable)')
+    parser.add_argument('--pool-dir',
+                        help='directory of the pools of pre-generated secrets')
+    parser.add_argument('--pool-key',
+                        help='key that pool entries are encrypted in (made if missing)')
+    parser.add_argument('--pool-low', type=int, default=16,
+                        help='refill a pool when it has fewer entries than this')
+    parser.add_argument('--pool-high', type=int, default=64,
+                        help='entries to refill a pool to (0 to disable the pools)')
+    parser.add_argument('--pool-seed',
+                        help='fill the pools with predictable secrets, FOR TESTING ONLY')
+    args = parser.parse_args()
+
+    allowed = { pwd.getpwnam(u).pw_uid for u in args.allow_user }
+    pool = None
+    if args.pool_dir and args.pool and args.pool_high > 0:
+        pool = secret_pool.SecretPool(args.pool_dir,
+                                      args.pool_key or f"{args.pool_dir}.key",
+                                      args.pool, args.pool_low, args.pool_high,
+                                      metrics, seed=args.pool_seed)
+    store = None
+    if args.store:
+        store = enroll_store.Store(args.store, 'rwc', wal=True)
+    cache_bytes = args.cache_max * 1024 * 1024
+    if args.shard_digits and store is None:
+        db = ShardedDB(args.repo, shards.check_digits(args.shard_digits),
+                       cache_bytes=cache_bytes, pool=pool)
+        if args.lock:
+            db.start_group_commit(args.lock, args.commit_window / 1000,
+                                  args.commit_max, stage_seconds)
+    else:
+        db = EnrollDB(args.repo, cache_bytes=cache_bytes, pool=pool, store=store)
+        if args.lock:
+            db.committer = group_commit.GroupCommitter(db, args.lock,
+                                                       args.commit_window / 1000,
+                                                       args.commit_max,
+                                                       stage_seconds)
+    metrics.open()
+    if pool is not None:
+        pool.start()
+    server = Server(args.socket, db, allowed)
+    print(f"Listening on {args.socket}", file=sys.stderr)
+    server.serve_forever()
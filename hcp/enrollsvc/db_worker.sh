@@ -0,0 +1,36 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+# See db_worker.py. Only the flask app's account may connect. Writes are
+# gathered for up to HCP_RUN_ENROLL_COMMIT_WINDOW milliseconds, or until
+# HCP_RUN_ENROLL_COMMIT_MAX of them are waiting, and made in a single commit.
+# Up to HCP_RUN_ENROLL_CACHE_MAX MiB of query/find results are cached.
+# Pre-generated secrets are kept for the genprogs in HCP_RUN_ENROLL_POOL, each
+# pool being refilled to HCP_RUN_ENROLL_POOL_HIGH entries (0 for no pools)
+# whenever it has fewer than HCP_RUN_ENROLL_POOL_LOW. With
+# HCP_RUN_ENROLL_STORE=sqlite, the enrollments are in STORE_PATH. If the repo
+# is sharded, each shard has a group commit (and lock) of its own.
+store_args=()
+using_store && store_args=(--store $STORE_PATH)
+pool_args=()
+for genprog in ${HCP_RUN_ENROLL_POOL:=genrootfskey}; do
+	pool_args+=(--pool "$genprog")
+done
+exec python3 /hcp/enrollsvc/db_worker.py \
+	--socket $DB_SOCKET \
+	--repo $REPO_PATH \
+	--allow-user $FLASK_USER \
+	--lock $REPO_LOCKPATH \
+	"${store_args[@]}" \
+	--shard-digits $SHARD_DIGITS \
+	--commit-window ${HCP_RUN_ENROLL_COMMIT_WINDOW:=20} \
+	--commit-max ${HCP_RUN_ENROLL_COMMIT_MAX:=64} \
+	--cache-max ${HCP_RUN_ENROLL_CACHE_MAX:=64} \
+	"${pool_args[@]}" \
+	--pool-dir $POOL_PATH \
+	--pool-key $POOL_KEY \
+	--pool-low ${HCP_RUN_ENROLL_POOL_LOW:=16} \
+	--pool-high ${HCP_RUN_ENROLL_POOL_HIGH:=64}
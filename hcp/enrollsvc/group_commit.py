@@ -0,0 +1,206 @@
+# Group commit for the enrollment database, used by db_worker.py.
+#
+# Every add or delete done by the op_<verb>.sh scripts takes the repo lock,
+# then does its own "git add" and "git commit" (each of which restats the whole
+# working tree), so concurrent writers queue up on the lock and throughput
+# flattens out early. Here, instead, writes from the worker's threads are
+# queued, and a single committer thread;
+# - waits for the first write to have been queued for 'window' seconds, or for
+#   'max_ops' writes to be queued, whichever comes first,
+# - takes the repo lock, applies all of those writes to the working tree in the
+#   order they were queued, updates hn2ek once, and makes a single commit,
+# - only then (once the commit is on disk) tells each writer how it went.
+#
+# Each write succeeds or fails on its own (e.g. enrolling a TPM that is already
+# enrolled fails that add, not the group), but if the commit itself fails then
+# the repo is rolled back (as in op_add.sh) and every write in the group fails.
+#
+# For adds, the asset generation (attest-enroll) happens in the writer's thread
+# before it is queued, see db_worker.py, so it is done in parallel and without
+# the lock.
+#
+# If given the DB worker's stage histogram, the committer records how long each
+# write waited to be committed, how long the lock took to get, and how long the
+# git commit took.
+#
+# With a single-file store (see sbin/enroll_store.py), a group is a single
+# transaction on the store instead, and there's no repo lock to take, hn2ek to
+# update, nor working tree to roll back; a failed transaction changes nothing.
+
+import os
+import shutil
+import threading
+import time
+
+import add_batch
+import hn2ek
+
+class Write:
+    def __init__(self):
+        self.done = threading.Event()
+        self.returncode = 1
+        self.result = None
+
+# Enroll an entry that has already been generated (see add_batch.generate)
+class Add(Write):
+    def __init__(self, entry):
+        super().__init__()
+        self.entry = entry
+
+    def apply(self, db, hn2ek_changes):
+        if not add_batch.install_entry(db.repo_path, self.entry):
+            return False
+        hn2ek_changes[f"{self.entry.hostname[::-1]} {self.entry.ekpubhash[0:32]}"] = True
+        self.returncode = 0
+        return True
+
+    def apply_store(self, w):
+        if not w.put_dir(self.entry.ekpubhash, self.entry.hostname, self.entry.outdir):
+            self.entry.error = "already enrolled"
+            return False
+        self.returncode = 0
+        return True
+
+# Delete the entries matching an ekpubhash prefix, the result being the same
+# JSON that op_delete.sh outputs
+class Delete(Write):
+    def __init__(self, ekpubhash):
+        super().__init__()
+        self.ekpubhash = ekpubhash
+
+    def apply(self, db, hn2ek_changes):
+        entries = []
+        for path in db.ply_dirs(self.ekpubhash):
+            e = db.entry(path)
+            shutil.rmtree(path)
+            hn2ek_changes[f"{e['hostname'][::-1]} {os.path.basename(path)}"] = False
+            entries.append(e)
+        self.result = { 'entries': entries }
+        self.returncode = 0
+        return len(entries) > 0
+
+    def apply_store(self, w):
+        self.result = { 'entries': w.delete(self.ekpubhash) }
+        self.returncode = 0
+        return len(self.result['entries']) > 0
+
+class GroupCommitter:
+    def __init__(self, db, lock_path, window, max_ops, stage_seconds=None):
+        self.db = db
+        self.stage_seconds = stage_seconds
+        self.lock_path = lock_path
+        self.window = window
+        self.max_ops = max_ops
+        self.queue = []
+        self.cond = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Queue a write, and wait for the commit it ends up in
+    def submit(self, write):
+        write.queued = time.monotonic()
+        with self.cond:
+            self.queue.append(write)
+            self.cond.notify()
+        write.done.wait()
+        return write.returncode, write.result
+
+    def next_group(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            deadline = self.queue[0].queued + self.window
+            while len(self.queue) < self.max_ops:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            group = self.queue[:self.max_ops]
+            del self.queue[:self.max_ops]
+            return group
+
+    def observe(self, stage, seconds):
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(seconds, stage)
+
+    # commit() handles the failures it expects; anything else fails the
+    # group rather than the thread, which would leave every later submit()
+    # waiting forever
+    def run(self):
+        while True:
+            group = self.next_group()
+            try:
+                now = time.monotonic()
+                for write in group:
+                    self.observe('commit_queue', now - write.queued)
+                self.commit(group)
+            except Exception as e:
+                self.fail(group, f"Error, unable to commit ({e!r})")
+            # whether it was committed or rolled back, the working tree
+            # has changed underneath any cached results
+            self.db.cache.clear()
+            for write in group:
+                write.done.set()
+
+    def fail(self, group, error):
+        for write in group:
+            write.returncode = 1
+            write.result = None
+        add_batch.log(error)
+
+    def commit_store(self, group):
+        start = time.monotonic()
+        try:
+            changed = 0
+            with self.db.store.write() as w:
+                for write in group:
+                    if write.apply_store(w):
+                        changed += 1
+        except Exception as e:
+            self.fail(group, f"Failure ({e!r}), nothing was committed")
+            return
+        self.observe('store_commit', time.monotonic() - start)
+        if changed:
+            add_batch.log(f"Committed {changed} of {len(group)} writes")
+
+    def commit(self, group):
+        if self.db.store is not None:
+            self.commit_store(group)
+            return
+        repo_path = self.db.repo_path
+        lock = add_batch.RepoLock(self.lock_path)
+        start = time.monotonic()
+        try:
+            lock.acquire()
+        except Exception:
+            self.fail(group, "Error, failed to lock repo")
+            return
+        self.observe('lock_wait', time.monotonic() - start)
+        try:
+            # The net effect of the group on hn2ek, by entry; True to
+            # add it, False to remove it.
+            hn2ek_changes = {}
+            changed = 0
+            for write in group:
+                if write.apply(self.db, hn2ek_changes):
+                    changed += 1
+            if changed:
+                table = hn2ek.Hn2ek(repo_path)
+                table.add_many(e.split(' ') for e, add in hn2ek_changes.items() if add)
+                table.remove(e for e, add in hn2ek_changes.items() if not add)
+                start = time.monotonic()
+                add_batch.commit(repo_path, f"group commit of {changed} writes")
+                self.observe('git_commit', time.monotonic() - start)
+                add_batch.log(f"Committed {changed} of {len(group)} writes")
+        except Exception as e:
+            self.fail(group, f"Failure ({e!r}), attempting recovery")
+            try:
+                add_batch.rollback(repo_path)
+            except Exception:
+                add_batch.log("Error, recovery failed, leaving the repo locked")
+                lock.abandon()
+                return
+        # (the writes are committed, or failed, whatever happens here)
+        try:
+            lock.release()
+        except OSError as e:
+            add_batch.log(f"Error, failed to unlock repo ({e!r})")
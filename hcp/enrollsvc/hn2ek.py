@@ -0,0 +1,242 @@
+# The reverse-lookup (hostname to ekpubhash) table of the enrollment database.
+#
+# Each entry is a line of the form;
+#    <reversed hostname> <ekpubhash, truncated to 32 characters>
+# so that a hostname-suffix search becomes a prefix search on the sorted
+# table. This used to be a single flat file ("hn2ek") that was re-sorted in its
+# entirety on every add, filtered in its entirety on every delete, and scanned
+# line by line on every find.
+#
+# Instead, the table is now split into sorted chunk files in the "hn2ek.d"
+# directory, each of no more than CHUNK_MAX lines, along with a sorted
+# manifest ("hn2ek.d/chunks") of the chunks and the lowest entry that each of
+# them may hold. Finding the chunk for an entry, or the first chunk for a
+# prefix, is a binary search of the manifest, and within a chunk it's a binary
+# search of its lines. An add or delete rewrites one chunk (and the manifest,
+# only if a chunk is split or emptied), which also keeps the git commits (and
+# therefore the replication to attestsvc) proportionate to the change.
+#
+# Writers must hold the repo lock (repo_cmd_lock). Readers need no lock; every
+# file is replaced atomically, and the order in which a split is written means
+# a concurrent reader might see an entry twice (which find() suppresses) but
+# never miss one.
+#
+# This file is used as a module (by db_worker.py) and as a command (by the
+# op_<verb>.sh scripts), see the bottom of this file.
+
+import bisect
+import heapq
+import os
+import sys
+
+HN2EK_FLAT = 'hn2ek'
+HN2EK_DIR = 'hn2ek.d'
+MANIFEST = 'chunks'
+
+# Largest number of entries in a chunk before it is split in two
+CHUNK_MAX = 512
+
+def write_atomic(path, lines):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(l + '\n' for l in lines)
+    os.rename(tmp, path)
+
+def read_lines(path):
+    with open(path) as f:
+        return [ l.rstrip('\n') for l in f if l.strip() ]
+
+class Hn2ek:
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.flat_path = os.path.join(repo_path, HN2EK_FLAT)
+        self.dir = os.path.join(repo_path, HN2EK_DIR)
+        self.manifest_path = os.path.join(self.dir, MANIFEST)
+
+    # The manifest is a list of (lowest entry, chunk name), sorted. The
+    # first chunk's lowest entry is always the empty string.
+    def manifest(self):
+        chunks = []
+        for line in read_lines(self.manifest_path):
+            name, _, low = line.partition(' ')
+            chunks.append((low, name))
+        return chunks
+
+    def write_manifest(self, chunks):
+        write_atomic(self.manifest_path, [ f"{name} {low}" for low, name in chunks ])
+
+    def chunk_path(self, name):
+        return os.path.join(self.dir, name)
+
+    def chunk(self, name):
+        try:
+            return read_lines(self.chunk_path(name))
+        except FileNotFoundError:
+            return []
+
+    # Index (in the manifest) of the chunk that holds, or would hold, entry
+    def locate(self, chunks, entry):
+        return max(bisect.bisect_right([ low for low, _ in chunks ], entry) - 1, 0)
+
+    def new_chunk_name(self, used):
+        n = len(used)
+        while f"c{n}" in used or os.path.exists(self.chunk_path(f"c{n}")):
+            n += 1
+        used.add(f"c{n}")
+        return f"c{n}"
+
+    # Convert from the flat file, if that is what the repo still has. The
+    # caller is expected to "git add -A" the result.
+    def migrate(self):
+        if os.path.exists(self.manifest_path):
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        entries = []
+        if os.path.exists(self.flat_path):
+            entries = sorted(set(read_lines(self.flat_path)))
+        chunks = []
+        for i in range(0, max(len(entries), 1), CHUNK_MAX // 2):
+            part = entries[i:i + CHUNK_MAX // 2]
+            name = f"c{len(chunks)}"
+            write_atomic(self.chunk_path(name), part)
+            chunks.append(('' if i == 0 else part[0], name))
+        self.write_manifest(chunks)
+        if os.path.exists(self.flat_path):
+            os.unlink(self.flat_path)
+
+    def add(self, revhn, ekpubhash):
+        self.add_many([ (revhn, ekpubhash) ])
+
+    # Add many (revhn, ekpubhash) pairs at once, rewriting each affected
+    # chunk once, and the manifest at most once.
+    def add_many(self, pairs):
+        self.migrate()
+        chunks = self.manifest()
+        by_chunk = {}
+        for revhn, ekpubhash in pairs:
+            entry = f"{revhn} {ekpubhash}"
+            by_chunk.setdefault(self.locate(chunks, entry), set()).add(entry)
+        used = { name for _, name in chunks }
+        splits = {}
+        for i, new in by_chunk.items():
+            low, name = chunks[i]
+            old = self.chunk(name)
+            lines = sorted(set(old) | new)
+            if len(lines) == len(old):
+                continue
+            if len(lines) <= CHUNK_MAX:
+                write_atomic(self.chunk_path(name), lines)
+                continue
+            # Split into (roughly) half-full pieces; the first stays in
+            # this chunk, the rest go to new chunks.
+            n = len(lines) // (CHUNK_MAX // 2)
+            bounds = [ (k * len(lines)) // n for k in range(n + 1) ]
+            pieces = [ lines[bounds[k]:bounds[k + 1]] for k in range(n) ]
+            splits[i] = [ (piece[0], self.new_chunk_name(used), piece)
+                          for piece in pieces[1:] ]
+            splits[i].insert(0, (low, name, pieces[0]))
+            for _, new_name, piece in splits[i][1:]:
+                write_atomic(self.chunk_path(new_name), piece)
+        if not splits:
+            return
+        # The new chunks are written, now make them reachable via the
+        # manifest, and only then drop their entries from the chunks they
+        # were split from.
+        manifest = []
+        for i, chunk in enumerate(chunks):
+            if i in splits:
+                manifest += [ (low, name) for low, name, _ in splits[i] ]
+            else:
+                manifest.append(chunk)
+        self.write_manifest(manifest)
+        for pieces in splits.values():
+            _, name, piece = pieces[0]
+            write_atomic(self.chunk_path(name), piece)
+
+    # Remove entries (an iterable of "revhn ekpubhash" strings), returning
+    # the number removed.
+    def remove(self, entries):
+        self.migrate()
+        chunks = self.manifest()
+        by_chunk = {}
+        for entry in entries:
+            by_chunk.setdefault(self.locate(chunks, entry), set()).add(entry)
+        removed = 0
+        emptied = set()
+        for i, gone in by_chunk.items():
+            name = chunks[i][1]
+            lines = self.chunk(name)
+            kept = [ l for l in lines if l not in gone ]
+            removed += len(lines) - len(kept)
+            if len(kept) == len(lines):
+                continue
+            if len(kept) == 0 and i != 0:
+                emptied.add(i)
+            else:
+                write_atomic(self.chunk_path(name), kept)
+        if emptied:
+            self.write_manifest([ c for i, c in enumerate(chunks) if i not in emptied ])
+            for i in emptied:
+                os.unlink(self.chunk_path(chunks[i][1]))
+        return removed
+
+    # Entries whose reversed hostname starts with revprefix, in order
+    def scan(self, revprefix):
+        if not os.path.exists(self.manifest_path):
+            # not yet migrated
+            for line in read_lines(self.flat_path):
+                if line.startswith(revprefix):
+                    yield line
+            return
+        chunks = self.manifest()
+        seen = set()
+        for low, name in chunks[self.locate(chunks, revprefix):]:
+            if low > revprefix and not low.startswith(revprefix):
+                break
+            lines = self.chunk(name)
+            for line in lines[bisect.bisect_left(lines, revprefix):]:
+                if not line.startswith(revprefix):
+                    break
+                if line not in seen:
+                    seen.add(line)
+                    yield line
+
+    # The ekpubhashes of hosts whose name ends with hostname_suffix
+    def find(self, hostname_suffix):
+        return [ line.split(' ', 1)[1] for line in self.scan(hostname_suffix[::-1]) ]
+
+# The same, across the tables of the shards of a database (see shards.py), in
+# the order they would be in if they were one table
+def find_many(repo_paths, hostname_suffix):
+    revprefix = hostname_suffix[::-1]
+    scans = [ Hn2ek(path).scan(revprefix) for path in repo_paths ]
+    return [ line.split(' ', 1)[1] for line in heapq.merge(*scans) ]
+
+# The command-line interface used by the op_<verb>.sh scripts;
+#    hn2ek.py <repo> add <reversed hostname> <ekpubhash>
+#    hn2ek.py <repo> add		(entries to add on stdin)
+#    hn2ek.py <repo> remove		(entries to remove on stdin)
+#    hn2ek.py <repo> find <hostname suffix> [<repo>...]	(ekpubhashes on stdout,
+#					from the shards given, if any)
+#    hn2ek.py <repo> migrate
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 2:
+        print("Usage: hn2ek.py <repo> add|remove|find|migrate [args]", file=sys.stderr)
+        sys.exit(1)
+    table = Hn2ek(args[0])
+    cmd = args[1]
+    if cmd == 'add' and len(args) == 4:
+        table.add(args[2], args[3])
+    elif cmd == 'add' and len(args) == 2:
+        table.add_many(l.split() for l in sys.stdin if l.strip())
+    elif cmd == 'remove' and len(args) == 2:
+        table.remove(l.strip() for l in sys.stdin if l.strip())
+    elif cmd == 'find' and len(args) >= 3:
+        for ekpubhash in find_many([ args[0] ] + args[3:], args[2]):
+            print(ekpubhash)
+    elif cmd == 'migrate' and len(args) == 2:
+        table.migrate()
+    else:
+        print("Error, bad arguments", file=sys.stderr)
+        sys.exit(1)
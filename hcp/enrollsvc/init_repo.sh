@@ -6,16 +6,35 @@ expect_db_user
 
 cd $HCP_ENROLLSVC_STATE_PREFIX
 echo "$HCP_VER" > version
+echo "$SHARD_DIGITS" > $SHARD_DIGITS_PATH
 
-mkdir $REPO_PATH
-cd $REPO_PATH
-git init
-echo "$HCP_VER" > version
-touch .git/git-daemon-export-ok
-touch $HN2EK_PATH
-mkdir $EK_BASENAME
-touch $EK_BASENAME/do_not_remove
-cp /hcp/enrollsvc/common_defs.sh .
-git add .
-git commit -m "Initial commit"
-git log
+# Usage: init_repo <path>
+function init_repo {
+	mkdir $1
+	cd $1
+	git init
+	echo "$HCP_VER" > version
+	touch .git/git-daemon-export-ok
+	REPO_PATH=$1 hn2ek migrate
+	mkdir $EK_BASENAME
+	touch $EK_BASENAME/do_not_remove
+	cp /hcp/enrollsvc/common_defs.sh .
+	git add .
+	git commit -m "Initial commit"
+	git log
+}
+
+init_repo $REPO_PATH
+
+# Each shard is a repo of the same form (see shards.py)
+if sharded; then
+	for prefix in `shard_prefixes`; do
+		init_repo `shard_repo $prefix`
+	done
+fi
+
+# The store is made here, rather than by its first writer, so that the
+# replication service (which only reads it) can start first.
+if using_store; then
+	enroll_store create
+fi
@@ -2,6 +2,8 @@ import flask
 from flask import request, abort
 import subprocess
 import json
+import base64
+import socket
 import os, sys
 from stat import *
 from markupsafe import escape
@@ -67,6 +69,39 @@ def home():
 # and arguments follow this, and are appended by each handler.
 sudoargs=['sudo','-u',os.environ.get('DB_USER')]
 
+# Rather than sudo, the handlers normally talk to db_worker.py, which runs as
+# $DB_USER and applies the same argument-validation to requests received over
+# a Unix socket (and only accepts connections from $FLASK_USER). This avoids
+# the cost of sudo, bash, and the op_<verb>.sh preambles for every request. If
+# the worker isn't running, we fall back to sudo.
+db_socket = os.environ.get('DB_SOCKET')
+
+def db_worker_available():
+    return db_socket is not None and os.path.exists(db_socket)
+
+# Send a request to the worker, and return a 2-tuple of the returncode and the
+# result (the JSON that the op_<verb>.sh script would have output).
+def db_request(req):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(db_socket)
+        s.sendall(json.dumps(req).encode() + b'\n')
+        resp = json.loads(s.makefile('rb').readline())
+    return resp['returncode'], resp.get('result')
+
+# Run /hcp/enrollsvc/op_<op>.sh with a single argument (named 'field' in the
+# request to the worker), one way or the other
+def db_op(op, field, arg):
+    if db_worker_available():
+        rc, j = db_request({ 'op': op, field: arg })
+        if rc != 0:
+            abort(500)
+        return j
+    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_' + op + '.sh', arg],
+                       stdout=subprocess.PIPE, text=True)
+    if (c.returncode != 0):
+        abort(500)
+    return json.loads(c.stdout)
+
 @app.route('/v1/add', methods=['POST'])
 def my_add():
     if 'ekpub' not in request.files:
@@ -75,6 +110,12 @@ def my_add():
         return { "error": "hostname not in request" }
     f = request.files['ekpub']
     h = request.form['hostname']
+    if db_worker_available():
+        rc, _ = db_request({ 'op': 'add', 'hostname': h,
+                             'ekpub': base64.b64encode(f.read()).decode() })
+        return {
+            "returncode": rc
+        }
     # Create a temporary directory (for the ek.pub file), and make it world
     # readable+executable. The /hcp/enrollsvc/op_add.sh script runs behind
     # sudo, as another user, and it needs to be able to read the ek.pub.
@@ -91,37 +132,160 @@ def my_add():
         "returncode": c.returncode
     }
 
+# Enroll many {ekpub,hostname} 2-tuples at once. The request carries repeated
+# 'ekpub' files and 'hostname' fields, paired up in the order given. The
+# response has a result for each entry (see add_batch.py).
+@app.route('/v1/add_batch', methods=['POST'])
+def my_add_batch():
+    fs = request.files.getlist('ekpub')
+    hs = request.form.getlist('hostname')
+    if len(fs) == 0:
+        return { "error": "ekpub not in request" }
+    if len(fs) != len(hs):
+        return { "error": "ekpub and hostname counts differ" }
+    # (The hostnames are properly validated by add_batch.py, but they mustn't
+    # be able to break the manifest's lines.)
+    if any(h != ''.join(h.split()) for h in hs):
+        return { "error": "malformed hostname" }
+    if db_worker_available():
+        rc, j = db_request({ 'op': 'add_batch', 'entries': [
+            { 'ekpub': base64.b64encode(f.read()).decode(), 'hostname': h }
+            for f, h in zip(fs, hs) ] })
+        if j is None:
+            return { "returncode": rc }
+        return j
+    # As for /v1/add, but with all the ek.pub files (and a manifest listing
+    # them with their hostnames) in the one temporary directory.
+    tf = tempfile.TemporaryDirectory()
+    s = os.stat(tf.name)
+    os.chmod(tf.name, s.st_mode | S_IROTH | S_IXOTH)
+    m = os.path.join(tf.name, 'manifest')
+    with open(m, 'w') as manifest:
+        for i, (f, h) in enumerate(zip(fs, hs)):
+            p = os.path.join(tf.name, f"{i}.pub")
+            f.save(p)
+            manifest.write(f"{p} {h}\n")
+    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_add_batch.sh', m],
+                       stdout=subprocess.PIPE, text=True)
+    try:
+        return json.loads(c.stdout)
+    except ValueError:
+        return { "returncode": c.returncode }
+
+# Paginated queries. If the query has a 'limit' and/or a 'cursor', the result
+# is NDJSON rather than a single JSON document; a line per entry (in ekpubhash
+# order, and no more than 'limit' of them), followed by a line of the form;
+#    { "cursor": "<opaque string>" }
+# The cursor is null on the last page, otherwise it is passed back (along with
+# the same ekpubhash prefix) to get the next page. The entries are streamed as
+# they are read from the worker, a bounded page (QUERY_PAGE entries) at a
+# time, so neither end need hold the whole result.
+QUERY_PAGE = 1000
+
+# The cursor is the name of the last per-TPM directory of the page (the first
+# 32 hex characters of its ekpubhash), but clients needn't know that.
+def encode_cursor(after):
+    return base64.urlsafe_b64encode(bytes.fromhex(after)).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    if cursor == '':
+        return ''
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except ValueError:
+        return None
+    if len(raw) != 16:
+        return None
+    return raw.hex()
+
+def query_stream(h, limit, after):
+    while limit > 0:
+        rc, page = db_request({ 'op': 'query_page', 'ekpubhash': h,
+                                'limit': min(limit, QUERY_PAGE), 'after': after })
+        if rc != 0:
+            yield json.dumps({ "error": "query failed" }) + '\n'
+            return
+        for e in page['entries']:
+            yield json.dumps(e) + '\n'
+        limit -= len(page['entries'])
+        after = page['cursor']
+        if after is None:
+            break
+    yield json.dumps({ "cursor": encode_cursor(after) if after else None }) + '\n'
+
+# Without the worker, op_query.sh can only give us everything at once, so we
+# paginate that.
+def query_slice(j, limit, after):
+    entries = sorted((e for e in j['entries'] if e['ekpubhash'][0:32] > after),
+                     key=lambda e: e['ekpubhash'])
+    for e in entries[0:limit]:
+        yield json.dumps(e) + '\n'
+    cursor = None
+    if len(entries) > limit:
+        cursor = encode_cursor(entries[limit - 1]['ekpubhash'][0:32])
+    yield json.dumps({ "cursor": cursor }) + '\n'
+
 @app.route('/v1/query', methods=['GET'])
 def my_query():
     if 'ekpubhash' not in request.args:
         return { "error": "ekpubhash not in request" }
     h = request.args['ekpubhash']
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_query.sh', h],
-                       stdout=subprocess.PIPE, text=True)
-    if (c.returncode != 0):
-        abort(500)
-    j = json.loads(c.stdout)
-    return j
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        return db_op('query', 'ekpubhash', h)
+    try:
+        limit = int(request.args.get('limit', QUERY_PAGE))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return { "error": "malformed limit" }
+    after = decode_cursor(request.args.get('cursor', ''))
+    if after is None:
+        return { "error": "malformed cursor" }
+    if db_worker_available():
+        lines = query_stream(h, limit, after)
+    else:
+        lines = query_slice(db_op('query', 'ekpubhash', h), limit, after)
+    return flask.Response(lines, mimetype='application/x-ndjson')
 
 @app.route('/v1/delete', methods=['POST'])
 def my_delete():
     h = request.form['ekpubhash']
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_delete.sh', h],
-                       stdout=subprocess.PIPE, text=True)
-    if (c.returncode != 0):
-        abort(500)
-    j = json.loads(c.stdout)
-    return j
+    if db_worker_available():
+        # A sharded delete that fails part way says what it did delete
+        rc, j = db_request({ 'op': 'delete', 'ekpubhash': h })
+        if rc != 0:
+            if j is None:
+                abort(500)
+            return dict(j, returncode=rc), 500
+        return j
+    return db_op('delete', 'ekpubhash', h)
 
 @app.route('/v1/find', methods=['GET'])
 def my_find():
     h = request.args['hostname_suffix']
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_find.sh', h],
-                       stdout=subprocess.PIPE, text=True)
-    if (c.returncode != 0):
+    return db_op('find', 'hostname_suffix', h)
+
+# The DB worker's statistics, e.g. the hit and miss counts of its cache of
+# query and find results
+@app.route('/v1/stats', methods=['GET'])
+def my_stats():
+    if not db_worker_available():
+        return { "error": "no DB worker" }
+    rc, j = db_request({ 'op': 'stats' })
+    if rc != 0:
         abort(500)
-    j = json.loads(c.stdout)
     return j
 
+# The DB worker's metrics in the Prometheus text format; the time taken by each
+# op, and by attest-enroll, the repo lock and the git commit within them
+@app.route('/metrics', methods=['GET'])
+def my_metrics():
+    if not db_worker_available():
+        abort(404)
+    rc, text = db_request({ 'op': 'metrics' })
+    if rc != 0:
+        abort(500)
+    return flask.Response(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == "__main__":
     app.run()
@@ -47,6 +47,20 @@ ls -l $EPHEMERAL_ENROLL
 EKPUBHASH="$(sha256sum "$EPHEMERAL_ENROLL/ek.pub" | cut -f1 -d' ')"
 HALFHASH=`echo $EKPUBHASH | cut -c 1-16`
 
+# With the single-file store, the enrolled attributes go into it (in one
+# transaction, with the ekpubhash file added as below) and that's that; there's
+# no lock to take, nor anything to roll back.
+if using_store; then
+	enroll_store add "$EKPUBHASH" "$2" $EPHEMERAL_ENROLL ||
+		(echo "Error, failed to add to the store" && exit 1) || exit 1
+	rm -rf $EPHEMERAL_ENROLL
+	echo "installed in \"$STORE_PATH\""
+	exit 0
+fi
+
+# If the repo is sharded, it's the shard (and the lock) for this ekpubhash
+use_shard "$EKPUBHASH"
+
 cd $REPO_PATH
 
 # The following code is the critical section, so surround it with lock/unlock.
@@ -63,17 +77,14 @@ ply_path_add "$EKPUBHASH" || itfailed=1
 	(echo "Error, TPM is already enrolled" && exit 1) || itfailed=1
 [[ -z "$itfailed" ]] && mkdir -p $FPATH || itfailed=1
 
-# Combine the existing hn2ek with the new entry, sort the result, and put in
-# hn2ek.tmp (it will replace the existing one iff other steps succeed).
-[[ -z "$itfailed" ]] &&
-	(echo "$HNREV `basename $FPATH`" | cat - $HN2EK_PATH | sort > $HN2EK_PATH.tmp) || itfailed=1
-
-# Add the enrolled attributes to the DB, update hn2ek, and git add+commit.
+# Add the enrolled attributes to the DB, insert the new entry into the hn2ek
+# table (this only rewrites the one chunk the entry sorts into), and git
+# add+commit. If any of this fails, the rollback below restores the table.
 [[ -z "$itfailed" ]] &&
 	(echo "$EKPUBHASH" > "$FPATH/ekpubhash" &&
 		cp -a $EPHEMERAL_ENROLL/* "$FPATH/" &&
-		mv $HN2EK_PATH.tmp $HN2EK_PATH &&
-		git add . &&
+		hn2ek add "$HNREV" `basename $FPATH` &&
+		git add -A . &&
 		git commit -m "map $HALFHASH to $2") || itfailed=1
 # TODO:
 # 1. This exception/error/rollback path (necessarily before releasing the lock)
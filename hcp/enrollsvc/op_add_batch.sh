@@ -0,0 +1,31 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+echo "Starting $0" >&2
+echo "  - Param1=$1 (path to manifest of '<ekpub path> <hostname>' lines)" >&2
+
+if [[ -z $1 || ! -f $1 ]]; then
+	echo "Error, missing manifest" >&2
+	exit 1
+fi
+
+# See add_batch.py. The attest-enroll runs happen in parallel, outside the lock,
+# then all of the entries are committed at once, under the lock. The JSON
+# results (per entry) go to stdout, everything else to stderr. New entries take
+# what secrets they can from the pools that db_worker.py keeps. With the
+# single-file store, they go into that instead. If the repo is sharded, each
+# shard's entries are committed under that shard's lock.
+store_args=()
+using_store && store_args=(--store $STORE_PATH)
+exec python3 /hcp/enrollsvc/add_batch.py \
+	--repo $REPO_PATH \
+	--lock $REPO_LOCKPATH \
+	"${store_args[@]}" \
+	--shard-digits $SHARD_DIGITS \
+	--pool-dir $POOL_PATH \
+	--pool-key $POOL_KEY \
+	--jobs ${HCP_ENROLLSVC_BATCH_JOBS:-`nproc`} \
+	"$1"
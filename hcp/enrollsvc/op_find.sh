@@ -9,6 +9,12 @@ echo "  - Param1=$1 (hostname_suffix)" >&2
 
 check_hostname_suffix "$1"
 
+# The single-file store produces the same JSON (see below)
+if using_store; then
+	enroll_store find "$1"
+	exit $?
+fi
+
 cd $REPO_PATH
 
 # The JSON output should look like;
@@ -28,26 +34,29 @@ echo "  \"hostname_suffix\": \"$1\","
 echo "  \"ekpubhashes\": ["
 
 # The table is indexed by _reversed_ hostname, so that our hostname_suffix
-# search becomes a prefix search on the table.
-revsuffix=`echo $1 | rev`
-
-# The reverse lookup table file is replaced atomically by the add/delete logic,
-# so when we pipe it into our filter loop below, it will remain unmodified
-# throughout the loop, even if the underlying file has been unlinked from the
-# file system and replaced. I.e. we don't need to copy nor lock.
+# search becomes a prefix search on the table, which hn2ek.py does by binary
+# search on the sorted chunks of the table.
+#
+# The table files are replaced atomically by the add/delete logic, so we don't
+# need to copy nor lock.
 
 # TODO: we should use 'jq' to produce the JSON, not 'echo'.
 
-# Filter the lookup table, line by line, through a prefix comparison
-(while IFS=" " read -r revhn ekpubhash
+# If the repo is sharded, the shards' tables are searched together.
+SHARD_REPOS=()
+if sharded; then
+	for prefix in `shard_prefixes`; do
+		SHARD_REPOS+=(`shard_repo $prefix`)
+	done
+fi
+
+(hn2ek find "$1" "${SHARD_REPOS[@]}" | while read -r ekpubhash
 do
-	if [[ $revhn == $revsuffix* ]]; then
-		[[ -n $NEEDCOMMA ]] && echo "    ,"
-		echo "    \"$ekpubhash\""
-		NEEDCOMMA=1
-	fi
-done < $HN2EK_PATH) ||
-	(echo "Error, the filter loop failed" >&2 && exit 1) || exit 1
+	[[ -n $NEEDCOMMA ]] && echo "    ,"
+	echo "    \"$ekpubhash\""
+	NEEDCOMMA=1
+done; exit ${PIPESTATUS[0]}) ||
+	(echo "Error, the hn2ek lookup failed" >&2 && exit 1) || exit 1
 
 echo "  ]"
 echo "}"
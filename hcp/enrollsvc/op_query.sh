@@ -12,6 +12,41 @@ echo "  - Param1=$1 (ekpubhash)" >&2
 
 check_ekpubhash_prefix "$1"
 
+# The single-file store produces the same JSON (see below), and does the
+# deletion in a single transaction.
+if using_store; then
+	if [[ -n $QUERY_PLEASE_ALSO_DELETE ]]; then
+		enroll_store delete "$1"
+	else
+		enroll_store query "$1"
+	fi
+	exit $?
+fi
+
+# If the repo is sharded, we run ourselves for each of the shards that can have
+# matching entries, in parallel, with ENROLL_SHARD set to the shard's prefix,
+# and put their entries together in shard (which is ekpubhash) order. Each of
+# them takes its own shard's lock, so a delete across shards is made of one
+# commit (or rollback) per shard.
+if sharded && [[ -z $ENROLL_SHARD ]]; then
+	SHARD_OUT=`mktemp -d`
+	pids=()
+	for prefix in `shard_prefixes "$1"`; do
+		ENROLL_SHARD=$prefix /hcp/enrollsvc/op_query.sh "$1" > $SHARD_OUT/$prefix &
+		pids+=($!)
+	done
+	for pid in "${pids[@]}"; do
+		wait $pid || itfailed=1
+	done
+	[[ -z $itfailed ]] && jq -n '{entries: [inputs.entries[]]}' $SHARD_OUT/* ||
+		itfailed=1
+	rm -rf $SHARD_OUT
+	[[ -n $itfailed ]] && exit 1
+	exit 0
+fi
+check_ekpubhash_prefix "$ENROLL_SHARD"
+use_shard "$ENROLL_SHARD"
+
 cd $REPO_PATH
 
 ply_path_get "$1"
@@ -44,9 +79,6 @@ ply_path_get "$1"
 
 repo_cmd_lock || (echo "Error, failed to lock repo" >&2 && exit 1) || exit 1
 
-# TODO: as noted in common.sh, the hn2ek implementation is crude and won't
-# have fantastic scalability.
-
 # If we're deleting, we build up a filter list of "rev(hostname) ekpubhash"
 # strings as we remove the corresponding directories. At the conclusion, we
 # filter this list out of the hn2ek (reverse-lookup) table.
@@ -84,19 +116,20 @@ done
 ) | jq -n '{entries: [inputs]}' || itfailed=1
 
 # If we haven't yet failed, and we're deleting, and we saw at least one entry
-# to be deleted, then filter the deleted entries out of the hn2ek table.
+# to be deleted, then remove the deleted entries from the hn2ek table (which
+# only rewrites the chunks they were in).
 [[ -s $HN2EK_PATH.filter ]] && ATLEAST1=1
 if [[ -z $itfailed ]] && [[ -n $QUERY_PLEASE_ALSO_DELETE ]] && [[ -n $ATLEAST1 ]]; then
-	(grep -F -v -f $HN2EK_PATH.filter $HN2EK_PATH > $HN2EK_PATH.new || /bin/true) &&
-	mv $HN2EK_PATH.new $HN2EK_PATH &&
+	hn2ek remove < $HN2EK_PATH.filter &&
 	rm $HN2EK_PATH.filter ||
 	(echo "Error, hn2ek filtering failed" >&2 && exit 1) || itfailed=1
 fi
 
 # Same criteria again. We add the hn2ek table to the list of modifications to
-# commit and make the commit
+# commit (with -A, as chunks can disappear, as does the old flat file on the
+# first change after an upgrade) and make the commit
 if [[ -z $itfailed ]] && [[ -n $QUERY_PLEASE_ALSO_DELETE ]] && [[ -n $ATLEAST1 ]]; then
-	git add $HN2EK_PATH >&2 &&
+	git add -A . >&2 &&
 	git commit -m "delete $1" >&2 ||
 	(echo "Error, commiting failed" >&2 && exit 1) || itfailed=1
 fi
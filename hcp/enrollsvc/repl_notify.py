@@ -0,0 +1,175 @@
+# Change notification for replicas of the enrollment database, run (as
+# DB_USER) alongside git-daemon in the enrollsvc-repl container.
+#
+# Rather than fetching on a timer whether or not anything changed, an
+# attestation service's updater asks;
+#    GET /v1/head?since=<commit>&wait=<seconds>
+# and the response, of the form;
+#    { "head": "<commit>" }
+# comes as soon as the repo's HEAD is something other than <commit> (which is
+# immediately, if it already is), or after <seconds> if nothing has changed by
+# then (in which case "head" is <commit>). Without 'since', the current HEAD is
+# returned straight away. The updater fetches only when "head" has moved.
+#
+# A single thread watches HEAD (by reading .git, not by forking git) and wakes
+# all of the waiting requests when it moves, so the cost here is independent of
+# the number of replicas waiting.
+#
+# If the repo is sharded (see shards.py), each shard is fetched from git-daemon
+# as a repo of its own, and has a HEAD of its own, which is waited for with
+#    GET /v1/head?shard=<prefix>&since=<commit>&wait=<seconds>
+# (The same thread watches all of them.)
+#
+# With the single-file store (HCP_RUN_ENROLL_STORE=sqlite, see
+# sbin/enroll_store.py), "head" is the store's head rather than a commit, and
+# the replicas are updated from here too, rather than by git-daemon;
+#    GET /v1/delta?since=<head>
+# responds with the changes to the store since <head> (everything, if <head>
+# is empty or from another store), as lines of JSON, which the replica applies
+# with "enroll_store.py <replica> pull <this URL>".
+
+import argparse
+import http.server
+import json
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from db_worker import head_commit
+
+sys.path.append('/safeboot/sbin')
+import enroll_store
+import shards
+
+# How often (in seconds) the watcher looks at HEAD
+POLL_INTERVAL = 0.2
+
+# Longest wait a request may ask for
+MAX_WAIT = 300
+
+re_commit = re.compile(r'^[0-9a-f]{40,64}$')
+
+# 'repos' maps the shard prefixes ('' if not sharded) to the paths of the
+# repos, and 'head' is the function that reads a head (head_commit, or the
+# store's)
+class HeadWatcher:
+    def __init__(self, repos, head=head_commit):
+        self.repos = repos
+        self.head_fn = head
+        self.cond = threading.Condition()
+        self.heads = { shard: head(path) for shard, path in repos.items() }
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def watch(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            for shard, path in self.repos.items():
+                try:
+                    head = self.head_fn(path)
+                except Exception as e:
+                    print(f"Error, reading the head of {path}: {e!r}", file=sys.stderr)
+                    continue
+                with self.cond:
+                    if head != self.heads[shard]:
+                        self.heads[shard] = head
+                        self.cond.notify_all()
+
+    # Wait for a shard's HEAD to be something other than 'since', for up to
+    # 'wait' seconds, and return it
+    def wait(self, shard, since, wait):
+        with self.cond:
+            self.cond.wait_for(lambda: self.heads[shard] != since, timeout=wait)
+            return self.heads[shard]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        args = urllib.parse.parse_qs(url.query)
+        if url.path == '/v1/delta' and self.server.store is not None:
+            self.delta(args.get('since', [ '' ])[0])
+            return
+        if url.path != '/v1/head':
+            self.send_error(404)
+            return
+        shard = args.get('shard', [ '' ])[0]
+        if shard not in self.server.watcher.heads:
+            self.send_error(404)
+            return
+        since = args.get('since', [ '' ])[0]
+        try:
+            wait = min(float(args.get('wait', [ '0' ])[0]), MAX_WAIT)
+        except ValueError:
+            wait = -1
+        if (since and not re_commit.match(since)) or not wait >= 0:
+            self.send_error(400)
+            return
+        watcher = self.server.watcher
+        head = watcher.wait(shard, since, wait) if since else watcher.heads[shard]
+        body = json.dumps({ 'head': head }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The response is streamed, so it has no Content-Length, the end of it
+    # being the end of the connection (and the last line of the delta)
+    def delta(self, since):
+        if since and not re_commit.match(since):
+            self.send_error(400)
+            return
+        lines = self.server.store.delta(since)
+        try:
+            first = next(lines)
+        except Exception as e:
+            print(f"Error, producing a delta: {e!r}", file=sys.stderr)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            self.wfile.write(json.dumps(first).encode() + b'\n')
+            for line in lines:
+                self.wfile.write(json.dumps(line).encode() + b'\n')
+        finally:
+            lines.close()
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, watcher, store=None):
+        self.watcher = watcher
+        self.store = store
+        super().__init__(('', port), Handler)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='enrollsvc change notification')
+    parser.add_argument('--repo', required=True,
+                        help='path of the enrollment database (REPO_PATH)')
+    parser.add_argument('--port', type=int, default=9419,
+                        help='port to listen on')
+    parser.add_argument('--store',
+                        help='path of the single-file store (STORE_PATH), to serve instead of the repo')
+    parser.add_argument('--shard-digits', type=int, default=0,
+                        help='hex digits of ekpubhash the repo is sharded by (see shards.py)')
+    args = parser.parse_args()
+
+    if args.store:
+        store = enroll_store.Store(args.store, 'ro')
+        watcher = HeadWatcher({ '': args.store }, lambda path: store.head())
+    else:
+        store = None
+        repos = { p: path for p, path, _ in
+                  shards.shard_paths(args.repo, None, shards.check_digits(args.shard_digits)) }
+        repos[''] = args.repo
+        watcher = HeadWatcher(repos)
+    server = Server(args.port, watcher, store)
+    print(f"Notifying of changes to {args.store or args.repo} on port {args.port}",
+          file=sys.stderr)
+    server.serve_forever()
@@ -21,6 +21,13 @@ echo "Chowning asset-signing keys for use by db_user"
 
 chown db_user:db_user $SIGNING_KEY_PRIV $SIGNING_KEY_PUB
 
+echo "Starting the DB worker, listening on $DB_SOCKET"
+
+mkdir -p $DB_SOCKET_DIR
+chown $DB_USER:$DB_USER $DB_SOCKET_DIR
+chmod 755 $DB_SOCKET_DIR
+drop_privs_db /hcp/enrollsvc/db_worker.sh &
+
 echo "Running 'enrollsvc-mgmt' service"
 
 drop_privs_flask /hcp/enrollsvc/flask_wrapper.sh
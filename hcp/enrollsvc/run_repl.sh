@@ -24,10 +24,35 @@ echo "Running 'enrollsvc-repl' service (git-daemon)"
 GITDAEMON=${HCP_RUN_ENROLL_GITDAEMON:=/usr/lib/git-core/git-daemon}
 GITDAEMON_FLAGS=${HCP_RUN_ENROLL_GITDAEMON_FLAGS:=--reuseaddr --verbose --listen=0.0.0.0 --port=9418}
 
+# If the repo is sharded, git-daemon serves each shard as a repo of its own
+# (enrolldb-<prefix>), alongside REPO_PATH.
+SHARD_REPOS=""
+if sharded; then
+	for prefix in `shard_prefixes`; do
+		SHARD_REPOS="$SHARD_REPOS `shard_repo $prefix`"
+	done
+fi
+
 TO_RUN="$GITDAEMON \
 	--base-path=$HCP_ENROLLSVC_STATE_PREFIX \
 	$GITDAEMON_FLAGS \
-	$REPO_PATH"
+	$REPO_PATH $SHARD_REPOS"
+
+# Alongside git-daemon, tell the attestation services' updaters when there's
+# something new to fetch (see repl_notify.py).
+NOTIFY_PORT=${HCP_RUN_ENROLL_NOTIFY_PORT:=9419}
+
+# With the single-file store, the replicas get deltas from repl_notify.py
+# instead, and there's nothing for git-daemon to do.
+if using_store; then
+	echo "Running (as $DB_USER): repl_notify.py on port $NOTIFY_PORT, for $STORE_PATH"
+	drop_privs_db python3 /hcp/enrollsvc/repl_notify.py \
+		--repo $REPO_PATH --store $STORE_PATH --port $NOTIFY_PORT
+	exit $?
+fi
+echo "Running (as $DB_USER): repl_notify.py on port $NOTIFY_PORT"
+drop_privs_db python3 /hcp/enrollsvc/repl_notify.py \
+	--repo $REPO_PATH --shard-digits $SHARD_DIGITS --port $NOTIFY_PORT &
 
 echo "Running (as $DB_USER): $TO_RUN"
 drop_privs_db $TO_RUN
@@ -0,0 +1,195 @@
+# Pools of pre-generated secrets for new enrollments, kept full by db_worker.py.
+#
+# Some of what attest-enroll generates for an enrollment depends on neither the
+# TPM nor the host being enrolled (the rootfs key, or gencert's private key),
+# and so can be made ahead of time, leaving just the encryption to the EK and
+# the signing for the add path. "attest-enroll -P GENPROG=COUNT" adds entries
+# to the pool for a genprog (see GENPROG_POOL in sbin/attest-enroll), each
+# encrypted in the pool key, and each new enrollment takes (and removes) the
+# oldest entry from the pool of each of its genprogs, if there is one.
+#
+# Here, a thread keeps the pools topped up; whenever one has fewer than 'low'
+# entries, it is filled back up to 'high'. It looks every 'interval' seconds,
+# and whenever poke() is called (after each add). Fills are run niced, so that
+# they give way to the adds.
+#
+# If there is no pool key when we start, one is made, and any entries made
+# with an earlier key are removed. db_worker.sh keeps the key out of the state
+# directory, so that the pools are no use to anyone with a copy of it.
+#
+# An entry that is being written or taken is named for the PID of the
+# attest-enroll doing so (see pool_fill and pool_take), and is removed if that
+# process has gone away.
+#
+# With 'seed', the pools are filled in attest-enroll's test mode (see
+# GENPROG_POOL_SEED), so that which secrets each enrollment gets can be
+# predicted. This is for testing only!
+#
+# The metrics are the entries available in each pool, the entries generated
+# and taken, the failed fills and the time each fill took.
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+# Most entries added by one run of attest-enroll
+FILL_MAX = 16
+
+# Longest wait (seconds) before retrying after failing to fill a pool; the
+# wait doubles with each failure, from 'interval'
+RETRY_MAX = 60
+
+re_entry = re.compile(r'^[0-9]+\.enc$')
+re_in_progress = re.compile(r'^\.(fill|take)-.*\.([0-9]+)$')
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class SecretPool:
+    def __init__(self, pool_dir, key_path, genprogs, low, high, metrics,
+                 interval=1.0, safeboot='/safeboot', seed=None):
+        self.pool_dir = pool_dir
+        self.key_path = key_path
+        self.genprogs = list(genprogs)
+        self.low = low
+        self.high = high
+        self.interval = interval
+        self.safeboot = safeboot
+        self.seed = seed
+        self.wake = threading.Event()
+        self.last = {}
+        self.available = metrics.gauge('safeboot_enroll_pool_available',
+                                       'Pre-generated secrets available, by genprog',
+                                       'genprog', self.genprogs)
+        self.generated = metrics.counter('safeboot_enroll_pool_generated_total',
+                                         'Pre-generated secrets added to the pool, by genprog',
+                                         'genprog', self.genprogs)
+        self.taken = metrics.counter('safeboot_enroll_pool_taken_total',
+                                     'Pre-generated secrets used by enrollments, by genprog',
+                                     'genprog', self.genprogs)
+        self.fill_failures = metrics.counter('safeboot_enroll_pool_fill_failures_total',
+                                             'Failed runs of attest-enroll -P, by genprog',
+                                             'genprog', self.genprogs)
+        self.fill_seconds = metrics.histogram('safeboot_enroll_pool_fill_seconds',
+                                              'Time spent in each run of attest-enroll -P',
+                                              'genprog', self.genprogs)
+
+    # The attest-enroll configuration for taking from the pools
+    def config(self):
+        return [ f"GENPROG_POOL={self.pool_dir}", f"GENPROG_POOL_KEY={self.key_path}" ]
+
+    def count(self, genprog):
+        try:
+            names = os.listdir(os.path.join(self.pool_dir, genprog))
+        except FileNotFoundError:
+            return 0
+        return sum(1 for n in names if re_entry.match(n))
+
+    def setup(self):
+        os.makedirs(self.pool_dir, mode=0o700, exist_ok=True)
+        if os.path.exists(self.key_path):
+            return
+        log("Making a new pool key, emptying the secret pools")
+        for name in os.listdir(self.pool_dir):
+            shutil.rmtree(os.path.join(self.pool_dir, name), ignore_errors=True)
+        fd = os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+
+    # Remove what fills and takes that died left behind
+    def sweep(self, genprog):
+        path = os.path.join(self.pool_dir, genprog)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return
+        for name in names:
+            m = re_in_progress.match(name)
+            if m and not alive(int(m.group(2))):
+                log(f"Removing abandoned pool entry {genprog}/{name}")
+                try:
+                    os.unlink(os.path.join(path, name))
+                except FileNotFoundError:
+                    pass
+
+    def fill(self, genprog, n):
+        cmd = [ 'nice', './sbin/attest-enroll', '-V', f"GENPROG_POOL={self.pool_dir}",
+                '-V', f"GENPROG_POOL_KEY={self.key_path}" ]
+        if self.seed is not None:
+            cmd += [ '-V', f"GENPROG_POOL_SEED={self.seed}" ]
+        cmd += [ '-P', f"{genprog}={n}" ]
+        start = time.perf_counter()
+        c = subprocess.run(cmd, cwd=self.safeboot, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, text=True)
+        self.fill_seconds.observe(time.perf_counter() - start, genprog)
+        if c.returncode != 0:
+            log(c.stderr)
+            log(f"Error, failed to add to the {genprog} pool")
+            self.fill_failures.inc(genprog)
+            return False
+        self.generated.inc(genprog, n)
+        return True
+
+    # Top up the pools that are below the low-water mark. As only we add
+    # entries, the ones that went missing since we last looked were taken.
+    # Returns False if a fill failed.
+    def check(self):
+        ok = True
+        for genprog in self.genprogs:
+            self.sweep(genprog)
+            n = self.count(genprog)
+            taken = self.last.get(genprog, n) - n
+            if n < self.low:
+                while n < self.high:
+                    before = n
+                    k = min(FILL_MAX, self.high - n)
+                    if not self.fill(genprog, k):
+                        ok = False
+                        break
+                    n = self.count(genprog)
+                    taken += before + k - n
+            if taken > 0:
+                self.taken.inc(genprog, taken)
+            self.last[genprog] = n
+            self.available.set(n, genprog)
+        return ok
+
+    def run(self):
+        wait = self.interval
+        while True:
+            try:
+                ok = self.check()
+            except Exception as e:
+                log(f"Error, refilling the secret pools: {e!r}")
+                ok = False
+            if ok:
+                wait = self.interval
+                self.wake.wait(wait)
+                self.wake.clear()
+            else:
+                # (not woken by adds, which would only fail again)
+                time.sleep(wait)
+                wait = min(wait * 2, RETRY_MAX)
+
+    def start(self):
+        if self.seed is not None:
+            log("WARNING: the secret pools are being filled with PREDICTABLE secrets, for testing")
+        self.setup()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Called after an add, which may have taken from the pools
+    def poke(self):
+        self.wake.set()
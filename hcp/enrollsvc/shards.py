@@ -0,0 +1,56 @@
+# Sharding of the enrollment database by ekpubhash prefix.
+#
+# With HCP_RUN_ENROLL_SHARD_DIGITS set to 1 or 2, the enrollments are split
+# between 16 or 256 repos, by the first 1 or 2 hex characters of the
+# ekpubhash. Each shard is a complete repo of the usual layout (an ekpubhash
+# tree and an hn2ek table of its own, see common_defs.sh and hn2ek.py), with a
+# lock and a commit stream of its own, so writes to different shards don't
+# wait for each other. As ekpubhashes are uniformly distributed, so are the
+# writes.
+#
+# The shard for prefix <p> lives next to REPO_PATH, named as REPO_PATH with
+# "-<p>" before the ".git" (enrolldb-3f.git), and likewise for its lockfile
+# (lock-enrolldb-3f.git). REPO_PATH itself is still made, but only holds the
+# version and common_defs.sh. The same naming is used by common.sh, and by the
+# attestation services (which replicate each shard separately).
+#
+# A query, delete or find for an ekpubhash prefix (or hostname suffix) that
+# doesn't pick out a single shard is done on each of the shards it could
+# match, and the results are put together in ekpubhash (or hostname) order.
+
+import os
+
+# Most shards a database may be split into (as hex digits of prefix)
+MAX_DIGITS = 2
+
+def check_digits(digits):
+    if digits < 0 or digits > MAX_DIGITS:
+        raise ValueError(f"shard digits must be between 0 and {MAX_DIGITS}")
+    return digits
+
+# The prefixes of the shards, in ekpubhash order ([ '' ] if not sharded)
+def prefixes(digits):
+    if digits == 0:
+        return [ '' ]
+    return [ format(i, f'0{digits}x') for i in range(16 ** digits) ]
+
+# The prefixes of the shards that entries matching an ekpubhash prefix can be
+# in (all of them, if it is shorter than a shard prefix)
+def matching(digits, ekpubhash_prefix):
+    return [ p for p in prefixes(digits) if p.startswith(ekpubhash_prefix[0:digits]) ]
+
+# The prefix of the shard an ekpubhash belongs to
+def shard_of(digits, ekpubhash):
+    return ekpubhash[0:digits]
+
+# The path of a shard's repo (or lockfile), given that of the database
+def shard_path(path, prefix):
+    if not prefix:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{prefix}{ext}"
+
+# The (prefix, repo path, lock path) of each shard
+def shard_paths(repo_path, lock_path, digits):
+    return [ (p, shard_path(repo_path, p), shard_path(lock_path, p) if lock_path else None)
+             for p in prefixes(digits) ]
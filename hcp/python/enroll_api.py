@@ -6,7 +6,12 @@
 #               -F hostname=<hostname> \
 #               <enrollsvc-URL>/v1/add
 #
+# add_batch: curl -v -F ekpub=@</path/to/ek1.pub> -F hostname=<hostname1> \
+#                 -F ekpub=@</path/to/ek2.pub> -F hostname=<hostname2> \
+#                 [...] <enrollsvc-URL>/v1/add_batch
+#
 # query:   curl -v -G -d ekpubhash=<hexstring> \
+#               [-d limit=<page size> [-d cursor=<cursor>]] \
 #               <enrollsvc-URL>/v1/query
 #
 # delete:  curl -v -F ekpubhash=<hexstring> \
@@ -21,16 +26,22 @@ import os
 import sys
 import argparse
 
-# Handler functions for the subcommands (add, query, delete, find)
+# Handler functions for the subcommands (add, add-batch, query, delete, find)
 # They all return a 2-tuple of {result,json}, where result is True iff the
 # operation was successful.
 
+# The HTTP calls go through args.session, if the caller provided one (a
+# requests.Session, so that a caller making many calls, like the soak tests
+# in test.py, reuses connections rather than making one per call).
+def http(args):
+    return getattr(args, 'session', None) or requests
+
 def enroll_add(args):
     form_data = {
         'ekpub': ('ek.pub', open(args.ekpub, 'rb')),
         'hostname': (None, args.hostname)
     }
-    response = requests.post(args.api + '/v1/add', files=form_data)
+    response = http(args).post(args.api + '/v1/add', files=form_data)
     jr = json.loads(response.content)
     try:
         rcode = jr['returncode']
@@ -42,17 +53,73 @@ def enroll_add(args):
         return False, jr
     return True, jr
 
+# The manifest has a line per entry, of the form "<path to ek.pub> <hostname>".
+# It is sent in batches of args.batch_size entries, and the per-entry results
+# of all the batches are returned together.
+def enroll_add_batch(args):
+    entries = []
+    with open(args.manifest) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            ekpub, _, hostname = line.rstrip('\n').rpartition(' ')
+            entries.append((ekpub, hostname))
+    result = True
+    results = []
+    for i in range(0, len(entries), args.batch_size):
+        batch = entries[i:i + args.batch_size]
+        form_data = []
+        for ekpub, hostname in batch:
+            with open(ekpub, 'rb') as ekf:
+                form_data.append(('ekpub', ('ek.pub', ekf.read())))
+            form_data.append(('hostname', (None, hostname)))
+        response = http(args).post(args.api + '/v1/add_batch', files=form_data)
+        jr = json.loads(response.content)
+        if 'entries' not in jr:
+            print("Error, response has no 'entries'")
+            print(jr)
+            return False, { 'entries': results }
+        results += jr['entries']
+        if any(e['returncode'] != 0 for e in jr['entries']):
+            result = False
+    return result, { 'entries': results }
+
 def do_query_or_delete(args, is_delete):
     if is_delete:
         form_data = { 'ekpubhash': (None, args.ekpubhash) }
-        response = requests.post(args.api + '/v1/delete', files=form_data)
+        response = http(args).post(args.api + '/v1/delete', files=form_data)
     else:
         form_data = { 'ekpubhash': args.ekpubhash }
-        response = requests.get(args.api + '/v1/query', params=form_data)
+        response = http(args).get(args.api + '/v1/query', params=form_data)
     jr = json.loads(response.content)
     return True, jr
 
+# Fetch the query results a page at a time, printing each entry (one JSON
+# object per line) as it arrives, so that dumping the whole database doesn't
+# need it all in memory at once.
+def query_pages(args):
+    form_data = { 'ekpubhash': args.ekpubhash, 'limit': args.page_size }
+    while True:
+        response = http(args).get(args.api + '/v1/query', params=form_data,
+                                stream=True)
+        cursor = None
+        for line in response.iter_lines():
+            if not line:
+                continue
+            jr = json.loads(line)
+            if 'error' in jr:
+                return False, jr
+            if 'cursor' in jr:
+                cursor = jr['cursor']
+                continue
+            print(json.dumps(jr))
+        if cursor is None:
+            return True, None
+        form_data['cursor'] = cursor
+
 def enroll_query(args):
+    if args.page_size:
+        return query_pages(args)
     return do_query_or_delete(args, False)
 
 def enroll_delete(args):
@@ -60,7 +127,7 @@ def enroll_delete(args):
 
 def enroll_find(args):
     form_data = { 'hostname_suffix': args.hostname_suffix }
-    response = requests.get(args.api + '/v1/find', params=form_data)
+    response = http(args).get(args.api + '/v1/find', params=form_data)
     jr = json.loads(response.content)
     return True, jr
 
@@ -104,6 +171,25 @@ if __name__ == '__main__':
     parser_a.add_argument('hostname', help=add_help_hostname)
     parser_a.set_defaults(func=enroll_add)
 
+    add_batch_help = 'Enroll many {TPM,hostname} 2-tuples at once'
+    add_batch_epilog = """
+    The 'add-batch' subcommand invokes the '/v1/add_batch' handler of the
+    Enrollment Service's management API, to enroll many TPM+hostname 2-tuples
+    with a single commit to the enrollment database per batch. The manifest file
+    has one line per enrollment, consisting of the path to the 'ekpub' file and
+    the hostname, separated by a space (see 'add' for details of both). The
+    result of each enrollment is reported, and the command fails if any of them
+    failed.
+    """
+    add_batch_help_manifest = 'path to the file of "<ekpub path> <hostname>" lines'
+    add_batch_help_size = 'number of enrollments per request (default: 500)'
+    parser_b = subparsers.add_parser('add-batch', help=add_batch_help,
+                                     epilog=add_batch_epilog)
+    parser_b.add_argument('manifest', help=add_batch_help_manifest)
+    parser_b.add_argument('--batch-size', type=int, default=500,
+                          help=add_batch_help_size)
+    parser_b.set_defaults(func=enroll_add_batch)
+
     query_help = 'Query (and list) enrollments based on prefix-search of hash(EKpub)'
     query_epilog = """
     The 'query' subcommand invokes the '/v1/query' handler of the Enrollment
@@ -116,11 +202,16 @@ if __name__ == '__main__':
     entries (respectively) will be returned. To query a specific entry, the query
     parameter should contain enough of the ekpubhash to uniquely distinguish it from
     all others. (Usually, this is significantly fewer characters than the full
-    ekpubhash value.)
+    ekpubhash value.) With '--page-size', the entries are retrieved that many at
+    a time (in ekpubhash order) and printed as they arrive, one per line, which
+    is how to dump a large database.
     """
     query_help_ekpubhash = 'hexidecimal prefix (empty to return all enrollments)'
+    query_help_page_size = 'fetch the entries this many at a time, printing one per line'
     parser_q = subparsers.add_parser('query', help=query_help, epilog=query_epilog)
     parser_q.add_argument('ekpubhash', help=query_help_ekpubhash)
+    parser_q.add_argument('--page-size', type=int, default=0,
+                          help=query_help_page_size)
     parser_q.set_defaults(func=enroll_query)
 
     delete_help = 'Delete enrollments based on prefix-search of hash(EKpub)'
@@ -164,9 +255,11 @@ if __name__ == '__main__':
         print("Error, no API URL was provided.")
         sys.exit(-1)
 
-    # Dispatch
-    result, json = args.func(args)
+    # Dispatch (with one connection for all of the calls that it makes)
+    args.session = requests.Session()
+    result, j = args.func(args)
     if not result:
         print("Error, API returned failure")
         sys.exit(-1)
-    print(json)
+    if j is not None:
+        print(j)
@@ -31,7 +31,9 @@
 # - The 'Initialize()' method launches the service container's setup script to
 #   create service state.
 # - The 'Delete()' method tears down the service state.
-# - Start/Stop are unimplemented for now.
+# - The 'Start()' method runs the service in a detached container, 'Exec()'
+#   runs commands inside it (e.g. tpm2-tools against a running software TPM)
+#   and 'Stop()' stops it.
 #
 # class HcpSwtpmsvc
 # - Derived from HcpService.
@@ -97,8 +99,10 @@ class Hcp:
 	#   right after the image name.
 	# - 'flags' and 'mounts' take the same form as they do in the
 	#   constructor, though they only take effect during this call.
+	# - If 'capture' is True, the container's stdout is captured (in the
+	#   returned struct's 'stdout') rather than passed through.
 	# Returns 'CompletedProcess' struct from os.subprocess.run()
-	def launch(self, name, cmd, *, flags=None, mounts=None):
+	def launch(self, name, cmd, *, flags=None, mounts=None, capture=False):
 		args = docker_run_preamble.copy()
 		args += self.flags
 		if (flags):
@@ -121,7 +125,8 @@ class Hcp:
 			args.append(self.util)
 		args += cmd
 		print('Running:', args)
-		outcome = subprocess.run(args)
+		outcome = subprocess.run(args,
+				stdout=subprocess.PIPE if capture else None)
 		print('Outcome:', outcome)
 		return outcome
 
@@ -140,6 +145,7 @@ class HcpService(Hcp):
 		super().__init__(**kwargs)
 		self.latched = False
 		self.running = False
+		self.container = None
 		if not path:
 			self.path = tempfile.mkdtemp()
 		else:
@@ -179,6 +185,43 @@ class HcpService(Hcp):
 					      flags=['-t','--rm'])
 		return None
 
+	# Runs the service (an initialized instance) in a detached container,
+	# using the command the derived class configured as 'runCmd'. The
+	# container is removed when it stops.
+	# - Returns the container ID.
+	def Start(self):
+		if self.running:
+			return self.container
+		if not self.Initialized():
+			raise Exception(f'Instance at {self.path} is not initialized')
+		outcome = self.launch(self.contName, self.runCmd,
+				      flags=['-d', '--rm'], capture=True)
+		if outcome.returncode != 0:
+			raise Exception(f'Unable to start instance at {self.path}')
+		self.container = outcome.stdout.decode().strip()
+		self.running = True
+		return self.container
+
+	# Runs a command inside the running container, with 'input' (bytes, if
+	# any) on its stdin. Unlike 'launch', stdout is always captured, and
+	# stderr is captured too unless 'verbose'.
+	# - Returns 'CompletedProcess' struct from os.subprocess.run()
+	def Exec(self, cmd, *, input=None, verbose=False):
+		if not self.running:
+			raise Exception(f'Instance at {self.path} is not running')
+		args = ['docker', 'exec', '-i', self.container] + cmd
+		return subprocess.run(args, input=input, stdout=subprocess.PIPE,
+				      stderr=None if verbose else subprocess.PIPE)
+
+	def Stop(self):
+		if not self.running:
+			return None
+		outcome = subprocess.run(['docker', 'stop', self.container],
+					 stdout=subprocess.DEVNULL)
+		self.container = None
+		self.running = False
+		return outcome
+
 	# Destroys an initialized instance. Note, there is no specialization for
 	# derived classes - deleting an instance is presumed to be equivalent to
 	# deleting its state. To avoid namespace weirdness, we use the utility
@@ -209,6 +252,7 @@ class HcpSwtpmsvc(HcpService):
 		super().__init__(**kwargs)
 		self.contName = 'swtpmsvc'
 		self.initCmd = ['/hcp/swtpmsvc/setup_swtpm.sh']
+		self.runCmd = ['/hcp/swtpmsvc/run_swtpm.sh']
 		self.envs['HCP_SWTPMSVC_STATE_PREFIX'] = '/state'
 		self.envs['HCP_SWTPMSVC_ENROLL_HOSTNAME'] = enrollHostname
 
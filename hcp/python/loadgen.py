@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+# Open-loop load generation, for the soak tests in test.py.
+#
+# A closed-loop test (N threads, each waiting for one call to finish before
+# making the next) slows down as the service slows down, so it never sees the
+# queues that build up when requests arrive faster than they're served. Here,
+# requests are started on a schedule (at a fixed rate, or as a Poisson process
+# at that mean rate) whether or not earlier ones have finished, and each one's
+# latency is measured from when it was *scheduled* to start. If the workers
+# can't keep up, the time a request spends waiting for one is counted against
+# it, as it would be for a real client.
+#
+# run() does the scheduling and returns a LoadStats, which gives percentiles,
+# the outcomes of each kind of operation and a histogram of their latencies,
+# as text (report()) or as a dict for writing out as JSON (summary()).
+
+import bisect
+import random
+import threading
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Histogram bucket upper bounds (seconds), for summary()
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+		   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The percentiles that are reported
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Nearest-rank percentile of a sorted array
+def percentile(samples, p):
+	if not samples:
+		return None
+	rank = int(len(samples) * p / 100.0 + 0.5)
+	return samples[min(max(rank - 1, 0), len(samples) - 1)]
+
+def pname(p):
+	return 'p' + f'{p:g}'.replace('.', '')
+
+class OpStats:
+
+	# The latencies and outcomes of one kind of operation. Latencies are
+	# kept individually (8 bytes each), so that percentiles are exact.
+	def __init__(self):
+		self.latencies = array('d')
+		self.outcomes = Counter()
+
+	def record(self, latency, outcome):
+		self.latencies.append(latency)
+		self.outcomes[outcome] += 1
+
+	def summary(self, elapsed):
+		samples = sorted(self.latencies)
+		s = {
+			'count': len(samples),
+			'throughput': len(samples) / elapsed if elapsed else 0,
+			'outcomes': dict(self.outcomes),
+		}
+		if samples:
+			s['mean'] = sum(samples) / len(samples)
+			s['max'] = samples[-1]
+			for p in PERCENTILES:
+				s[pname(p)] = percentile(samples, p)
+			buckets = [ 0 ] * (len(LATENCY_BUCKETS) + 1)
+			for v in samples:
+				buckets[bisect.bisect_left(LATENCY_BUCKETS, v)] += 1
+			s['histogram'] = {
+				'le': list(LATENCY_BUCKETS) + [ 'inf' ],
+				'counts': buckets,
+			}
+		return s
+
+class LoadStats:
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.ops = {}
+		self.skipped = Counter()
+		self.lock = threading.Lock()
+		self.started = None
+		self.finished = None
+		# the largest gap between when a request was due and when the
+		# dispatcher got to start it (if this gets large, the load
+		# generator itself was the bottleneck)
+		self.max_dispatch_lag = 0
+
+	def record(self, name, latency, outcome):
+		with self.lock:
+			op = self.ops.get(name)
+			if op is None:
+				op = self.ops[name] = OpStats()
+			op.record(latency, outcome)
+
+	def done(self):
+		with self.lock:
+			return sum(len(op.latencies) for op in self.ops.values())
+
+	def elapsed(self):
+		return (self.finished or time.monotonic()) - self.started
+
+	def summary(self):
+		elapsed = self.elapsed()
+		total = OpStats()
+		for op in self.ops.values():
+			total.latencies.extend(op.latencies)
+			total.outcomes.update(op.outcomes)
+		return {
+			'offered_rate': self.rate,
+			'elapsed': elapsed,
+			'max_dispatch_lag': self.max_dispatch_lag,
+			'skipped': dict(self.skipped),
+			'total': total.summary(elapsed),
+			'ops': { name: op.summary(elapsed) for name, op in sorted(self.ops.items()) },
+		}
+
+	# A human-readable version of summary()
+	def report(self):
+		s = self.summary()
+		lines = [ f"offered {s['offered_rate']:g}/s for {s['elapsed']:.1f}s, "
+			  f"max dispatch lag {s['max_dispatch_lag'] * 1000:.1f}ms" ]
+		for name, op in [ ('total', s['total']) ] + list(s['ops'].items()):
+			line = f"{name:>12}: {op['count']} ops, {op['throughput']:.1f}/s"
+			if op['count']:
+				line += ''.join(f", {pname(p)} {op[pname(p)] * 1000:.1f}ms"
+						for p in PERCENTILES)
+				line += f", max {op['max'] * 1000:.1f}ms"
+			lines.append(line)
+			outcomes = ', '.join(f'{k}={v}' for k, v in sorted(op['outcomes'].items()))
+			lines.append(f"{'':>12}  {outcomes}")
+		if s['skipped']:
+			skipped = ', '.join(f'{k}={v}' for k, v in sorted(s['skipped'].items()))
+			lines.append(f"{'skipped':>12}: {skipped}")
+		return '\n'.join(lines)
+
+# Start 'count' operations (or as many as are due in 'duration' seconds) at
+# 'rate' per second, on a pool of 'workers' threads. 'pick' is called with the
+# sequence number of each operation when it is due, and returns a 2-tuple of
+# the operation's name and a function that performs it and returns its
+# outcome (a short string, e.g. 'ok' or the kind of failure). An exception
+# raised by that function is recorded as its outcome. If the function is None,
+# the operation couldn't be started (e.g. the test has nothing for it to work
+# on), which is only counted (as skipped). With 'poisson', the
+# gaps between arrivals are exponentially distributed rather than fixed.
+def run(pick, *, rate, duration=None, count=None, workers=64, poisson=False,
+	seed=None, progress=None):
+	if rate <= 0:
+		raise ValueError('rate must be positive')
+	if count is None and duration is None:
+		raise ValueError('need a duration or a count')
+	rng = random.Random(seed)
+	stats = LoadStats(rate)
+
+	def do(name, fn, due):
+		try:
+			outcome = fn()
+		except Exception as e:
+			outcome = type(e).__name__
+		stats.record(name, time.monotonic() - due, outcome)
+
+	pool = ThreadPoolExecutor(workers)
+	stats.started = time.monotonic()
+	due = stats.started
+	last_progress = due
+	i = 0
+	while count is None or i < count:
+		if duration is not None and due - stats.started >= duration:
+			break
+		now = time.monotonic()
+		if due > now:
+			time.sleep(due - now)
+			now = time.monotonic()
+		stats.max_dispatch_lag = max(stats.max_dispatch_lag, now - due)
+		name, fn = pick(i)
+		if fn is None:
+			stats.skipped[name] += 1
+		else:
+			pool.submit(do, name, fn, due)
+		i += 1
+		due += rng.expovariate(rate) if poisson else 1.0 / rate
+		if progress and now - last_progress >= progress:
+			last_progress = now
+			print(f'{i} started, {stats.done()} done')
+	pool.shutdown(wait=True)
+	stats.finished = time.monotonic()
+	return stats
@@ -1,15 +1,21 @@
 #!/usr/bin/python3
 
 import os
+import io
+import json
+import struct
+import tarfile
+import threading
+import requests
 from tempfile import mkdtemp
-from multiprocessing import Lock
-from random import randrange
+from random import Random
 from pathlib import Path
 from hashlib import sha256
-from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
 
 from hcp import HcpSwtpmsvc
-from enroll_api import enroll_add, enroll_delete, enroll_find
+from enroll_api import enroll_add, enroll_delete, enroll_find, enroll_query
+import loadgen
 
 # The enroll_api functions take an 'args' object that contain inputs parsed
 # from the command-line (via 'argparse'). We want to use the same functions
@@ -18,6 +24,65 @@ from enroll_api import enroll_add, enroll_delete, enroll_find
 class HcpArgs:
 	pass
 
+# The sTPMs are driven with the tpm2-tools and safeboot scripts inside their
+# own (running) swtpmsvc containers. common.sh sets up the paths, and the
+# swtpm may take a moment to start listening.
+swtpm_preamble = '''
+. /hcp/swtpmsvc/common.sh 2> /dev/null
+export TPM2TOOLS_TCTI=swtpm:host=localhost,port=9876
+for i in $(seq 50); do
+	tpm2 pcrread sha256:0 > /dev/null 2>&1 && break
+	sleep 0.2
+done
+'''
+
+# Extends the PCRs given as arguments ("<pcr>:sha256=<hex>") and writes a
+# quote to stdout
+swtpm_quote = swtpm_preamble + '''
+tpm2 pcrextend "$@" >&2
+tpm2-attest quote
+'''
+
+# Unseals an attestation response from stdin
+swtpm_unseal = swtpm_preamble + '''
+tpm2-attest unseal
+'''
+
+# TCG event log constants (see sbin/tpm2_eventlog.py)
+EV_POST_CODE = 0x00000001
+EV_NO_ACTION = 0x00000003
+EV_SEPARATOR = 0x00000004
+TPM_ALG_SHA256 = 0x000b
+
+# A crypto-agile (sha256 only) event log with a few events in each of PCRs
+# 0-7, made up from 'seed' so that each sTPM has its own but always the same
+# PCR values. Returns the log and the list of (pcr, digest) extensions that
+# make the sTPM's PCRs match it.
+def synthetic_eventlog(seed):
+	spec_id = b'Spec ID Event03\0' + struct.pack('<IBBBBIHHB',
+		0, 0, 2, 0, 2, 1, TPM_ALG_SHA256, 32, 0)
+	log = struct.pack('<II', 0, EV_NO_ACTION) + bytes(20) + \
+		struct.pack('<I', len(spec_id)) + spec_id
+	extends = []
+	for pcr in range(8):
+		for etype, data in ((EV_POST_CODE, f'{seed} pcr{pcr}'.encode()),
+				    (EV_SEPARATOR, bytes(4))):
+			digest = sha256(data).digest()
+			log += struct.pack('<IIIH', pcr, etype, 1, TPM_ALG_SHA256) + \
+				digest + struct.pack('<I', len(data)) + data
+			extends.append((pcr, digest))
+	return log, extends
+
+# Adds a member to a tarball (bytes), returning the new tarball
+def tar_append(tarball, name, data):
+	out = io.BytesIO(tarball)
+	with tarfile.open(fileobj=out, mode='a') as tf:
+		info = tarfile.TarInfo(name)
+		info.size = len(data)
+		info.mode = 0o644
+		tf.addfile(info, io.BytesIO(data))
+	return out.getvalue()
+
 # This object represents a bank of swtpm instances that we use to test
 # enrollment and attestation endpoints. It is backed onto the filesystem and if
 # a 'path' argument is provided to the constructor it will be persistent from
@@ -54,8 +119,7 @@ class HcpSwtpmBank:
 		for n in range(self.num):
 			entry = {
 				'path': self.path + '/t{num}'.format(num = n),
-				'index': n,
-				'lock': Lock()
+				'index': n
 				}
 			entry['tpm'] = None
 			entry['tpmEKpub'] = entry['path'] + '/tpm/ek.pub'
@@ -105,65 +169,232 @@ class HcpSwtpmBank:
 		Path(self.numFile).unlink()
 		os.rmdir(self.path)
 
-	def Soakenroll(self, loop, threads):
-		children = []
-		for _ in range(threads):
-			p = Process(target=self.Soakenroll_thread, args=(loop,))
-			print('launching')
-			p.start()
-			children.append(p)
-		while len(children):
-			p = children.pop()
-			print('joining')
-			p.join()
-
-	def Soakenroll_thread(self, loop):
-		print(f'_thread, loop={loop}')
-		for _ in range(loop):
-			self.Soakenroll_iteration()
-
-	def Soakenroll_iteration(self):
-		print('_iteration')
-		args = HcpArgs()
-		args.api = self.enrollAPI
-		idx = randrange(0, self.num)
-		entry = self.entries[idx]
-		entry['lock'].acquire()
-		if os.path.isfile(entry['touchEnrolled']):
-			print('{idx} enrolled, unenrolling.'.format(idx=idx), end=' ')
-			if not entry['ekpubhash']:
-				# Lazy initialize the ekpubhash value, using 'find'
-				args.hostname_suffix = entry['hostname']
-				result, jr = enroll_find(args)
-				if not result:
-					raise Exception('Enrollment \'find\' failed')
-				num = len(jr['ekpubhashes'])
-				if num != 1:
-					raise Exception(f'Enrollment \'find\' return {num} hashes')
-				entry['ekpubhash'] = jr['ekpubhashes'].pop()
-				print('lazy-init ekpubhash={ekph}.'.format(
-					ekph = entry['ekpubhash']), end=' ')
-			args.ekpubhash = entry['ekpubhash']
-			result, jr = enroll_delete(args)
-			if not result:
-				raise Exception('Enrollment \'delete\' failed')
-			Path(entry['touchEnrolled']).unlink()
-		else:
-			print('{idx} unenrolled, enrolling.'.format(idx=idx), end=' ')
-			pubOrPem = randrange(0, 2)
-			if pubOrPem == 0:
-				print('TPM2B_PUBLIC.', end=' ')
-				args.ekpub = entry['tpmEKpub']
+	# Soak tests the enrollment service with an open-loop mix of operations
+	# (see loadgen.py) on the bank's sTPMs, started at 'rate' per second
+	# for 'duration' seconds. 'mix' maps each of 'add', 'query', 'find' and
+	# 'delete' to its share of the operations;
+	# - add enrolls an unenrolled sTPM (with its EK in either format),
+	# - delete unenrolls an enrolled one,
+	# - find looks an enrolled sTPM up by its hostname, which is also how
+	#   its ekpubhash is learned, and
+	# - query looks an enrolled sTPM up by its ekpubhash.
+	# An sTPM is only used by one operation at a time. If an enrolled sTPM's
+	# ekpubhash isn't known yet, a query or delete of it is preceded by a
+	# find, and counted as 'find+query' or 'find+delete'. If there's no sTPM
+	# in the state an operation needs, it is skipped (and counted). The
+	# calls share pooled connections ('workers' of them). Returns the
+	# summary, which is also printed (and written to 'report' as JSON, if
+	# given).
+	def Soakenroll(self, *, rate, duration, mix, workers=16, poisson=False,
+		       seed=None, report=None):
+		ops = [ op for op in mix if mix[op] > 0 ]
+		weights = [ mix[op] for op in ops ]
+		rng = Random(seed)
+		lock = threading.Lock()
+		local = threading.local()
+		enrolled = set()
+		unenrolled = set()
+		for entry in self.entries:
+			if os.path.isfile(entry['touchEnrolled']):
+				enrolled.add(entry['index'])
 			else:
-				print('PEM.', end=' ')
-				args.ekpub = entry['tpmEKpem']
+				unenrolled.add(entry['index'])
+
+		def api_args():
+			args = HcpArgs()
+			args.api = self.enrollAPI
+			if not hasattr(local, 'session'):
+				local.session = requests.Session()
+			args.session = local.session
+			return args
+
+		def find(entry):
+			args = api_args()
+			args.hostname_suffix = entry['hostname']
+			result, jr = enroll_find(args)
+			num = len(jr.get('ekpubhashes', []))
+			if num != 1:
+				return f'found_{num}'
+			entry['ekpubhash'] = jr['ekpubhashes'][0]
+			return 'ok'
+
+		def add(entry, pem):
+			args = api_args()
+			args.ekpub = entry['tpmEKpem'] if pem else entry['tpmEKpub']
 			args.hostname = entry['hostname']
 			result, jr = enroll_add(args)
 			if not result:
-				raise Exception('Enrollment \'add\' failed')
+				return f"returncode_{jr.get('returncode')}"
 			Path(entry['touchEnrolled']).touch()
-		print('OK')
-		entry['lock'].release()
+			return 'ok'
+
+		def query(entry):
+			if not entry['ekpubhash']:
+				outcome = find(entry)
+				if outcome != 'ok':
+					return outcome
+			args = api_args()
+			args.ekpubhash = entry['ekpubhash']
+			args.page_size = 0
+			result, jr = enroll_query(args)
+			num = len(jr.get('entries', []))
+			return 'ok' if num == 1 else f'found_{num}'
+
+		def delete(entry):
+			if not entry['ekpubhash']:
+				outcome = find(entry)
+				if outcome != 'ok':
+					return outcome
+			args = api_args()
+			args.ekpubhash = entry['ekpubhash']
+			result, jr = enroll_delete(args)
+			if 'error' in jr:
+				return 'error'
+			Path(entry['touchEnrolled']).unlink()
+			return 'ok'
+
+		funcs = { 'add': add, 'query': query, 'find': find, 'delete': delete }
+
+		# Runs in the dispatcher; takes an sTPM that is in the state
+		# that the operation needs out of circulation until it's done
+		def pick(i):
+			op = rng.choices(ops, weights)[0]
+			with lock:
+				pool = unenrolled if op == 'add' else enrolled
+				if not pool:
+					return op, None
+				idx = rng.choice(tuple(pool))
+				pool.discard(idx)
+			entry = self.entries[idx]
+			name = op
+			if op in ('query', 'delete') and not entry['ekpubhash']:
+				name = 'find+' + op
+			# the EK is sent as TPM2B_PUBLIC or PEM at random
+			fargs = (rng.randrange(0, 2) == 1,) if op == 'add' else ()
+
+			def fn():
+				try:
+					outcome = funcs[op](entry, *fargs)
+				finally:
+					enrolled_now = os.path.isfile(entry['touchEnrolled'])
+					if not enrolled_now:
+						entry['ekpubhash'] = None
+					with lock:
+						(enrolled if enrolled_now else unenrolled).add(idx)
+				return outcome
+			return name, fn
+
+		stats = loadgen.run(pick, rate=rate, duration=duration,
+				    workers=workers, poisson=poisson, seed=seed,
+				    progress=5)
+		print(stats.report())
+		summary = stats.summary()
+		summary['mix'] = dict(mix)
+		summary['bank'] = { 'size': self.num,
+				    'enrolled': len(enrolled),
+				    'unenrolled': len(unenrolled) }
+		if report:
+			with open(report, 'w') as f:
+				json.dump(summary, f, indent=1)
+		return summary
+
+	# Quotes each of the given entries' sTPMs, after extending its PCRs to
+	# match a synthetic event log, which is added to the quote. The sTPMs
+	# are left running, because the AKs in the quotes (and therefore the
+	# responses to them) only work until the sTPM restarts.
+	def Quote(self, entries, threads):
+		def quote_one(entry):
+			if not entry['tpm']:
+				entry['tpm'] = HcpSwtpmsvc(path=entry['path'])
+			entry['tpm'].Start()
+			eventlog, extends = synthetic_eventlog(entry['hostname'])
+			outcome = entry['tpm'].Exec(['bash', '-c', swtpm_quote, 'quote'] +
+				[ f'{pcr}:sha256={digest.hex()}' for pcr, digest in extends ])
+			if outcome.returncode != 0:
+				print(outcome.stderr.decode(errors='replace'))
+				raise Exception(f'Quote from {entry["path"]} failed')
+			entry['quote'] = tar_append(outcome.stdout, 'eventlog', eventlog)
+			entry['enrolled'] = os.path.isfile(entry['touchEnrolled'])
+			print('Quoted {num} ({enrolled})'.format(num = entry['index'],
+				enrolled = 'enrolled' if entry['enrolled'] else 'unenrolled'))
+		with ThreadPoolExecutor(threads) as pool:
+			list(pool.map(quote_one, entries))
+
+	def Stop(self):
+		for entry in self.entries:
+			if entry['tpm']:
+				entry['tpm'].Stop()
+
+	# Replays quotes from (up to 'quotes' of) the bank's sTPMs to the
+	# attestation service, as an open-loop load (see loadgen.py). Quotes
+	# from enrolled sTPMs should get sealed secrets back, and those from
+	# unenrolled ones should be refused; anything else is counted as an
+	# error, by kind (e.g. HTTP status or exception). With 'unseal', the
+	# first response for each enrolled sTPM is unsealed by that sTPM
+	# afterwards, to check that the service sealed the right thing to the
+	# right TPM. Returns the summary, which is also printed (and written to
+	# 'report' as JSON, if given).
+	def Soakattest(self, attestAPI, *, rate, duration, quotes=0, threads=4,
+		       workers=64, poisson=False, unseal=False, seed=None,
+		       report=None):
+		entries = self.entries[:quotes] if quotes else self.entries
+		local = threading.local()
+		rng = Random(seed)
+		responses = {}
+		try:
+			self.Quote(entries, threads)
+
+			def attest(entry):
+				if not hasattr(local, 'session'):
+					local.session = requests.Session()
+				response = local.session.post(attestAPI,
+					files={ 'quote': ('quote.tar', entry['quote']) })
+				if response.status_code != 200:
+					return f'http_{response.status_code}'
+				# a refusal is a JSON error, rather than a sealed
+				# tarball
+				refused = response.headers.get('content-type', '').startswith('application/json')
+				if refused:
+					return 'unexpected_refusal' if entry['enrolled'] else 'refused'
+				if not entry['enrolled']:
+					return 'unexpected_success'
+				if unseal:
+					responses.setdefault(entry['index'], response.content)
+				return 'ok'
+
+			def pick(i):
+				entry = entries[rng.randrange(len(entries))]
+				return ('enrolled' if entry['enrolled'] else 'unenrolled',
+					lambda: attest(entry))
+
+			stats = loadgen.run(pick, rate=rate, duration=duration,
+					    workers=workers, poisson=poisson,
+					    seed=seed, progress=5)
+			print(stats.report())
+			summary = stats.summary()
+
+			if unseal:
+				unsealed = { 'ok': 0, 'failed': 0 }
+				for idx, sealed in sorted(responses.items()):
+					outcome = self.entries[idx]['tpm'].Exec(
+						['bash', '-c', swtpm_unseal], input=sealed)
+					try:
+						if outcome.returncode != 0:
+							raise tarfile.TarError(outcome.stderr.decode(errors='replace'))
+						with tarfile.open(fileobj=io.BytesIO(outcome.stdout)) as tf:
+							tf.getmembers()
+						unsealed['ok'] += 1
+					except tarfile.TarError as e:
+						print(f'Unsealing the response for {idx} failed: {e}')
+						unsealed['failed'] += 1
+				print(f"unsealed: {unsealed['ok']} ok, {unsealed['failed']} failed")
+				summary['unsealed'] = unsealed
+		finally:
+			self.Stop()
+		if report:
+			with open(report, 'w') as f:
+				json.dump(summary, f, indent=1)
+		return summary
 
 if __name__ == '__main__':
 
@@ -188,13 +419,52 @@ if __name__ == '__main__':
 	def cmd_ekbank_soakenroll(args):
 		cmd_ekbank_common(args)
 		args.bank.Initialize()
-		if args.loop < 1:
-			print(f"Error, illegal loop value ({args.loop})")
+		if args.rate <= 0 or args.duration <= 0:
+			print(f"Error, illegal rate/duration ({args.rate}/{args.duration})")
+			sys.exit(-1)
+		if args.workers < 1:
+			print(f"Error, illegal workers value ({args.workers})")
 			sys.exit(-1)
-		if args.threads < 1:
-			print(f"Error, illegal threads value ({args.threads})")
+		mix = {}
+		for item in args.mix.split(','):
+			op, _, weight = item.partition('=')
+			if op not in ('add', 'query', 'find', 'delete') or not weight.isdigit():
+				print(f"Error, illegal mix ({args.mix})")
+				sys.exit(-1)
+			mix[op] = int(weight)
+		if not any(mix.values()):
+			print(f"Error, illegal mix ({args.mix})")
 			sys.exit(-1)
-		args.bank.Soakenroll(args.loop, args.threads)
+		args.bank.Soakenroll(rate = args.rate,
+				     duration = args.duration,
+				     mix = mix,
+				     workers = args.workers,
+				     poisson = args.poisson,
+				     seed = args.seed,
+				     report = args.report)
+
+	def cmd_ekbank_soakattest(args):
+		cmd_ekbank_common(args)
+		args.bank.Initialize()
+		if not args.attest:
+			print("Error, no attestation URL was provided (--attest)")
+			sys.exit(-1)
+		if args.rate <= 0 or args.duration <= 0:
+			print(f"Error, illegal rate/duration ({args.rate}/{args.duration})")
+			sys.exit(-1)
+		summary = args.bank.Soakattest(args.attest,
+				rate = args.rate,
+				duration = args.duration,
+				quotes = args.quotes,
+				threads = args.threads,
+				workers = args.workers,
+				poisson = args.poisson,
+				unseal = args.unseal,
+				seed = args.seed,
+				report = args.report)
+		if any(k not in ('ok', 'refused') for k in summary['total']['outcomes']) or \
+		   summary.get('unsealed', {}).get('failed'):
+			sys.exit(1)
 
 	# Wrapper 'test' command
 	test_desc = 'Toolkit for testing HCP services and functions'
@@ -256,22 +526,101 @@ if __name__ == '__main__':
 
 	# ekbank::soakenroll
 	ekbank_soakenroll_help = 'Soak tests an Enrollment Service using a bank of sTPM instances'
-	ekbank_soakenroll_epilog = ''
-	ekbank_soakenroll_help_loop = 'number of iterations in the core loop'
-	ekbank_soakenroll_help_threads = 'number of core loops to run in parallel'
+	ekbank_soakenroll_epilog = """
+	Operations on the bank's sTPMs are started at '--rate' per second for
+	'--duration' seconds, regardless of how quickly the enrollment service
+	responds (an "open loop"), and the latency of each is measured from when it
+	was due to start, so that queueing delays are seen. '--mix' gives the share
+	of each kind of operation; add (enroll an unenrolled sTPM), query (by
+	ekpubhash), find (by hostname) and delete (unenroll). The throughput,
+	latency percentiles and outcomes of each kind are reported, and '--report'
+	writes them (with latency histograms) to a file as JSON, for comparing one
+	run with another.
+	"""
 	parser_ekbank_soakenroll = subparsers_ekbank.add_parser('soakenroll',
 						help = ekbank_soakenroll_help,
 						epilog = ekbank_soakenroll_epilog)
-	parser_ekbank_soakenroll.add_argument('--loop',
+	parser_ekbank_soakenroll.add_argument('--rate',
+					      type = float,
+					      default = 10,
+					      help = 'operations per second')
+	parser_ekbank_soakenroll.add_argument('--duration',
+					      type = float,
+					      default = 60,
+					      help = 'seconds to keep starting operations for')
+	parser_ekbank_soakenroll.add_argument('--mix',
+					      default = 'add=4,query=3,find=2,delete=1',
+					      help = 'relative shares of the operations (default: add=4,query=3,find=2,delete=1)')
+	parser_ekbank_soakenroll.add_argument('--poisson',
+					      action = 'store_true',
+					      help = 'start operations at random (exponentially distributed) intervals rather than evenly')
+	parser_ekbank_soakenroll.add_argument('--workers',
 					      type = int,
-					      default = 20,
-					      help = ekbank_soakenroll_help_loop)
-	parser_ekbank_soakenroll.add_argument('--threads',
+					      default = 16,
+					      help = 'largest number of operations in flight (and of connections)')
+	parser_ekbank_soakenroll.add_argument('--seed',
 					      type = int,
-					      default = 1,
-					      help = ekbank_soakenroll_help_threads)
+					      help = 'seed for choosing (and timing) the operations')
+	parser_ekbank_soakenroll.add_argument('--report', metavar='<FILE>',
+					      help = 'write the results to this file as JSON')
 	parser_ekbank_soakenroll.set_defaults(func = cmd_ekbank_soakenroll)
 
+	# ekbank::soakattest
+	ekbank_soakattest_help = 'Load tests an Attestation Service using a bank of sTPM instances'
+	ekbank_soakattest_epilog = """
+	Each sTPM in the bank (or the first '--quotes' of them) is started in its
+	own container, its PCRs are extended to match a made-up event log and it
+	produces a quote, including that event log. The quotes are then sent to the
+	attestation service at '--rate' per second for '--duration' seconds,
+	regardless of how quickly it responds (an "open loop"), and the latency of
+	each attestation is measured from when it was due to be sent. Quotes from
+	enrolled sTPMs (those that 'soakenroll' left enrolled) should succeed and the
+	others should be refused; the throughput, latency percentiles and mix of
+	results are reported for each. With '--unseal', one response for each
+	enrolled sTPM is then unsealed by that sTPM. If the attestation URL is not
+	supplied (via '--attest'), it will fallback to using the 'ATTESTSVC_API_URL'
+	environment variable. The command fails if any attestation had an
+	unexpected result.
+	"""
+	parser_ekbank_soakattest = subparsers_ekbank.add_parser('soakattest',
+						help = ekbank_soakattest_help,
+						epilog = ekbank_soakattest_epilog)
+	parser_ekbank_soakattest.add_argument('--attest', metavar='<URL>',
+					      default = os.environ.get('ATTESTSVC_API_URL'),
+					      help = 'URL of the attestation service')
+	parser_ekbank_soakattest.add_argument('--rate',
+					      type = float,
+					      default = 10,
+					      help = 'attestations per second')
+	parser_ekbank_soakattest.add_argument('--duration',
+					      type = float,
+					      default = 60,
+					      help = 'seconds to keep sending attestations for')
+	parser_ekbank_soakattest.add_argument('--poisson',
+					      action = 'store_true',
+					      help = 'send at random (exponentially distributed) intervals rather than evenly')
+	parser_ekbank_soakattest.add_argument('--quotes',
+					      type = int,
+					      default = 0,
+					      help = 'number of sTPMs to quote (default: all)')
+	parser_ekbank_soakattest.add_argument('--threads',
+					      type = int,
+					      default = 4,
+					      help = 'number of sTPMs to quote in parallel')
+	parser_ekbank_soakattest.add_argument('--workers',
+					      type = int,
+					      default = 64,
+					      help = 'largest number of attestations in flight')
+	parser_ekbank_soakattest.add_argument('--unseal',
+					      action = 'store_true',
+					      help = 'check the responses by unsealing them')
+	parser_ekbank_soakattest.add_argument('--seed',
+					      type = int,
+					      help = 'seed for choosing (and timing) the quotes to send')
+	parser_ekbank_soakattest.add_argument('--report', metavar='<FILE>',
+					      help = 'write the results to this file as JSON')
+	parser_ekbank_soakattest.set_defaults(func = cmd_ekbank_soakattest)
+
 	# Process the command line
 	func = None
 	args = parser.parse_args()
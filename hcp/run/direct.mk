@@ -79,11 +79,33 @@ HCP_RUN_ENROLL_SIGNER_AUTOCREATE ?= yes
 #HCP_RUN_ENROLL_UWSGI_OPTIONS ?= --processes 2 --threads 2
 #HCP_RUN_ENROLL_GITDAEMON ?= /usr/lib/git-core/git-daemon
 #HCP_RUN_ENROLL_GITDAEMON_FLAGS ?= --reuseaddr --verbose --listen=0.0.0.0 --port=9418
+#HCP_RUN_ENROLL_COMMIT_WINDOW ?= 20
+#HCP_RUN_ENROLL_COMMIT_MAX ?= 64
+#HCP_RUN_ENROLL_CACHE_MAX ?= 64
+#HCP_RUN_ENROLL_POOL ?= genrootfskey
+#HCP_RUN_ENROLL_POOL_LOW ?= 16
+#HCP_RUN_ENROLL_POOL_HIGH ?= 64
+#HCP_RUN_ENROLL_NOTIFY_PORT ?= 9419
+# "sqlite" keeps the enrollments in a single file rather than a directory per
+# TPM in the git repo, and replicates it with deltas (HCP_RUN_ATTEST_STORE must
+# match, and HCP_RUN_ATTEST_REMOTE_NOTIFY must be set), see
+# sbin/enroll_store.py.
+#HCP_RUN_ENROLL_STORE ?= dir
+# 1 or 2 splits the repo into 16 or 256 shards (each with its own lock and
+# commits) by that many leading hex digits of the ekpubhash, see
+# hcp/enrollsvc/shards.py. Fixed when the state is created, and
+# HCP_RUN_ATTEST_SHARD_DIGITS must match.
+#HCP_RUN_ENROLL_SHARD_DIGITS ?= 0
 HCP_RUN_ENROLL_XTRA_MGMT ?= --publish=5000:5000 --publish=5001:5001
-HCP_RUN_ENROLL_XTRA_REPL ?= --publish=9418:9418
+HCP_RUN_ENROLL_XTRA_REPL ?= --publish=9418:9418 --publish=9419:9419
 
 HCP_RUN_ATTEST_REMOTE_REPO ?= git://enrollsvc_repl/enrolldb
 HCP_RUN_ATTEST_UPDATE_TIMER ?= 10
+# Set to empty to have the updater poll every HCP_RUN_ATTEST_UPDATE_TIMER
+# seconds, rather than wait to be told of changes.
+HCP_RUN_ATTEST_REMOTE_NOTIFY ?= http://enrollsvc_repl:9419
+#HCP_RUN_ATTEST_STORE ?= dir
+#HCP_RUN_ATTEST_SHARD_DIGITS ?= 0
 #HCP_RUN_ATTEST_UWSGI ?= uwsgi_python3
 #HCP_RUN_ATTEST_UWSGI_PORT ?= 8080
 #HCP_RUN_ATTEST_UWSGI_FLAGS ?= --http :8080 --stats :8081
@@ -0,0 +1,229 @@
+"""
+Asynchronous front end for the Attestation Server.
+
+This serves the same API as sbin/attest-server-sub.py (which it loads for the
+actual work), but from an asyncio event loop rather than from uwsgi threads.
+Connections are cheap to hold open, while the verification and sealing of each
+quote is handed to a fixed-size pool of worker processes. The number of quotes
+waiting for a worker is bounded; past that, requests are answered immediately
+with "503 Service Unavailable" and a Retry-After header, rather than leaving
+the attesting machines to time out. The same goes for the memory held by the
+quotes of the requests being read or handled, which is bounded in bytes, so
+that slow uploads of large batches can't pile up while they're being read.
+
+This is launched from sbin/attest-server when SAFEBOOT_ATTEST_FRONTEND=async,
+see there for the environment variables.
+"""
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from aiohttp import web
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+import safeboot_metrics
+
+# Requests waiting for (or being handled by) a worker. This has to be declared
+# before the flask application is loaded, as that maps the metrics.
+pending_gauge = safeboot_metrics.registry.gauge('safeboot_attest_pending',
+	'Quotes queued for or being handled by a worker')
+
+# Load the flask application (as a plain module; its flask app isn't used) so
+# that the workers, which are forked from this process, inherit it along with
+# the trust store it loads and the metrics.
+spec = importlib.util.spec_from_file_location('attest_server_sub',
+	os.path.join(here, 'attest-server-sub.py'))
+sub = importlib.util.module_from_spec(spec)
+sys.modules['attest_server_sub'] = sub
+spec.loader.exec_module(sub)
+
+# Number of worker processes doing the verification and sealing
+workers = int(os.environ.get('SAFEBOOT_ATTEST_WORKERS', str(os.cpu_count() or 2)))
+
+# Number of quotes allowed to wait for a worker, beyond those being handled
+queue_depth = int(os.environ.get('SAFEBOOT_ATTEST_QUEUE', str(workers * 16)))
+
+# Seconds to tell the client to wait when the queue is full
+retry_after = int(os.environ.get('SAFEBOOT_ATTEST_RETRY_AFTER', '5'))
+
+# Most bytes of quotes held in memory, by the requests being read or handled
+max_buffered = int(os.environ.get('SAFEBOOT_ATTEST_MAX_BUFFERED', str(4 * sub.max_batch_bytes)))
+
+# Raised when a request would go past max_buffered
+class Busy(Exception):
+	pass
+
+class Server:
+	def __init__(self, workers, queue_depth, max_buffered):
+		self.workers = workers
+		self.limit = workers + queue_depth
+		self.pending = 0
+		self.max_buffered = max_buffered
+		self.buffered = 0
+		self.pool = self.new_pool()
+
+	def new_pool(self):
+		return ProcessPoolExecutor(self.workers,
+			mp_context=multiprocessing.get_context('fork'))
+
+	# Run attest_verify() in a worker. Returns None if the queue is full.
+	async def attest(self, quote_data):
+		if self.pending >= self.limit:
+			return None
+		self.pending += 1
+		pending_gauge.inc()
+		pool = self.pool
+		try:
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(pool, sub.attest_verify, quote_data)
+		except BrokenProcessPool:
+			# a worker died (the OOM killer?), so start over with a
+			# fresh pool and fail this request. Every request that
+			# was in the broken pool gets here, but only the first
+			# replaces it.
+			if self.pool is pool:
+				logging.error("worker pool broken, restarting it")
+				self.pool = self.new_pool()
+				pool.shutdown(wait=False, cancel_futures=True)
+			return (500, "ATTEST_WORKER FAILED")
+		finally:
+			self.pending -= 1
+			pending_gauge.dec()
+
+	def busy(self):
+		sub.results.inc('busy')
+		return web.json_response({ "error": "server busy" }, status=503,
+			headers={ 'Retry-After': str(retry_after) })
+
+	# Run a batch of quotes through the workers, as for attest(), but with
+	# each quote failing on its own. Returns None if there isn't room in
+	# the queue for all of them.
+	async def attest_batch(self, quotes):
+		if self.pending + len(quotes) > self.limit:
+			return None
+		results = await asyncio.gather(*[ self.attest(q) for q in quotes ],
+			return_exceptions=True)
+		for i, result in enumerate(results):
+			if isinstance(result, BaseException):
+				logging.error(f"batch: unable to verify quote: {result!r}")
+				results[i] = (500, "ATTEST_FAILED")
+			elif result is None:
+				# the queue filled up underneath us
+				sub.results.inc('busy')
+				results[i] = (503, "ATTEST_BUSY")
+		return results
+
+	# The bytes of quotes a request holds, which count against
+	# max_buffered until it is done with them (see take())
+	@contextmanager
+	def holding(self):
+		held = [ 0 ]
+		try:
+			yield held
+		finally:
+			self.buffered -= held[0]
+
+	def take(self, held, n):
+		if self.buffered + n > self.max_buffered:
+			raise Busy()
+		self.buffered += n
+		held[0] += n
+
+	# Read the `quote` parts of the multipart form into memory, returning
+	# a list of (filename, data). Each quote is limited to max_quote_size,
+	# and all of them together to max_batch_bytes, as they are read.
+	async def read_quotes(self, request, limit, held):
+		quotes = []
+		total = 0
+		reader = await request.multipart()
+		async for part in reader:
+			if part.name != 'quote':
+				continue
+			if len(quotes) == limit:
+				raise web.HTTPBadRequest()
+			quote_data = bytearray()
+			while True:
+				chunk = await part.read_chunk()
+				if not chunk:
+					break
+				quote_data += chunk
+				total += len(chunk)
+				if len(quote_data) > sub.max_quote_size:
+					raise web.HTTPRequestEntityTooLarge(sub.max_quote_size, len(quote_data))
+				if total > sub.max_batch_bytes:
+					raise web.HTTPRequestEntityTooLarge(sub.max_batch_bytes, total)
+				self.take(held, len(chunk))
+			quotes.append((part.filename, bytes(quote_data)))
+		return quotes
+
+	async def home_get(self, request):
+		return web.json_response({ "error": "GET request, but this service only supports POST" })
+
+	async def home_post(self, request):
+		# refuse early, before reading the quote
+		if self.pending >= self.limit:
+			return self.busy()
+		with self.holding() as held:
+			try:
+				quotes = await self.read_quotes(request, 1, held)
+			except Busy:
+				return self.busy()
+			except (ValueError, AssertionError):
+				quotes = []
+			if len(quotes) == 0:
+				raise web.HTTPInternalServerError()
+			result = await self.attest(quotes[0][1])
+		if result is None:
+			return self.busy()
+		rcode, rbody = result
+		if rcode != 200:
+			return web.json_response({ "error": "attestation failed" })
+		return web.Response(body=rbody, content_type='application/octet-stream')
+
+	async def batch_post(self, request):
+		if self.pending >= self.limit:
+			return self.busy()
+		with self.holding() as held:
+			try:
+				quotes = await self.read_quotes(request, sub.max_batch, held)
+			except Busy:
+				return self.busy()
+			except (ValueError, AssertionError):
+				raise web.HTTPBadRequest()
+			if len(quotes) == 0:
+				raise web.HTTPBadRequest()
+			results = await self.attest_batch([ q for _, q in quotes ])
+		if results is None:
+			return self.busy()
+		ctype, body = sub.batch_response([ n for n, _ in quotes ], results)
+		return web.Response(body=body, headers={ 'Content-Type': ctype })
+
+	# Served by the event loop from the shared map, without involving the
+	# workers
+	async def metrics_get(self, request):
+		return web.Response(text=safeboot_metrics.registry.render(),
+			headers={ 'Content-Type': safeboot_metrics.CONTENT_TYPE })
+
+	def app(self):
+		app = web.Application(client_max_size=sub.max_quote_size)
+		app.router.add_get('/', self.home_get)
+		app.router.add_post('/', self.home_post)
+		app.router.add_post('/batch', self.batch_post)
+		app.router.add_get('/metrics', self.metrics_get)
+		return app
+
+if __name__ == '__main__':
+	from sys import argv
+	logging.basicConfig(level=logging.INFO)
+
+	port = int(argv[1]) if len(argv) > 1 else 8080
+	server = Server(workers, queue_depth, max_buffered)
+	logging.info(f"{workers} workers, {queue_depth} queued requests, {max_buffered} bytes buffered")
+	web.run_app(server.app(), port=port)
@@ -6,48 +6,235 @@ This is a python flask server implementing a single API end-point. This is launc
 explanation about the functionality.
 """
 import flask
-from flask import request, abort, send_file
+from flask import request, abort
 import subprocess
 import os, sys
-from stat import *
+import io
+import json
+import uuid
+import importlib.machinery, importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from markupsafe import escape
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import tempfile
 import logging
 import yaml
 import hashlib
 
+# The in-process verification code lives next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tpm2_quote
+import ek_trust
+import tpm2_eventlog
+import tpm2_seal
+import safeboot_metrics
+
+# The policy half of sbin/attest-verify, so that it can be applied without
+# forking it for each quote
+attest_policy_loader = importlib.machinery.SourceFileLoader('attest_policy',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attest-verify'))
+attest_policy = importlib.util.module_from_spec(
+	importlib.util.spec_from_loader('attest_policy', attest_policy_loader))
+attest_policy_loader.exec_module(attest_policy)
+
 # hard code the hashing algorithm used
 alg = 'sha256'
 
-# This subroutine is the meat in the sandwich. Its only argument is a path to
-# the input tarball (the "quotefile") that was received from the attesting
-# host/client, and it returns a 2-tuple of status code and response tarball (as
-# a byte array, not a path) for returning to the host/client. This function is
-# called by the flask-handling code further down, which extracts the input
-# tarball from the http request and returns the output tarball in the http
-# response.
+# How the quote gets verified. "native" does the work of `tpm2-attest verify`
+# in this process (see sbin/tpm2_quote.py), "shell" forks `tpm2-attest verify`
+# and parses its YAML output. We fall back to the latter if the python
+# cryptography module isn't installed.
+verify_mode = os.environ.get('SAFEBOOT_ATTEST_VERIFY', 'native')
+if verify_mode == 'native' and not tpm2_quote.have_crypto:
+	logging.warning("python3-cryptography not found, using 'tpm2-attest verify'")
+	verify_mode = 'shell'
 
-def attest_verify(quote_file):
-	# verify that the Endorsment Key came from an authorized TPM,
-	# that the quote is signed by a valid Attestation Key
+# How the response gets sealed. "native" does the work of `tpm2-attest seal`
+# in this process (see sbin/tpm2_seal.py), "shell" forks it.
+seal_mode = os.environ.get('SAFEBOOT_ATTEST_SEAL', 'native')
+if seal_mode == 'native' and not tpm2_seal.have_crypto:
+	seal_mode = 'shell'
+
+# Quotes and sealed responses are kept in memory. If this is set to a
+# directory, each request instead gets a subdirectory there with the quote,
+# the verified quote YAML and the response, which are left behind for
+# debugging.
+debug_dir = os.environ.get('SAFEBOOT_ATTEST_DEBUG_DIR')
+
+# Largest quote we'll accept (the eventlog and IMA log make up most of it)
+max_quote_size = int(os.environ.get('SAFEBOOT_ATTEST_MAX_QUOTE', str(16 << 20)))
+
+# Largest number of quotes accepted in one request to /batch, and the largest
+# request (all of its quotes together, which are held in memory), enforced as
+# it is read
+max_batch = int(os.environ.get('SAFEBOOT_ATTEST_MAX_BATCH', '256'))
+max_batch_bytes = int(os.environ.get('SAFEBOOT_ATTEST_MAX_BATCH_BYTES', str(64 << 20)))
+
+# The threads verifying the quotes of a batch. They share the worker's GIL, so
+# they only overlap where it is released (the subprocesses of the shell modes,
+# hashing and the cryptography module's OpenSSL calls); the eventlog replay and
+# the policy run one at a time. The async front end runs each quote of a batch
+# in a worker process of its own instead.
+batch_threads = int(os.environ.get('SAFEBOOT_ATTEST_BATCH_THREADS', str(os.cpu_count() or 2)))
+batch_pool = ThreadPoolExecutor(batch_threads)
+
+# Where the time goes in attest_verify(), and how it turns out. These are
+# shared by all of the workers (see sbin/safeboot_metrics.py) and served on
+# /metrics.
+metrics = safeboot_metrics.registry
+stage_seconds = metrics.histogram('safeboot_attest_stage_seconds',
+	'Time spent in each stage of verifying a quote and sealing the response',
+	'stage', [ 'quote_verify', 'ek_verify', 'eventlog_replay', 'policy', 'seal' ])
+request_seconds = metrics.histogram('safeboot_attest_request_seconds',
+	'Time spent handling each quote')
+results = metrics.counter('safeboot_attest_results_total',
+	'Quotes handled, by result',
+	'result', [ 'ok', 'verify_failed', 'seal_failed', 'error', 'busy' ])
+in_flight = metrics.gauge('safeboot_attest_in_flight',
+	'Quotes being verified or sealed')
+result_names = {
+	200: 'ok',
+	"ATTEST_VERIFY FAILED": 'verify_failed',
+	"ATTEST_SEAL FAILED": 'seal_failed',
+}
+
+# The EK certificates are loaded and indexed once per worker, rather than by
+# `openssl verify` for each quote. The store notices when `refresh-certs`
+# updates the certs directory and reloads itself.
+ek_store = None
+if verify_mode == 'native':
+	ek_store = ek_trust.TrustStore()
+
+# The shell tools still want a quote file name, so give them /dev/fd/N of an
+# anonymous memory file rather than writing the quote out to tmpfs. Yields
+# the path and the file descriptors the subprocesses must inherit.
+@contextmanager
+def quote_path(quote_data, debug=None):
+	if debug is not None:
+		path = os.path.join(debug, 'quote.tar')
+		with open(path, 'wb') as f:
+			f.write(quote_data)
+		yield path, ()
+		return
+	fd = os.memfd_create('quote', 0)
+	try:
+		os.write(fd, quote_data)
+		os.lseek(fd, 0, os.SEEK_SET)
+		yield f"/dev/fd/{fd}", (fd,)
+	finally:
+		os.close(fd)
+
+# Run `tpm2-attest verify` and return a 2-tuple of whether it succeeded and
+# the parsed YAML from its stdout.
+def quote_verify_shell(quote_file, fds):
 	sub = subprocess.run(["./sbin/tpm2-attest", "verify", quote_file ],
 		stdout=subprocess.PIPE,
 		stderr=sys.stderr,
+		pass_fds=fds,
 	)
+	return sub.returncode == 0, yaml.safe_load(sub.stdout)
+
+# Validate the EK certificate against the preloaded trust store, falling back
+# to `tpm2-attest ek-verify` for certificates that it can't handle.
+def ek_verify(quote_file, fds, files):
+	try:
+		logging.info(f"{quote_file}: {ek_trust.verify(ek_store, files)}")
+		return True
+	except ek_trust.TrustUnsupported as e:
+		logging.info(f"{quote_file}: {e}, using 'tpm2-attest ek-verify'")
+	except ek_trust.TrustError as e:
+		logging.warning(f"{quote_file}: {e}")
+		return False
+
+	sub = subprocess.run(["./sbin/tpm2-attest", "ek-verify", quote_file ],
+		stdout=sys.stderr,
+		stderr=sys.stderr,
+		pass_fds=fds,
+	)
+	return sub.returncode == 0
+
+# The in-process equivalent of quote_verify_shell(), including replaying the
+# eventlog (if the quote contains one) into PCR values. The unpacked quote is
+# left in 'files' for sealing.
+def quote_verify_native(quote_file, fds, quote_data, files):
+	try:
+		with stage_seconds.time('quote_verify'):
+			files.update(tpm2_quote.unpack(io.BytesIO(quote_data)))
+			quote = tpm2_quote.verify(files)
+	except tpm2_quote.QuoteError as e:
+		logging.warning(f"{quote_file}: {e}")
+		return False, None
+	quote['eventlog-pcrs'] = None
+
+	if 'ek.crt' in files:
+		with stage_seconds.time('ek_verify'):
+			ek_valid = ek_verify(quote_file, fds, files)
+		if not ek_valid:
+			logging.warning(f"{quote_file}: unable to verify EK certificate")
+			return False, quote
+	else:
+		# this should be an optional die if the EK is not
+		# already known to the attestation server.
+		logging.warning(f"{quote_file}: no EK certificate")
+
+	# Note that the eventlog has not been verified by this stage, only
+	# that there was one.
+	if 'eventlog' in files:
+		try:
+			with stage_seconds.time('eventlog_replay'):
+				quote['eventlog-pcrs'] = tpm2_eventlog.replay(files['eventlog'])
+		except tpm2_eventlog.EventlogError as e:
+			logging.warning(f"{quote_file}: unable to parse eventlog: {e}")
+			return False, quote
+
+	return True, quote
+
+# This subroutine is the meat in the sandwich. Its only argument is the input
+# tarball (the "quotefile", as a byte array) that was received from the
+# attesting host/client, and it returns a 2-tuple of status code and response
+# tarball (also a byte array) for returning to the host/client. This function is
+# called by the flask-handling code further down, which extracts the input
+# tarball from the http request and returns the output tarball in the http
+# response.
 
-	quote_valid = sub.returncode == 0
+def attest_verify(quote_data, index=None):
+	debug = None
+	if debug_dir is not None:
+		debug = tempfile.mkdtemp(dir=debug_dir)
+	result = 'error'
+	try:
+		with in_flight.track(), request_seconds.time():
+			with quote_path(quote_data, debug) as (quote_file, fds):
+				rcode, rbody = attest_verify_quote(quote_file, fds, quote_data, debug, index)
+		result = result_names.get(rcode if rcode == 200 else rbody, 'error')
+		return (rcode, rbody)
+	finally:
+		results.inc(result)
 
-	# The output contains YAML formatted hash of the EK and the PCRs
-	quote = yaml.safe_load(sub.stdout)
+def attest_verify_quote(quote_file, fds, quote_data, debug, index):
+	# verify that the Endorsment Key came from an authorized TPM,
+	# that the quote is signed by a valid Attestation Key
+	files = {}
+	if verify_mode == 'native':
+		quote_valid, quote = quote_verify_native(quote_file, fds, quote_data, files)
+		if quote is None:
+			return (403, "ATTEST_VERIFY FAILED")
+	else:
+		with stage_seconds.time('quote_verify'):
+			quote_valid, quote = quote_verify_shell(quote_file, fds)
+
+	# The result contains the hash of the EK and the PCRs
 	if 'ekhash' in quote:
 		ekhash = quote['ekhash']
 	else:
 		quote_valid = False
 		ekhash = "UNKNOWN"
 
-	with open("/tmp/quote.yaml", "w") as y:
-		y.write(str(quote))
+	if debug is not None:
+		with open(os.path.join(debug, "quote.yaml"), "w") as y:
+			y.write(str(quote))
 
 	# Validate that the every computed PCR in the eventlog
 	# matches a quoted PCRs.
@@ -82,32 +269,130 @@ def attest_verify(quote_file):
 	# the quote, eventlog and PCRS are consistent, so ask the verifier to
 	# process the eventlog and decide if the eventlog meets policy for
 	# this ekhash.
-	sub = subprocess.run(["./sbin/attest-verify", "verify", str(quote_valid)],
-		input=bytes(str(quote), encoding="utf-8"),
-		stdout=subprocess.PIPE,
-		stderr=sys.stderr,
-	)
+	if verify_mode == 'native':
+		with stage_seconds.time('policy'):
+			if index is None:
+				index = attest_policy.current_index()
+			ekdir = attest_policy.policy(quote, str(quote_valid), index)
+			if ekdir is not None:
+				response = attest_policy.payload(ekhash, ekdir, index)
+		if ekdir is None:
+			return (403, "ATTEST_VERIFY FAILED")
+	else:
+		with stage_seconds.time('policy'):
+			sub = subprocess.run(["./sbin/attest-verify", "verify", str(quote_valid)],
+				input=bytes(str(quote), encoding="utf-8"),
+				stdout=subprocess.PIPE,
+				stderr=sys.stderr,
+			)
+
+		if sub.returncode != 0:
+			return (403, "ATTEST_VERIFY FAILED")
+
+		# read the (binary) response from the sub process stdout
+		response = sub.stdout
+
+	with stage_seconds.time('seal'):
+		sealed = seal(quote_file, fds, quote_data, files, response)
+	if sealed is None:
+		return (403, "ATTEST_SEAL FAILED")
+
+	if debug is not None:
+		with open(os.path.join(debug, "output"), "wb") as o:
+			o.write(sealed)
 
-	if sub.returncode != 0:
-		return (403, "ATTEST_VERIFY FAILED")
+	return (200, sealed)
 
-	# read the (binary) response from the sub process stdout
-	response = sub.stdout
+# Seal the response for the attesting host, returning the sealed tarball or
+# None. 'files' is the unpacked quote, if it has been unpacked already.
+def seal(quote_file, fds, quote_data, files, response):
+	if seal_mode == 'native':
+		try:
+			if not files:
+				files = tpm2_quote.unpack(io.BytesIO(quote_data))
+			return tpm2_seal.seal(files, response)
+		except (tpm2_seal.SealError, tpm2_quote.QuoteError) as e:
+			logging.warning(f"{quote_file}: unable to seal: {e}")
+			return None
 
 	result = subprocess.run(["./sbin/tpm2-attest", "seal", quote_file, ],
 		input=response,
-		capture_output=True
+		capture_output=True,
+		pass_fds=fds,
 	)
-
 	if result.returncode != 0:
-		return (403, "ATTEST_SEAL FAILED")
+		return None
+	return result.stdout
+
+# Verify a batch of quotes on batch_pool, sharing the trust store and the
+# enrollment index between them. Returns a list of 2-tuples as per
+# attest_verify(), one for each quote; a failure of one quote (even an
+# unexpected one) does not affect the others.
+def attest_verify_batch(quotes):
+	index = None
+	if verify_mode == 'native':
+		index = attest_policy.current_index()
+
+	def attest_one(quote_data):
+		try:
+			return attest_verify(quote_data, index)
+		except Exception:
+			logging.exception("batch: unable to verify quote")
+			return (500, "ATTEST_FAILED")
+
+	return list(batch_pool.map(attest_one, quotes))
 
-	return (200, result.stdout)
+# Build the multipart/mixed response to a batch, with one part for each quote
+# (in the same order as the request) that has either the sealed tarball or an
+# error. The part's X-Attest-Status header has the status from attest_verify()
+# and its filename is that of the quote. Returns the content type and body.
+def batch_response(names, results):
+	boundary = uuid.uuid4().hex
+	body = []
+	for name, (rcode, rbody) in zip(names, results):
+		if rcode == 200:
+			ctype = 'application/x-tar'
+		else:
+			ctype = 'application/json'
+			rbody = json.dumps({ "error": "attestation failed" }).encode()
+		body.append((f"--{boundary}\r\n"
+			f"Content-Type: {ctype}\r\n"
+			f"Content-Disposition: attachment; filename=\"{secure_filename(name or '')}\"\r\n"
+			f"X-Attest-Status: {rcode}\r\n"
+			"\r\n").encode())
+		body.append(rbody)
+		body.append(b"\r\n")
+	body.append(f"--{boundary}--\r\n".encode())
+	return f"multipart/mixed; boundary={boundary}", b''.join(body)
 
 # The flask details;
 
+# An uploaded quote, refused as it is read once it is larger than any quote
+# we'll accept
+class QuoteFile(io.BytesIO):
+    def write(self, data):
+        if self.tell() + len(data) > max_quote_size:
+            raise RequestEntityTooLarge()
+        return super().write(data)
+
+# Keep uploaded files in memory, rather than letting werkzeug spool the larger
+# ones to a temporary file. werkzeug refuses a request longer than
+# max_content_length as it reads it.
+class QuoteRequest(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return QuoteFile()
+
+    @property
+    def max_content_length(self):
+        if self.path == '/batch':
+            return max_batch_bytes
+        return max_quote_size
+
 app = flask.Flask(__name__)
 app.config["DEBUG"] = True
+app.config["MAX_CONTENT_LENGTH"] = max_quote_size
+app.request_class = QuoteRequest
 
 @app.route('/', methods=['GET'])
 def home_get():
@@ -117,30 +402,34 @@ def home_get():
 def home_post():
     if 'quote' not in request.files:
         abort(500)
-    f = request.files['quote']
-    # Create a temporary directory for the quote file, and make it world
-    # readable+executable. (This gets garbage collected after we're done, as do
-    # any files we put in there.) We may priv-sep the python API from the
-    # underlying safeboot routines at some point, by running the latter behind
-    # sudo as another user, so this ensures it would be able to read the quote
-    # file.
-    tf = tempfile.TemporaryDirectory()
-    s = os.stat(tf.name)
-    os.chmod(tf.name, s.st_mode | S_IROTH | S_IXOTH)
-    # Sanitize the user-supplied filename, append it to the temp directory
-    # path, and save the quote file.
-    p = os.path.join(tf.name, secure_filename(f.filename))
-    f.save(p)
-    # Pass the saved quote file (by path) to the attestation code
-    rcode, rbody = attest_verify(p)
+    # Pass the quote file (as bytes) to the attestation code
+    rcode, rbody = attest_verify(request.files['quote'].read())
     if (rcode != 200):
         return { "error": "attestation failed" }
-    # Put the output in a file in the temp directory and send it.
-    p = os.path.join(tf.name, 'output')
-    ofd = os.open(p, os.O_RDWR | os.O_CREAT)
-    os.write(ofd, rbody)
-    os.close(ofd)
-    return send_file(p)
+    # Stream the sealed output straight back
+    return flask.Response(rbody, mimetype='application/octet-stream')
+
+# The metrics, for Prometheus to scrape. Rendering them only reads the shared
+# map, so this doesn't get in the way of the attestations.
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+    return flask.Response(metrics.render(), content_type=safeboot_metrics.CONTENT_TYPE)
+
+@app.route('/batch', methods=['POST'])
+def batch_post():
+    # The quotes are all in `quote` fields, e.g. with
+    # curl -F quote=@host1.tar -F quote=@host2.tar ...
+    quotes = request.files.getlist('quote')
+    if len(quotes) == 0 or len(quotes) > max_batch:
+        abort(400)
+    results = attest_verify_batch([ f.read() for f in quotes ])
+    ctype, body = batch_response([ f.filename for f in quotes ], results)
+    return flask.Response(body, content_type=ctype)
+
+# Once all of the metrics have been declared, and before uwsgi forks the
+# workers (or the async front end forks its pool), map them. (The async front
+# end declares its own first.)
+metrics.open()
 
 if __name__ == "__main__":
     app.run()
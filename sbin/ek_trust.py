@@ -0,0 +1,352 @@
+"""
+Preloaded trust store for TPM Endorsement Key certificates.
+
+This is a python implementation of `tpm2-attest ek-verify` for use by the
+attestation server. Rather than have `openssl verify` reparse `roots.pem` and
+the c_rehash'd CApath on every request, the whole certs directory is loaded
+once and indexed by subject and by subject key identifier (to match the
+authority key identifier of the certificates they issued). Chains that have
+been validated are remembered in an LRU cache keyed by the hash of `ek.crt`,
+so repeat attestations from the same TPM skip chain building altogether.
+
+The store reloads itself when the certs directory changes, which is what
+`refresh-certs` does when it fetches new vendor certificates (it rewrites
+`roots.pem` and recreates the c_rehash symlinks).
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from tpm2_quote import QuoteError, TPM_ALG_RSA, TPM_ALG_ECC
+import tpm2_quote
+
+try:
+	from cryptography import x509
+	from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+	from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+	from cryptography.x509.oid import SignatureAlgorithmOID
+	have_crypto = True
+except ImportError:
+	have_crypto = False
+
+# Expected attributes for the endorsement key, in the order that `tpm2 print`
+# displays them. This must match EK_TYPE in sbin/tpm2-attest.
+EK_TYPE = 'fixedtpm|fixedparent|sensitivedataorigin|adminwithpolicy|restricted|decrypt'
+
+# Number of validated EK chains to remember, per worker
+EK_CACHE_SIZE = int(os.environ.get('SAFEBOOT_EK_CACHE_SIZE', '4096'))
+
+# How often (in seconds) to check whether the certs directory has changed
+RELOAD_CHECK_INTERVAL = 5
+
+# Longest chain we'll try to build, not counting the EK certificate
+MAX_DEPTH = 8
+
+pem_re = re.compile(rb'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', re.S)
+
+class TrustError(QuoteError):
+	pass
+
+# Raised for EK certificates we can't handle in python (unparseable DER,
+# signature algorithms we don't implement). The caller can fall back to
+# `tpm2-attest ek-verify`, which uses OpenSSL.
+class TrustUnsupported(TrustError):
+	pass
+
+# The equivalent of `safeboot_dir certs` in functions.sh, relative to the
+# directory this file was installed in.
+def default_certs_dir():
+	if 'SAFEBOOT_CERTS_DIR' in os.environ:
+		return os.environ['SAFEBOOT_CERTS_DIR']
+	top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	if top == '/usr' and os.path.isdir('/usr/libexec/safeboot'):
+		return '/usr/libexec/safeboot/certs'
+	if os.path.isdir(os.path.join(top, 'libexec')):
+		return os.path.join(top, 'libexec', 'certs')
+	return '/etc/safeboot/certs'
+
+# The safeboot CA certificate ($CERT in sbin/tpm2-attest), which signs the
+# EKs of TPMs that don't come with an OEM certificate (see `tpm2-attest
+# ek-sign`). sbin/attest-server exports $CERT as tpm2-attest works it out from
+# safeboot.conf and local.conf; a relative one is made absolute the same way.
+def default_safeboot_cert():
+	prefix = os.environ.get('PREFIX', '')
+	etc = os.environ.get('DIR', '/etc/safeboot')
+	cert = os.environ.get('CERT')
+	if not cert:
+		return prefix + etc + '/cert.pem'
+	if not cert.startswith('/'):
+		return prefix + etc + '/' + cert
+	return cert
+
+def not_before(cert):
+	if hasattr(cert, 'not_valid_before_utc'):
+		return cert.not_valid_before_utc
+	return cert.not_valid_before.replace(tzinfo=timezone.utc)
+
+def not_after(cert):
+	if hasattr(cert, 'not_valid_after_utc'):
+		return cert.not_valid_after_utc
+	return cert.not_valid_after.replace(tzinfo=timezone.utc)
+
+def valid_at(cert, now):
+	return not_before(cert) <= now <= not_after(cert)
+
+def fingerprint(cert):
+	return hashlib.sha256(cert.tbs_certificate_bytes + cert.signature).digest()
+
+def extension(cert, oid_class):
+	try:
+		return cert.extensions.get_extension_for_class(oid_class).value
+	except x509.ExtensionNotFound:
+		return None
+
+# As `openssl verify` has it; a v3 certificate is only a CA if its basic
+# constraints say so, a v1 certificate (which can't) if it is self-issued.
+def is_ca(cert):
+	bc = extension(cert, x509.BasicConstraints)
+	if bc is not None:
+		return bc.ca
+	return cert.version == x509.Version.v1 and cert.issuer == cert.subject
+
+# The signature schemes that signed_by() implements, which are the ones that
+# TPM vendors use (PKCS#1 v1.5 RSA and ECDSA)
+if have_crypto:
+	SIGNATURE_ALGORITHMS = {
+		SignatureAlgorithmOID.RSA_WITH_SHA1,
+		SignatureAlgorithmOID.RSA_WITH_SHA224,
+		SignatureAlgorithmOID.RSA_WITH_SHA256,
+		SignatureAlgorithmOID.RSA_WITH_SHA384,
+		SignatureAlgorithmOID.RSA_WITH_SHA512,
+		SignatureAlgorithmOID.ECDSA_WITH_SHA1,
+		SignatureAlgorithmOID.ECDSA_WITH_SHA224,
+		SignatureAlgorithmOID.ECDSA_WITH_SHA256,
+		SignatureAlgorithmOID.ECDSA_WITH_SHA384,
+		SignatureAlgorithmOID.ECDSA_WITH_SHA512,
+	}
+
+# Check that `issuer` signed `cert`. Any other scheme (RSA-PSS, say) raises
+# TrustUnsupported, for OpenSSL to check.
+def signed_by(cert, issuer):
+	if cert.issuer != issuer.subject:
+		return False
+	if cert.signature_algorithm_oid not in SIGNATURE_ALGORITHMS:
+		raise TrustUnsupported(f"{cert.subject.rfc4514_string()}: unsupported signature "
+			f"algorithm {cert.signature_algorithm_oid.dotted_string}")
+	key = issuer.public_key()
+	try:
+		h = cert.signature_hash_algorithm
+		if isinstance(key, rsa.RSAPublicKey):
+			key.verify(cert.signature, cert.tbs_certificate_bytes, padding.PKCS1v15(), h)
+		elif isinstance(key, ec.EllipticCurvePublicKey):
+			key.verify(cert.signature, cert.tbs_certificate_bytes, ec.ECDSA(h))
+		else:
+			raise TrustUnsupported(f"{issuer.subject.rfc4514_string()}: unsupported key type")
+	except UnsupportedAlgorithm as e:
+		raise TrustUnsupported(f"{cert.subject.rfc4514_string()}: {e}")
+	except (InvalidSignature, ValueError):
+		return False
+	return True
+
+# EK certificates read from the TPM NV index are often padded out to the
+# size of the index; like `openssl x509 -inform DER`, ignore anything after
+# the outer SEQUENCE.
+def der_trim(der):
+	if len(der) < 2 or der[0] != 0x30:
+		return der
+	n = der[1]
+	if n < 0x80:
+		return der[:2 + n]
+	nbytes = n & 0x7f
+	length = int.from_bytes(der[2:2 + nbytes], 'big')
+	return der[:2 + nbytes + length]
+
+# Read every certificate (PEM, possibly several per file, or DER) in a file
+def load_certs(path):
+	with open(path, 'rb') as f:
+		data = f.read()
+	blocks = pem_re.findall(data)
+	try:
+		if blocks:
+			return [ x509.load_pem_x509_certificate(b) for b in blocks ]
+		return [ x509.load_der_x509_certificate(der_trim(data)) ]
+	except ValueError:
+		return []
+
+class TrustStore:
+	def __init__(self, certs_dir=None, safeboot_cert=None, cache_size=EK_CACHE_SIZE):
+		self.certs_dir = certs_dir or default_certs_dir()
+		self.safeboot_cert = safeboot_cert or default_safeboot_cert()
+		self.cache_size = cache_size
+		self.lock = threading.Lock()
+		self.stamp = None
+		self.checked = 0
+		self.load()
+
+	# The state that `refresh-certs` changes; the directory itself (c_rehash
+	# recreates the symlinks) and roots.pem (which is rewritten each time).
+	def current_stamp(self):
+		stamp = []
+		for p in (self.certs_dir, os.path.join(self.certs_dir, 'roots.pem'),
+			  self.safeboot_cert):
+			try:
+				st = os.stat(p)
+				stamp.append((st.st_mtime_ns, st.st_ino, st.st_size))
+			except OSError:
+				stamp.append(None)
+		return stamp
+
+	def load(self):
+		by_subject = {}
+		by_ski = {}
+		by_fp = {}
+		anchors = {}
+		stamp = self.current_stamp()
+		paths = []
+		if os.path.isdir(self.certs_dir):
+			paths = [ os.path.join(self.certs_dir, n) for n in sorted(os.listdir(self.certs_dir)) ]
+		for path in paths:
+			if not os.path.isfile(path):
+				continue
+			for cert in load_certs(path):
+				fp = fingerprint(cert)
+				if fp in by_fp:
+					continue
+				by_fp[fp] = cert
+				by_subject.setdefault(cert.subject.public_bytes(), []).append(cert)
+				ski = extension(cert, x509.SubjectKeyIdentifier)
+				if ski is not None:
+					by_ski.setdefault(ski.digest, []).append(cert)
+		if os.path.isfile(self.safeboot_cert):
+			for cert in load_certs(self.safeboot_cert):
+				anchors[fingerprint(cert)] = cert
+		self.by_subject = by_subject
+		self.by_ski = by_ski
+		self.by_fp = by_fp
+		self.anchors = anchors
+		self.cache = OrderedDict()
+		self.stamp = stamp
+
+	# Reload if the certs directory has changed, at most once every
+	# RELOAD_CHECK_INTERVAL seconds. Must be called with the lock held.
+	def maybe_reload(self):
+		now = time.monotonic()
+		if now - self.checked < RELOAD_CHECK_INTERVAL:
+			return
+		self.checked = now
+		if self.current_stamp() != self.stamp:
+			self.load()
+
+	def issuers(self, cert):
+		found = []
+		aki = extension(cert, x509.AuthorityKeyIdentifier)
+		if aki is not None and aki.key_identifier is not None:
+			found += self.by_ski.get(aki.key_identifier, [])
+		for c in self.by_subject.get(cert.issuer.public_bytes(), []):
+			if c not in found:
+				found.append(c)
+		return found
+
+	# Depth-first search for a path from `cert` to a self-signed
+	# certificate in the store. Like `openssl verify -CApath`, every
+	# certificate in the certs directory is trusted as a CA, but the chain
+	# must end at a self-signed one. Returns the chain (not including
+	# `cert`) or None. If there isn't one, but there might have been along
+	# a path with a signature we can't check, raises TrustUnsupported.
+	def build(self, cert, now, depth=0):
+		unsupported = None
+		try:
+			if fingerprint(cert) in self.by_fp and signed_by(cert, cert):
+				return []
+		except TrustUnsupported as e:
+			unsupported = e
+		if depth > MAX_DEPTH:
+			return None
+		for issuer in self.issuers(cert):
+			if issuer is cert or not is_ca(issuer) or not valid_at(issuer, now):
+				continue
+			try:
+				if not signed_by(cert, issuer):
+					continue
+				chain = self.build(issuer, now, depth + 1)
+			except TrustUnsupported as e:
+				unsupported = e
+				continue
+			if chain is not None:
+				return [ issuer ] + chain
+		if unsupported is not None:
+			raise unsupported
+		return None
+
+	# Validate the EK certificate (DER, as read from the TPM NV index).
+	# Returns a description of how it was validated, or raises TrustError.
+	def verify_cert(self, ek_crt, now=None):
+		key = hashlib.sha256(ek_crt).digest()
+		if now is None:
+			now = datetime.now(timezone.utc)
+		with self.lock:
+			self.maybe_reload()
+			hit = self.cache.get(key)
+			if hit is not None and hit[0] <= now <= hit[1]:
+				self.cache.move_to_end(key)
+				return hit[2]
+		try:
+			cert = x509.load_der_x509_certificate(der_trim(ek_crt))
+		except ValueError as e:
+			raise TrustUnsupported(f"ek.crt: unable to parse: {e}")
+		if not valid_at(cert, now):
+			raise TrustError("ek.crt: certificate is not valid at this time")
+
+		# check to see if the EK was signed with the safeboot key, which
+		# happens if this the TPM did not include its own OEM cert
+		chain = None
+		for anchor in self.anchors.values():
+			if valid_at(anchor, now) and signed_by(cert, anchor):
+				chain = [ anchor ]
+				how = "safeboot cert"
+				break
+		if chain is None:
+			chain = self.build(cert, now)
+			how = "SSL cert"
+		if chain is None:
+			raise TrustError("ek.crt: SSL verification failure")
+
+		# Remember the window during which the whole chain is valid
+		how = f"ek.crt certificate validated with {how}: " + \
+			" <- ".join(c.subject.rfc4514_string() for c in chain)
+		start = max(not_before(c) for c in [ cert ] + chain)
+		end = min(not_after(c) for c in [ cert ] + chain)
+		with self.lock:
+			self.cache[key] = (start, end, how)
+			self.cache.move_to_end(key)
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return how
+
+# This is `tpm2-attest ek-verify`; validate the EK certificate chain, check
+# that ek.pub has the proper key attributes, and that it is the same key as
+# the one in the certificate. `files` is the output of tpm2_quote.unpack().
+def verify(store, files, now=None):
+	how = store.verify_cert(files['ek.crt'], now)
+
+	# make sure the EK has the proper key attributes
+	ek = tpm2_quote.parse_tpm2b_public(files['ek.pub'], 'ek.pub')
+	if not tpm2_quote.attributes_str(ek['attributes']).startswith(EK_TYPE):
+		raise TrustError("ek.pub: unexpected EK key parameters")
+
+	# make sure that the keys are the same
+	key = x509.load_der_x509_certificate(der_trim(files['ek.crt'])).public_key()
+	if ek['type'] == TPM_ALG_RSA and isinstance(key, rsa.RSAPublicKey):
+		same = key.public_numbers().n == int.from_bytes(ek['modulus'], 'big')
+	elif ek['type'] == TPM_ALG_ECC and isinstance(key, ec.EllipticCurvePublicKey):
+		n = key.public_numbers()
+		same = (n.x, n.y) == (int.from_bytes(ek['x'], 'big'), int.from_bytes(ek['y'], 'big'))
+	else:
+		same = False
+	if not same:
+		raise TrustError("ek.crt and ek.pub have different keys")
+	return how
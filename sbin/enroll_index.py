@@ -0,0 +1,696 @@
+"""
+Memory-mapped index of the enrollment database.
+
+Looking up an enrollment in a clone of the database means walking the 3-ply
+`ekpubhash/xx/xxxxxx/<32 hex>` directory tree (or the legacy `xx/<ekhash>`
+one) and opening `phase2`, `pcrs` and `tofu_pcrs` one after the other. The
+index built here replaces all of that with a binary search over a sorted
+table in a single file, which is built once per replicated commit and mapped
+read-only by every reader, so that they all share the same page cache.
+
+The file is laid out as;
+
+	header:  magic[8] count:u32 tofu_len:u32 tofu_off:u64 commit[40]
+		 sets_len:u32 sets_off:u64
+	records: key[16] flags:u32 len:u32 off:u64	(sorted by key)
+	blobs:   JSON objects with the enrolled directory, the digest of its
+		 golden PCR set and the names of the assets, referenced by
+		 (off,len) above
+	tofu:    the tofu_pcrs file, as JSON
+	sets:    JSON object of every golden PCR set, by digest
+
+where `key` is the first 16 bytes of the ekpubhash (the same truncation as
+the 3-ply directory names). All integers are little-endian.
+
+Golden PCR sets are interned; a fleet of identical machines has thousands of
+enrollments with the same golden values, which are stored once in the index,
+by the SHA-256 of their canonical form (see PCRSet), and parsed once by each
+reader when it maps the index, rather than once per attestation. An enrollment
+has its golden PCRs either in a `pcrs` file of its own, or by reference, with
+a `pcrset` file holding the digest of a set stored once in the database's
+`pcrsets` directory (see `attest-verify predictpcr-batch`). The `pcrs` file
+wins if there are both.
+
+The index lives in the `.git` directory of the clone it describes, so that
+`git clean` leaves it alone and it is swapped along with the clone. Each build
+writes a new file, so the file's identity (device and inode) names the
+generation of the clone that readers have mapped. A build starts from the
+index of the clone's last generation (or its twin's), and only scans the
+enrollments that `git diff` says have changed since the commit that index was
+built from; the database is only walked in full when there is no such index.
+
+Next to it is a store of secret bundles, the tarballs of the enrolled
+directories that are sealed and sent to attesting hosts, so that they aren't
+tarred up again for every attestation. The store is content-addressed by the
+key and the git tree hash of the enrolled directory, so that bundles can be
+carried over from an earlier generation (or the twin clone) for enrollments
+that haven't changed, and it is laid out as;
+
+	header:  magic[8] count:u32 pad:u32
+	records: key[16] tree[32] len:u32 off:u64	(sorted by key and tree)
+	blobs:   the tarballs, referenced by (off,len) above
+
+where `tree` is the tree hash, padded with zeroes for SHA-1 repositories.
+There are no bundles for enrollments still waiting for their TOFU PCRs to be
+written, since writing them changes the enrolled directory.
+"""
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import subprocess
+import tarfile
+import tempfile
+import yaml
+
+INDEX_NAME = 'safeboot-enroll.idx'
+MAGIC = b'SBENRIX2'
+
+header = struct.Struct('<8sIIQ40sIQ')
+record = struct.Struct('<16sIIQ')
+
+BUNDLES_NAME = 'safeboot-bundles.dat'
+BUNDLES_MAGIC = b'SBBNDL01'
+
+bundles_header = struct.Struct('<8sII')
+bundles_record = struct.Struct('<16s32sIQ')
+
+# Record flags
+PHASE2 = 1 << 0		# `phase2` exists in the enrolled directory
+PCRS = 1 << 1		# `pcrs` (or `pcrset`) exists and its golden set is indexed
+LEGACY = 1 << 2		# enrolled with the old `xx/<ekhash>` layout
+UNUSABLE = 1 << 3	# the golden PCRs can't be used, see scan_entry()
+
+def index_path(db_path):
+	return os.path.join(db_path, '.git', INDEX_NAME)
+
+def bundles_path(db_path):
+	return os.path.join(db_path, '.git', BUNDLES_NAME)
+
+# Where the golden PCR sets shared by enrollments are kept in the database
+PCRSETS_DIR = 'pcrsets'
+
+def pcrset_path(db_path, digest):
+	return os.path.join(db_path, PCRSETS_DIR, digest)
+
+# Find the commit checked out in a clone without forking git
+def head_commit(db_path):
+	git = os.path.join(db_path, '.git')
+	try:
+		with open(os.path.join(git, 'HEAD')) as f:
+			head = f.read().strip()
+		if not head.startswith('ref: '):
+			return head
+		ref = head[5:]
+		try:
+			with open(os.path.join(git, ref)) as f:
+				return f.read().strip()
+		except FileNotFoundError:
+			pass
+		with open(os.path.join(git, 'packed-refs')) as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) == 2 and fields[1] == ref:
+					return fields[0]
+	except OSError:
+		pass
+	return None
+
+# The tree hash of every directory in the commit checked out, by path. Returns
+# an empty dict if git can't tell us, in which case there are no bundles.
+def tree_hashes(db_path):
+	sub = subprocess.run([ 'git', '-C', db_path, 'ls-tree', '-r', '-t', '-z', 'HEAD' ],
+		stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL,
+	)
+	trees = {}
+	if sub.returncode != 0:
+		return trees
+	for line in sub.stdout.split(b'\0'):
+		if not line:
+			continue
+		meta, path = line.split(b'\t', 1)
+		_, kind, obj = meta.split()
+		if kind == b'tree':
+			trees[path.decode()] = bytes.fromhex(obj.decode()).ljust(32, b'\0')
+	return trees
+
+# The same as `tar cf - -C path .`, in memory
+def tar_dir(path):
+	out = io.BytesIO()
+	with tarfile.open(fileobj=out, mode='w', format=tarfile.GNU_FORMAT) as tf:
+		tf.add(path, arcname='.')
+	return out.getvalue()
+
+# yaml allows integer keys, JSON does not; keep the PCR values exactly as
+# they were parsed (int or str) so that pcr_validate() treats them the same.
+def encode_pcrs(doc):
+	if not isinstance(doc, dict) or not isinstance(doc.get('pcrs'), dict):
+		return None
+	pcrs = {}
+	for alg, values in doc['pcrs'].items():
+		if values is None:
+			values = {}
+		if not isinstance(values, dict):
+			return None
+		pcrs[alg] = [ [ pcr, values[pcr] ] for pcr in values ]
+	return pcrs
+
+# Hex digits of the values of each PCR bank, for writing them out
+PCR_DIGITS = { 'sha1': 40, 'sha256': 64, 'sha384': 96, 'sha512': 128 }
+
+# A golden PCR set, parsed once and shared by every enrollment that has it.
+# 'values' is { alg: { pcr: value } } with every value an int, which is what
+# pcr_validate() in attest-verify compares a quote against. 'text' is the
+# canonical form of the set, a `pcrs` YAML document with the algorithms and
+# PCRs in order and the values in hex (which YAML reads back as ints), and
+# 'digest' (the set's name) is its SHA-256.
+class PCRSet:
+	def __init__(self, values):
+		self.values = values
+		lines = [ 'pcrs:' ]
+		for alg in sorted(values):
+			lines.append(f"  {alg}:")
+			digits = PCR_DIGITS.get(alg, 0)
+			for pcr in sorted(values[alg]):
+				lines.append(f"    {pcr}: 0x{values[alg][pcr]:0{digits}x}")
+		self.text = ('\n'.join(lines) + '\n').encode()
+		self.digest = hashlib.sha256(self.text).hexdigest()
+
+	# The set in a parsed `pcrs` document, or None if it is unusual (see
+	# scan_entry()). Raises ValueError if a value is not usable.
+	@classmethod
+	def from_doc(cls, doc):
+		pcrs = encode_pcrs(doc)
+		if pcrs is None:
+			return None
+		return cls.from_encoded(pcrs)
+
+	# The same, from the JSON of encode_pcrs()
+	@classmethod
+	def from_encoded(cls, pcrs):
+		values = {}
+		for alg, pairs in pcrs.items():
+			values[alg] = {}
+			for pcr, value in pairs:
+				if not isinstance(pcr, int):
+					raise ValueError(f"bad golden PCR index {pcr!r}")
+				if isinstance(value, str):
+					value = int(value, 16)
+				elif not isinstance(value, int):
+					raise ValueError(f"bad golden PCR {value!r}")
+				values[alg][pcr] = value
+		return cls(values)
+
+	def encode(self):
+		return { alg: [ [ pcr, value ] for pcr, value in sorted(values.items()) ]
+			for alg, values in self.values.items() }
+
+def check_digest(digest):
+	if len(digest) != 64 or digest.strip('0123456789abcdef'):
+		raise ValueError(f"bad golden PCR set digest {digest!r}")
+	return digest
+
+# Read a set from the database's `pcrsets` directory, checking that it is the
+# one its name says
+def read_pcrset(db_path, digest):
+	path = pcrset_path(db_path, check_digest(digest))
+	with open(path, 'rb') as f:
+		text = f.read()
+	if hashlib.sha256(text).hexdigest() != digest:
+		raise ValueError(f"{path}: golden PCR set does not match its digest")
+	pcrset = PCRSet.from_doc(yaml.safe_load(text))
+	if pcrset is None:
+		raise ValueError(f"{path}: not a golden PCR set")
+	return pcrset
+
+# Store a set in the database's `pcrsets` directory, if it isn't there
+# already, returning its digest
+def write_pcrset(db_path, pcrset):
+	path = pcrset_path(db_path, pcrset.digest)
+	if not os.path.exists(path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		write_file(path, [ pcrset.text ])
+	return pcrset.digest
+
+# The golden PCRs of an enrollment that has them, but not in a form that can be
+# used (bad values, or a `pcrset` that's missing or doesn't match its digest).
+# 'error' says what is wrong, if known.
+class Unusable:
+	def __init__(self, error=None):
+		self.error = error
+
+# 'sets' collects the golden PCR sets found, by digest, so that enrollments
+# with the same golden values share one
+def scan_entry(db_path, ekdir, flags, sets):
+	assets = sorted(os.listdir(os.path.join(db_path, ekdir)))
+	entry = { 'dir': ekdir, 'assets': assets }
+	if 'phase2' in assets:
+		flags |= PHASE2
+	pcrset = None
+	try:
+		if 'pcrs' in assets:
+			with open(os.path.join(db_path, ekdir, 'pcrs')) as f:
+				doc = yaml.safe_load(f)
+			if doc is None:
+				entry['pcrset'] = None
+				flags |= PCRS
+			else:
+				pcrset = PCRSet.from_doc(doc)
+				# anything unusual is left for the reader to parse
+				if pcrset is None:
+					return flags, entry
+		elif 'pcrset' in assets:
+			with open(os.path.join(db_path, ekdir, 'pcrset')) as f:
+				digest = f.read().strip()
+			pcrset = sets.get(digest) or read_pcrset(db_path, digest)
+	except (OSError, ValueError, yaml.YAMLError) as e:
+		# One bad enrollment mustn't keep the clone from being swapped
+		# in (holding up every other change), so it is indexed as
+		# unusable, and rejected when it attests.
+		logging.warning(f"{ekdir}: unusable golden PCRs: {e}")
+		entry['pcrset'] = None
+		entry['error'] = str(e)
+		return flags | PCRS | UNUSABLE, entry
+	if pcrset is not None:
+		entry['pcrset'] = sets.setdefault(pcrset.digest, pcrset).digest
+		flags |= PCRS
+	return flags, entry
+
+# (lower case only, as the directories are named, see ply_path_add in
+# common_defs.sh)
+def is_hex(name):
+	return not name.strip('0123456789abcdef')
+
+# Walk the enrollment database once and collect every enrollment
+def scan(db_path, sets):
+	entries = {}
+	root = os.path.join(db_path, 'ekpubhash')
+	if os.path.isdir(root):
+		# (skipping anything that isn't a ply directory or an enrolled
+		# directory, such as ekpubhash/do_not_remove, or a name that isn't
+		# hex, which would otherwise fail the whole build)
+		for ply1 in os.listdir(root):
+			if len(ply1) != 2 or not os.path.isdir(os.path.join(root, ply1)):
+				continue
+			for ply2 in os.listdir(os.path.join(root, ply1)):
+				if not os.path.isdir(os.path.join(root, ply1, ply2)):
+					continue
+				for name in os.listdir(os.path.join(root, ply1, ply2)):
+					ekdir = os.path.join('ekpubhash', ply1, ply2, name)
+					if len(name) != 32 or not is_hex(name) or \
+							not os.path.isdir(os.path.join(db_path, ekdir)):
+						continue
+					entries[bytes.fromhex(name)] = scan_entry(db_path, ekdir, 0, sets)
+
+	# the old layout is only used for hashes not in the new one
+	for ply1 in os.listdir(db_path):
+		if len(ply1) != 2 or not os.path.isdir(os.path.join(db_path, ply1)):
+			continue
+		for name in os.listdir(os.path.join(db_path, ply1)):
+			ekdir = os.path.join(ply1, name)
+			if len(name) != 64 or not is_hex(name) or \
+					not os.path.isdir(os.path.join(db_path, ekdir)):
+				continue
+			key = bytes.fromhex(name[0:32])
+			if key not in entries:
+				entries[key] = scan_entry(db_path, ekdir, LEGACY, sets)
+	return entries
+
+# The paths that differ between a commit and the one checked out, or None if
+# git can't tell us (the commit isn't in the clone, say)
+def changed_paths(db_path, commit):
+	sub = subprocess.run([ 'git', '-C', db_path, 'diff', '--name-only', '--no-renames', '-z',
+			commit, 'HEAD', '--' ],
+		stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL,
+	)
+	if sub.returncode != 0:
+		return None
+	return [ path.decode() for path in sub.stdout.split(b'\0') if path ]
+
+# The tree hashes of some of the directories in the commit checked out, as
+# tree_hashes() gives for all of them
+def tree_hashes_of(db_path, dirs):
+	sub = subprocess.run([ 'git', '-C', db_path, 'cat-file', '--batch-check' ],
+		input=''.join(f"HEAD:{ekdir}\n" for ekdir in dirs).encode(),
+		stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL,
+	)
+	trees = {}
+	if sub.returncode != 0:
+		return trees
+	for ekdir, line in zip(dirs, sub.stdout.decode().splitlines()):
+		fields = line.split()
+		if len(fields) == 3 and fields[1] == 'tree':
+			trees[ekdir] = bytes.fromhex(fields[0]).ljust(32, b'\0')
+	return trees
+
+# The index of an earlier generation of the clone (or of its twin, in 'reuse')
+# to build on, and the paths changed since the commit it was built from. Both
+# are None if there isn't one that git can diff against.
+def base_index(db_path, reuse):
+	for other in [ db_path ] + list(reuse):
+		try:
+			index = Index(other)
+		except (OSError, ValueError):
+			continue
+		if index.commit == '':
+			continue
+		changed = changed_paths(db_path, index.commit)
+		if changed is not None:
+			return index, changed
+	return None, None
+
+# Scan the enrollment with this key again, in whichever of the directories it
+# might be in is there; those the changed paths were in, then where
+# ply_path_add (in common_defs.sh) puts it, then the old layout. Returns None
+# if it is no longer enrolled.
+def rescan_entry(db_path, key, dirs, sets):
+	name = key.hex()
+	ekdirs = sorted(ekdir for ekdir in dirs if ekdir.startswith('ekpubhash/'))
+	ekdirs.append(os.path.join('ekpubhash', name[0:2], name[0:6], name))
+	for ekdir in ekdirs:
+		if os.path.isdir(os.path.join(db_path, ekdir)):
+			return scan_entry(db_path, ekdir, 0, sets)
+	ekdirs = sorted(ekdir for ekdir in dirs if not ekdir.startswith('ekpubhash/'))
+	if os.path.isdir(os.path.join(db_path, name[0:2])):
+		ekdirs += sorted(os.path.join(name[0:2], other)
+			for other in os.listdir(os.path.join(db_path, name[0:2]))
+			if len(other) == 64 and other.startswith(name) and is_hex(other))
+	for ekdir in ekdirs:
+		if os.path.isdir(os.path.join(db_path, ekdir)):
+			return scan_entry(db_path, ekdir, LEGACY, sets)
+	return None
+
+# As scan(), but starting from the enrollments in the index of an earlier
+# generation, and only scanning those that the changed paths are in again
+# (along with the unusable ones, and those whose golden PCR set changed).
+# Returns the enrollments and the keys of those scanned.
+def scan_changes(db_path, base, changed, sets):
+	dirs = {}
+	digests = set()
+	for path in changed:
+		parts = path.split('/')
+		if len(parts) >= 4 and parts[0] == 'ekpubhash' and len(parts[1]) == 2 and \
+				len(parts[3]) == 32 and is_hex(parts[3]):
+			dirs.setdefault(bytes.fromhex(parts[3]), set()).add('/'.join(parts[0:4]))
+		elif len(parts) >= 2 and len(parts[0]) == 2 and \
+				len(parts[1]) == 64 and is_hex(parts[1]):
+			dirs.setdefault(bytes.fromhex(parts[1][0:32]), set()).add('/'.join(parts[0:2]))
+		elif len(parts) == 2 and parts[0] == PCRSETS_DIR:
+			digests.add(parts[1])
+	entries = {}
+	for key, flags, blob in base.records():
+		if key in dirs or flags & UNUSABLE or blob.get('pcrset') in digests:
+			dirs.setdefault(key, set()).add(blob['dir'])
+			continue
+		if blob.get('pcrset') is not None:
+			sets[blob['pcrset']] = base.sets[blob['pcrset']]
+		entries[key] = (flags, blob)
+	for key, ekdirs in dirs.items():
+		entry = rescan_entry(db_path, key, ekdirs, sets)
+		if entry is not None:
+			entries[key] = entry
+	return entries, [ key for key in dirs if key in entries ]
+
+# Write a file next to 'out' and rename it into place, so that readers with
+# the old one mapped are not disturbed
+def write_file(out, parts):
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(out), prefix='.' + os.path.basename(out))
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			for part in parts:
+				f.write(part)
+		os.chmod(tmp, 0o644)
+		os.rename(tmp, out)
+	except:
+		os.unlink(tmp)
+		raise
+
+# Write the bundle store for the enrollments found by scan(), taking the
+# bundles of unchanged enrollments from the stores in 'reuse' rather than
+# tarring them up again. Returns the number of bundles tarred up.
+def build_bundles(db_path, entries, reuse=()):
+	old = []
+	for other in reuse:
+		try:
+			old.append(Bundles(other))
+		except (OSError, ValueError):
+			pass
+	keys = []
+	blobs = []
+	made = 0
+	for key in sorted(entries):
+		flags, entry = entries[key]
+		tree = entry.get('tree')
+		if tree is None or (flags & PHASE2 and not flags & PCRS):
+			continue
+		tree = bytes.fromhex(tree)
+		for bundles in old:
+			blob = bundles.lookup(key, tree)
+			if blob is not None:
+				break
+		else:
+			blob = tar_dir(os.path.join(db_path, entry['dir']))
+			made += 1
+		keys.append(key + tree)
+		blobs.append(blob)
+	off = bundles_header.size + bundles_record.size * len(keys)
+	table = []
+	for key, blob in zip(keys, blobs):
+		table.append(bundles_record.pack(key[0:16], key[16:], len(blob), off))
+		off += len(blob)
+	write_file(bundles_path(db_path),
+		[ bundles_header.pack(BUNDLES_MAGIC, len(keys), 0), b''.join(table) ] + blobs)
+	return made
+
+def build(db_path, out=None, reuse=()):
+	if out is None:
+		out = index_path(db_path)
+	sets = {}
+	commit = head_commit(db_path) or ''
+
+	# Only the enrollments that changed since the last build are scanned
+	# (and tarred up) again, unless there is nothing to start from
+	base, changed = base_index(db_path, reuse)
+	if base is not None:
+		try:
+			entries, scanned = scan_changes(db_path, base, changed, sets)
+			trees = tree_hashes_of(db_path, [ entries[key][1]['dir'] for key in scanned ])
+		except (KeyError, ValueError):
+			base = None
+			sets = {}
+	if base is None:
+		entries = scan(db_path, sets)
+		scanned = entries.keys()
+		trees = tree_hashes(db_path)
+	for key in scanned:
+		entry = entries[key][1]
+		if entry['dir'] in trees:
+			entry['tree'] = trees[entry['dir']].hex()
+	build_bundles(db_path, entries, [ bundles_path(db_path) ] +
+		[ bundles_path(other) for other in reuse ])
+
+	tofu = None
+	if os.path.exists(os.path.join(db_path, 'tofu_pcrs')):
+		with open(os.path.join(db_path, 'tofu_pcrs')) as f:
+			tofu = json.dumps(yaml.safe_load(f)).encode()
+
+	keys = sorted(entries)
+	blobs = [ json.dumps(entries[key][1], separators=(',',':')).encode() for key in keys ]
+	off = header.size + record.size * len(keys)
+	table = []
+	for key, blob in zip(keys, blobs):
+		table.append(record.pack(key, entries[key][0], len(blob), off))
+		off += len(blob)
+	tofu_off, tofu_len = (off, len(tofu)) if tofu is not None else (0, 0)
+	off += tofu_len
+	table_of_sets = json.dumps({ digest: pcrset.encode() for digest, pcrset in sets.items() },
+		separators=(',',':')).encode()
+
+	write_file(out, [ header.pack(MAGIC, len(keys), tofu_len, tofu_off, commit.encode(),
+			len(table_of_sets), off),
+		b''.join(table), b''.join(blobs), tofu or b'', table_of_sets ])
+	return len(keys)
+
+class Entry:
+	def __init__(self, db_path, flags, blob, sets):
+		self.flags = flags
+		self.dir = os.path.join(db_path, blob['dir'])
+		self.assets = blob['assets']
+		self.tree = bytes.fromhex(blob['tree']) if 'tree' in blob else None
+		self.has_pcrs = bool(flags & PCRS)
+		# (a PCRSet, shared with the other entries that have it)
+		self.pcrs = None
+		if flags & UNUSABLE:
+			self.pcrs = Unusable(blob.get('error'))
+		elif self.has_pcrs and blob['pcrset'] is not None:
+			self.pcrs = sets[blob['pcrset']]
+
+	@property
+	def phase2(self):
+		return bool(self.flags & PHASE2)
+
+class Bundles:
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count, _ = bundles_header.unpack_from(self.map, 0)
+		if magic != BUNDLES_MAGIC:
+			raise ValueError(f"{path}: bad bundle store")
+		if bundles_header.size + self.count * bundles_record.size > len(self.map):
+			raise ValueError(f"{path}: truncated bundle store")
+
+	def key(self, i):
+		off = bundles_header.size + i * bundles_record.size
+		return self.map[off:off + 48]
+
+	# Binary search for the bundle of the enrollment with this key and
+	# tree hash. Returns a view of it in the map, or None.
+	def lookup(self, key, tree):
+		key = key + tree
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.key(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo == self.count or self.key(lo) != key:
+			return None
+		_, _, length, off = bundles_record.unpack_from(self.map,
+			bundles_header.size + lo * bundles_record.size)
+		if off + length > len(self.map):
+			return None
+		return memoryview(self.map)[off:off + length]
+
+class Index:
+	def __init__(self, db_path, path=None):
+		self.db_path = db_path
+		with open(path or index_path(db_path), 'rb') as f:
+			st = os.fstat(f.fileno())
+			self.ident = (st.st_dev, st.st_ino)
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count, tofu_len, tofu_off, commit, sets_len, sets_off = \
+			header.unpack_from(self.map, 0)
+		if magic != MAGIC:
+			raise ValueError(f"{db_path}: bad enrollment index")
+		if header.size + self.count * record.size > len(self.map):
+			raise ValueError(f"{db_path}: truncated enrollment index")
+		self.commit = commit.rstrip(b'\0').decode()
+		self.has_tofu_pcrs = tofu_len != 0
+		self.tofu_pcrs = None
+		if self.has_tofu_pcrs:
+			self.tofu_pcrs = json.loads(self.map[tofu_off:tofu_off + tofu_len])
+		# (parsed here, once for each generation of the clone)
+		if sets_off + sets_len > len(self.map):
+			raise ValueError(f"{db_path}: truncated enrollment index")
+		self.sets = { digest: PCRSet.from_encoded(pcrs) for digest, pcrs in
+			json.loads(self.map[sets_off:sets_off + sets_len]).items() }
+		try:
+			self.bundles = Bundles(bundles_path(db_path))
+		except (OSError, ValueError):
+			self.bundles = None
+
+	# An index is only good for the commit it was built from; the clone
+	# might have been updated since without it being rebuilt.
+	def current(self):
+		return self.commit != '' and self.commit == head_commit(self.db_path)
+
+	def key(self, i):
+		off = header.size + i * record.size
+		return self.map[off:off + 16]
+
+	# The flags and blob of a record, as build() wrote them
+	def record(self, i):
+		_, flags, length, off = record.unpack_from(self.map, header.size + i * record.size)
+		if off + length > len(self.map):
+			raise ValueError(f"{self.db_path}: truncated enrollment index")
+		return flags, json.loads(self.map[off:off + length])
+
+	def entry(self, i):
+		return Entry(self.db_path, *self.record(i), self.sets)
+
+	# Every enrollment, in key order
+	def entries(self):
+		for i in range(self.count):
+			yield self.key(i), self.entry(i)
+
+	# Every record, in key order (see scan_changes())
+	def records(self):
+		for i in range(self.count):
+			yield (self.key(i), *self.record(i))
+
+	# Binary search for the ekhash (hex). Returns an Entry or None.
+	def lookup(self, ekhash):
+		key = bytes.fromhex(ekhash[0:32])
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.key(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo == self.count or self.key(lo) != key:
+			return None
+		return self.entry(lo)
+
+	# The bundle of secrets for an Entry found with lookup(ekhash), as a
+	# view of the mapped bundle store, or None if there isn't one
+	def bundle(self, ekhash, entry):
+		if self.bundles is None or entry.tree is None:
+			return None
+		return self.bundles.lookup(bytes.fromhex(ekhash[0:32]), entry.tree)
+
+# Open the index for a clone, returning None if there isn't a usable one
+def open_index(db_path):
+	try:
+		index = Index(db_path)
+	except (OSError, ValueError):
+		return None
+	if not index.current():
+		return None
+	return index
+
+def read_file(path):
+	with open(path, 'rb') as f:
+		while f.read(1 << 16):
+			pass
+
+# Build the index (and bundle store) for a clone and check it against the clone, reading every
+# enrolled asset on the way. This is done by the attestsvc updater before a
+# clone is swapped in, so that a bad index is never served and the first
+# attestations against the new clone find the index, the directories and the
+# assets already in the page and dentry caches. The bundles of enrollments
+# that are the same in the clones in 'reuse' are taken from their stores
+# rather than tarred up again. Returns the number of enrollments, or raises
+# ValueError if the index doesn't describe the clone. Enrollments with golden
+# PCRs that pcr_validate() can't use are logged and indexed as UNUSABLE (see
+# scan_entry()), rather than failing the clone.
+def prepare(db_path, reuse=()):
+	build(db_path, reuse=reuse)
+	index = Index(db_path)
+	if not index.current():
+		raise ValueError(f"{db_path}: index is not for the checked out commit")
+	prev = None
+	unusable = 0
+	for key, entry in index.entries():
+		if prev is not None and key <= prev:
+			raise ValueError(f"{db_path}: enrollment index is not sorted")
+		prev = key
+		if entry.flags & UNUSABLE:
+			unusable += 1
+		for asset in entry.assets:
+			path = os.path.join(entry.dir, asset)
+			if os.path.isdir(path):
+				continue
+			read_file(path)
+	if index.bundles is not None:
+		read_file(bundles_path(db_path))
+	if unusable:
+		logging.warning(f"{db_path}: {unusable} enrollments have unusable golden PCRs")
+	return index.count
@@ -0,0 +1,653 @@
+#!/usr/bin/python3
+"""
+Single-file (SQLite) enrollment store.
+
+The enrollment database is normally a git repository with a directory of small
+files per TPM (`ekpubhash/xx/xxxxxx/<32 hex>`, see ply_path_add in
+common_defs.sh) and the hn2ek reverse-lookup table, replicated by cloning it.
+With millions of TPMs that is tens of millions of files and git objects, so
+adds and commits slow down (git restats the working tree), new replicas take a
+long time to clone, and the filesystem runs out of inodes. This store is the
+alternative, selected with HCP_RUN_ENROLL_STORE=sqlite on the enrollment
+service and HCP_ATTESTSVC_STORE=sqlite on the attestation service, and it
+keeps everything in one SQLite file;
+
+	enrollments	key (the first 32 hex digits of the ekpubhash, as in
+			the directory names), ekpubhash, hostname, reversed
+			hostname (indexed, for find) and the sequence number of
+			the write that last changed it
+	assets		the files of each enrolled directory (including
+			`ekpubhash` and `hostname`), inline, by key and path
+	deleted		the keys of deleted enrollments, by sequence number
+	prepared	the flags and the digest of the golden PCR set (as in
+			enroll_index) and the bundle of secrets of each
+			enrollment, made by replicas as changes are applied, so
+			that lookups don't parse or tar anything
+	pcrsets		the golden PCR sets of the prepared enrollments, each
+			stored once, by digest, and parsed once by each process
+			that looks enrollments up
+	meta		the origin (random, made with the store), the sequence
+			number of the last write, tofu_pcrs, and on replicas,
+			the head of the store they replicate
+
+Every write (a transaction, see Store.write()) bumps the sequence number, and
+the store's head is the origin followed by the sequence number, as 40 hex
+digits, so that it passes for a commit where the git repo's HEAD would be (see
+repl_notify.py and wait_head.py). Replication ships deltas rather than a
+working tree; delta(since) produces every enrollment written, and every key
+deleted, after the head 'since' (everything, if 'since' is from another
+origin), as lines of JSON, and apply() applies them to a replica in a single
+transaction. Tombstones are kept for good, they're small.
+
+The attestation server looks enrollments up with open_index(), which has the
+same interface as the enroll_index.Index of a git clone (see attest-verify).
+
+The directory layout is still the default, see convert_store.py (in
+hcp/enrollsvc) for converting a repo to a store and back.
+"""
+import base64
+import io
+import json
+import os
+import sqlite3
+import sys
+import tarfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+try:
+	# (only needed to prepare enrollments for lookup, the enrollment
+	# service has no yaml)
+	import yaml
+	import enroll_index
+except ImportError:
+	yaml = None
+	enroll_index = None
+
+# The tables (see above). Assets that are in sub-directories of the enrolled
+# directory have '/' in their names.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS enrollments (
+	key TEXT PRIMARY KEY,
+	ekpubhash TEXT NOT NULL,
+	hostname TEXT NOT NULL,
+	rhostname TEXT NOT NULL,
+	seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS enrollments_rhostname ON enrollments (rhostname, key);
+CREATE INDEX IF NOT EXISTS enrollments_seq ON enrollments (seq);
+CREATE TABLE IF NOT EXISTS assets (
+	key TEXT NOT NULL,
+	name TEXT NOT NULL,
+	mode INTEGER NOT NULL,
+	data BLOB NOT NULL,
+	PRIMARY KEY (key, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS deleted (
+	key TEXT PRIMARY KEY,
+	seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deleted_seq ON deleted (seq);
+CREATE TABLE IF NOT EXISTS prepared (
+	key TEXT PRIMARY KEY,
+	flags INTEGER NOT NULL,
+	pcrset TEXT,
+	bundle BLOB
+);
+CREATE TABLE IF NOT EXISTS pcrsets (
+	digest TEXT PRIMARY KEY,
+	pcrs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+	name TEXT PRIMARY KEY,
+	value TEXT
+);
+"""
+
+# Hex digits are below this, so [prefix, prefix + HEX_END) is every key with
+# that prefix; and likewise for hostnames (see check_hostname in common_defs.sh)
+HEX_END = 'g'
+HOSTNAME_END = '\x7f'
+
+class StoreError(Exception):
+	pass
+
+@contextmanager
+def transaction(db, mode='IMMEDIATE'):
+	db.execute(f'BEGIN {mode}')
+	try:
+		yield db
+	except:
+		db.execute('ROLLBACK')
+		raise
+	db.execute('COMMIT')
+
+def key_of(ekpubhash):
+	return ekpubhash[0:32]
+
+# The head of a store, as 40 hex digits
+def make_head(origin, seq):
+	return f"{origin}{seq:016x}"
+
+def split_head(head):
+	if head is None or len(head) != 40:
+		return None, 0
+	try:
+		return head[0:24], int(head[24:], 16)
+	except ValueError:
+		return None, 0
+
+# The files of an enrolled directory, as (name, mode, contents), leaving out
+# dot-files as install_entry in add_batch.py does
+def read_dir(path):
+	files = []
+	for root, dirs, names in os.walk(path):
+		dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+		for name in sorted(names):
+			if name.startswith('.'):
+				continue
+			p = os.path.join(root, name)
+			with open(p, 'rb') as f:
+				data = f.read()
+			files.append((os.path.relpath(p, path), os.stat(p).st_mode & 0o7777, data))
+	return files
+
+def write_dir(path, files):
+	for name, mode, data in files:
+		p = os.path.join(path, name)
+		os.makedirs(os.path.dirname(p), exist_ok=True)
+		with open(p, 'wb') as f:
+			f.write(data)
+		os.chmod(p, mode)
+
+# The same tarball as `tar cf - -C ekdir .` (see enroll_index.tar_dir) of the
+# enrolled directory, from its assets
+def tar_files(files):
+	out = io.BytesIO()
+	now = int(time.time())
+	with tarfile.open(fileobj=out, mode='w', format=tarfile.GNU_FORMAT) as tf:
+		def add_dir(name):
+			info = tarfile.TarInfo(name)
+			info.type = tarfile.DIRTYPE
+			info.mode = 0o755
+			info.mtime = now
+			tf.addfile(info)
+		add_dir('.')
+		made = set()
+		for name, mode, data in sorted(files):
+			parts = name.split('/')
+			for i in range(1, len(parts)):
+				d = '/'.join(parts[0:i])
+				if d not in made:
+					made.add(d)
+					add_dir('./' + d)
+			info = tarfile.TarInfo('./' + name)
+			info.size = len(data)
+			info.mode = mode
+			info.mtime = now
+			tf.addfile(info, io.BytesIO(data))
+	return out.getvalue()
+
+# The flags and golden PCR set (an enroll_index.PCRSet) of an enrollment, as
+# enroll_index.scan_entry() finds them in an enrolled directory. As there,
+# golden PCRs that can't be used are an enroll_index.Unusable, with the
+# UNUSABLE flag, rather than an error, so that one bad enrollment doesn't hold
+# up the rest of a delta.
+def prepare_entry(files):
+	flags = 0
+	pcrset = None
+	names = { name for name, _, _ in files }
+	if 'phase2' in names:
+		flags |= enroll_index.PHASE2
+	if 'pcrset' in names and 'pcrs' not in names:
+		# (there is no pcrsets directory for it to refer to, see
+		# convert_store.py)
+		return flags | enroll_index.PCRS | enroll_index.UNUSABLE, \
+			enroll_index.Unusable("a pcrset reference, which a store can't resolve")
+	for name, _, data in files:
+		if name != 'pcrs':
+			continue
+		flags |= enroll_index.PCRS
+		# (unlike the index, there's no file to leave them in for the
+		# reader, so they must be usable by pcr_validate() here)
+		try:
+			doc = yaml.safe_load(data)
+			if doc is None:
+				continue
+			pcrset = enroll_index.PCRSet.from_doc(doc)
+			if pcrset is None:
+				raise ValueError("not a golden PCRs document")
+		except (ValueError, yaml.YAMLError) as e:
+			return flags | enroll_index.UNUSABLE, enroll_index.Unusable(str(e))
+	return flags, pcrset
+
+# An enrollment found by Store.lookup(), with the same attributes as an
+# enroll_index.Entry. 'dir' names the enrollment (there is no directory) so
+# that payload() in attest-verify can match it up.
+class Entry:
+	def __init__(self, store, key, flags, pcrset):
+		self.dir = f"{store.path}#{key}"
+		self.key = key
+		self.flags = flags
+		self.has_pcrs = bool(flags & enroll_index.PCRS)
+		self.pcrs = pcrset
+		if flags & enroll_index.UNUSABLE and pcrset is None:
+			self.pcrs = enroll_index.Unusable()
+		# (for enroll_index.Index.bundle(), which wants a tree hash)
+		self.tree = None
+
+	@property
+	def phase2(self):
+		return bool(self.flags & enroll_index.PHASE2)
+
+class Store:
+	# 'mode' is that of SQLite's URIs; 'ro', 'rw', or 'rwc' to create the
+	# store if it doesn't exist
+	def __init__(self, path, mode='rw', wal=False):
+		self.path = path
+		self.mode = mode
+		self.local = threading.local()
+		self.tofu_parsed = (None, None)
+		self.pcrsets = {}
+		db = self.conn()
+		if mode == 'rwc':
+			if wal:
+				db.execute('PRAGMA journal_mode=WAL')
+			db.executescript(SCHEMA)
+			with transaction(db):
+				if self.meta(db, 'origin') is None:
+					self.set_meta(db, 'origin', os.urandom(12).hex())
+					self.set_meta(db, 'seq', '0')
+		try:
+			self.origin = self.meta(db, 'origin')
+		except sqlite3.DatabaseError:
+			self.origin = None
+		if self.origin is None:
+			raise StoreError(f"{path}: not an enrollment store")
+
+	def connect(self):
+		uri = 'file:' + urllib.parse.quote(os.path.abspath(self.path)) + f'?mode={self.mode}'
+		db = sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None,
+			check_same_thread=False)
+		db.execute('PRAGMA synchronous=FULL')
+		return db
+
+	# A connection for this thread (and process, connections don't survive
+	# a fork)
+	def conn(self):
+		db = getattr(self.local, 'db', None)
+		if db is None or self.local.pid != os.getpid():
+			db = self.local.db = self.connect()
+			self.local.pid = os.getpid()
+		return db
+
+	def meta(self, db, name):
+		row = db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+		return None if row is None else row[0]
+
+	def set_meta(self, db, name, value):
+		db.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+	def head(self):
+		return make_head(self.origin, int(self.meta(self.conn(), 'seq')))
+
+	# The head of the store this replica was last updated from
+	def upstream(self):
+		return self.meta(self.conn(), 'upstream')
+
+	# The tofu_pcrs file (YAML) of the enrollment database, as it is
+	def read_tofu_pcrs(self, db=None):
+		return self.meta(db or self.conn(), 'tofu_pcrs')
+
+	# The JSON of an enrollment, as built by op_query.sh
+	def entry_json(self, db, key, ekpubhash, hostname):
+		names = set()
+		for (name,) in db.execute('SELECT name FROM assets WHERE key = ?', (key,)):
+			names.add(name.split('/', 1)[0])
+		others = [ n for n in sorted(names) if 'ekpubhash' not in n and 'hostname' not in n ]
+		return { 'ekpubhash': ekpubhash, 'hostname': hostname, 'others': others }
+
+	# The enrollments matching an ekpubhash prefix, in key order, starting
+	# after the key 'after' and stopping at 'limit' (if given)
+	def select(self, db, prefix, after='', limit=-1):
+		prefix = prefix[0:32]
+		return db.execute('SELECT key, ekpubhash, hostname FROM enrollments '
+			'WHERE key >= ? AND key < ? AND key > ? ORDER BY key LIMIT ?',
+			(prefix, prefix + HEX_END, after, limit)).fetchall()
+
+	def query(self, ekpubhash):
+		db = self.conn()
+		with transaction(db, 'DEFERRED'):
+			return { 'entries': [ self.entry_json(db, *row)
+				for row in self.select(db, ekpubhash) ] }
+
+	# As EnrollDB.query_page in db_worker.py
+	def query_page(self, ekpubhash, limit, after):
+		db = self.conn()
+		with transaction(db, 'DEFERRED'):
+			rows = self.select(db, ekpubhash, after, limit + 1)
+			cursor = rows[limit - 1][0] if len(rows) > limit else None
+			return { 'entries': [ self.entry_json(db, *row) for row in rows[0:limit] ],
+				'cursor': cursor }
+
+	# The (truncated) ekpubhashes of hosts whose name ends with
+	# hostname_suffix, in the same order as hn2ek.find()
+	def find(self, hostname_suffix):
+		prefix = hostname_suffix[::-1]
+		rows = self.conn().execute('SELECT key FROM enrollments '
+			'WHERE rhostname >= ? AND rhostname < ? ORDER BY rhostname, key',
+			(prefix, prefix + HOSTNAME_END))
+		return [ key for (key,) in rows ]
+
+	def files(self, db, key):
+		return db.execute('SELECT name, mode, data FROM assets WHERE key = ? ORDER BY name',
+			(key,)).fetchall()
+
+	# A transaction that makes one write (in the sense of the head), e.g.
+	#	with store.write() as w:
+	#		w.put(...)
+	def write(self):
+		return Writer(self)
+
+	# Every enrollment written and deleted since the head 'since', for
+	# apply(), as dicts (one per line of the delta, see repl_notify.py);
+	# first { "origin", "head", "full", "tofu_pcrs" }, then
+	# { "put": key, "ekpubhash", "hostname", "assets": [ [ name, mode,
+	# base64 ], ... ] } or { "delete": key } for each change, and last
+	# { "end": head }, so that the receiver can tell it got it all. The
+	# delta is produced from one snapshot of the store, on a connection of
+	# its own.
+	def delta(self, since):
+		origin, seq = split_head(since)
+		full = origin != self.origin
+		if full:
+			seq = -1
+		db = self.connect()
+		try:
+			with transaction(db, 'DEFERRED'):
+				head = make_head(self.origin, int(self.meta(db, 'seq')))
+				yield { 'origin': self.origin, 'head': head, 'full': full,
+					'tofu_pcrs': self.read_tofu_pcrs(db) }
+				rows = db.execute('SELECT key, ekpubhash, hostname FROM enrollments '
+					'WHERE seq > ? ORDER BY key', (seq,))
+				for key, ekpubhash, hostname in rows:
+					yield { 'put': key, 'ekpubhash': ekpubhash, 'hostname': hostname,
+						'assets': [ [ name, mode, base64.b64encode(data).decode() ]
+							for name, mode, data in self.files(db, key) ] }
+				if not full:
+					for (key,) in db.execute('SELECT key FROM deleted WHERE seq > ? ORDER BY key', (seq,)):
+						yield { 'delete': key }
+				yield { 'end': head }
+		finally:
+			db.close()
+
+	# Apply the lines of a delta (see above) to this replica, in a single
+	# transaction, preparing each enrollment for lookup() on the way.
+	# Returns the new upstream head. If the delta is incomplete, or not
+	# for this replica, nothing is changed and StoreError is raised.
+	def apply(self, lines):
+		db = self.conn()
+		lines = iter(lines)
+		puts = deletes = 0
+		with transaction(db):
+			first = json.loads(next(lines, '{}'))
+			if 'head' not in first:
+				raise StoreError("not a delta")
+			origin, _ = split_head(self.upstream())
+			if not first['full'] and origin != first['origin']:
+				raise StoreError("delta is for another store")
+			if first['full']:
+				for table in ('enrollments', 'assets', 'deleted', 'prepared', 'pcrsets'):
+					db.execute(f'DELETE FROM {table}')
+			end = None
+			for line in lines:
+				change = json.loads(line)
+				if 'end' in change:
+					end = change['end']
+					break
+				if 'delete' in change:
+					self.remove(db, change['delete'])
+					deletes += 1
+					continue
+				key = change['put']
+				files = [ (name, mode, base64.b64decode(data))
+					for name, mode, data in change['assets'] ]
+				self.remove(db, key)
+				self.insert(db, key, change['ekpubhash'], change['hostname'], files, 0)
+				self.prepare(db, key, files)
+				puts += 1
+			if end != first['head']:
+				raise StoreError("delta is incomplete")
+			if first['tofu_pcrs'] is None:
+				db.execute("DELETE FROM meta WHERE name = 'tofu_pcrs'")
+			else:
+				self.set_meta(db, 'tofu_pcrs', first['tofu_pcrs'])
+			self.set_meta(db, 'upstream', end)
+		print(f"Applied {puts} enrollments and {deletes} deletions"
+			f"{' (full)' if first['full'] else ''}, now at {end}", file=sys.stderr)
+		return end
+
+	def insert(self, db, key, ekpubhash, hostname, files, seq):
+		db.execute('INSERT INTO enrollments (key, ekpubhash, hostname, rhostname, seq) '
+			'VALUES (?, ?, ?, ?, ?)', (key, ekpubhash, hostname, hostname[::-1], seq))
+		db.executemany('INSERT INTO assets (key, name, mode, data) VALUES (?, ?, ?, ?)',
+			[ (key, name, mode, data) for name, mode, data in files ])
+
+	def remove(self, db, key):
+		for table in ('enrollments', 'assets', 'prepared'):
+			db.execute(f'DELETE FROM {table} WHERE key = ?', (key,))
+
+	# There is no bundle for an enrollment still waiting for its TOFU
+	# PCRs, as with enroll_index.build_bundles(). Golden PCR sets that no
+	# enrollment refers to any more are left until the next full delta,
+	# they're small.
+	def prepare(self, db, key, files):
+		flags, pcrset = prepare_entry(files)
+		bundle = None
+		if not (flags & enroll_index.PHASE2 and not flags & enroll_index.PCRS):
+			bundle = tar_files(files)
+		if isinstance(pcrset, enroll_index.Unusable):
+			print(f"{key}: unusable golden PCRs: {pcrset.error}", file=sys.stderr)
+			pcrset = None
+		if pcrset is not None:
+			db.execute('INSERT OR IGNORE INTO pcrsets (digest, pcrs) VALUES (?, ?)',
+				(pcrset.digest, json.dumps(pcrset.encode())))
+		db.execute('INSERT OR REPLACE INTO prepared (key, flags, pcrset, bundle) VALUES (?, ?, ?, ?)',
+			(key, flags, None if pcrset is None else pcrset.digest, bundle))
+
+	# The golden PCR set with this digest, parsed once for each process
+	# (the sets are content-addressed, so they never go stale)
+	def pcrset(self, db, digest):
+		pcrset = self.pcrsets.get(digest)
+		if pcrset is None:
+			row = db.execute('SELECT pcrs FROM pcrsets WHERE digest = ?', (digest,)).fetchone()
+			if row is None:
+				raise StoreError(f"{self.path}: missing golden PCR set {digest}")
+			pcrset = self.pcrsets.setdefault(digest,
+				enroll_index.PCRSet.from_encoded(json.loads(row[0])))
+		return pcrset
+
+	# The rest is the enroll_index.Index interface, for attest-verify.
+	# Changes are applied transactionally, so the store is always current.
+	# (parsed once for each version of the file)
+	@property
+	def tofu_pcrs(self):
+		value = self.read_tofu_pcrs()
+		if value is None:
+			return None
+		if self.tofu_parsed[0] != value:
+			self.tofu_parsed = (value, yaml.safe_load(value))
+		return self.tofu_parsed[1]
+
+	@property
+	def has_tofu_pcrs(self):
+		return self.read_tofu_pcrs() is not None
+
+	def current(self):
+		return True
+
+	def lookup(self, ekhash):
+		key = key_of(ekhash)
+		db = self.conn()
+		row = db.execute('SELECT flags, pcrset FROM prepared WHERE key = ?', (key,)).fetchone()
+		if row is None:
+			# not prepared (e.g. a store written by the enrollment
+			# service, rather than a replica)
+			files = self.files(db, key)
+			if not files:
+				return None
+			flags, pcrset = prepare_entry(files)
+			if isinstance(pcrset, enroll_index.PCRSet):
+				pcrset = self.pcrsets.setdefault(pcrset.digest, pcrset)
+			return Entry(self, key, flags, pcrset)
+		flags, digest = row
+		return Entry(self, key, flags, None if digest is None else self.pcrset(db, digest))
+
+	def bundle(self, ekhash, entry):
+		db = self.conn()
+		row = db.execute('SELECT bundle FROM prepared WHERE key = ?', (entry.key,)).fetchone()
+		if row is not None and row[0] is not None:
+			return row[0]
+		files = self.files(db, entry.key)
+		return tar_files(files) if files else None
+
+	# Trust-on-first-use; write the quoted values of the tofu_pcrs PCRs as
+	# the golden PCRs of the enrollment (as write_tofu_pcrs does in
+	# attest-verify), returning them, or None if there aren't any to write.
+	# This is a change to the replica only (as it is with a git clone),
+	# which the next delta with the enrollment in it will undo.
+	def write_tofu_pcrs(self, entry, quote_pcrs, tofu_pcrs):
+		if len(tofu_pcrs) == 0:
+			return None
+		doc = { 'pcrs': { 'sha256': { pcr: quote_pcrs[pcr] for pcr in tofu_pcrs } } }
+		print(f"Writing TOFU PCRs to {entry.dir}", file=sys.stderr)
+		db = self.conn()
+		with transaction(db):
+			db.execute('INSERT OR REPLACE INTO assets (key, name, mode, data) VALUES (?, ?, ?, ?)',
+				(entry.key, 'pcrs', 0o644, yaml.dump(doc).encode()))
+			self.prepare(db, entry.key, self.files(db, entry.key))
+		return doc
+
+class Writer:
+	def __init__(self, store):
+		self.store = store
+		self.db = store.conn()
+
+	def __enter__(self):
+		self.db.execute('BEGIN IMMEDIATE')
+		self.seq = int(self.store.meta(self.db, 'seq')) + 1
+		self.changed = False
+		return self
+
+	# Nothing changed, no new head
+	def __exit__(self, kind, value, tb):
+		if kind is not None:
+			self.db.execute('ROLLBACK')
+		elif not self.changed:
+			self.db.execute('ROLLBACK')
+		else:
+			self.store.set_meta(self.db, 'seq', str(self.seq))
+			self.db.execute('COMMIT')
+
+	# Enroll a TPM, with the files of its enrolled directory. Returns False
+	# if it is already enrolled (enrollment is exclusive, as in op_add.sh).
+	def put(self, ekpubhash, hostname, files):
+		key = key_of(ekpubhash)
+		if self.db.execute('SELECT 1 FROM enrollments WHERE key = ?', (key,)).fetchone():
+			return False
+		self.store.insert(self.db, key, ekpubhash, hostname, files, self.seq)
+		self.db.execute('DELETE FROM deleted WHERE key = ?', (key,))
+		self.changed = True
+		return True
+
+	# The same, from a directory made by attest-enroll, to which the
+	# `ekpubhash` file is added (as op_add.sh does)
+	def put_dir(self, ekpubhash, hostname, path):
+		files = [ f for f in read_dir(path) if f[0] != 'ekpubhash' ]
+		files.append(('ekpubhash', 0o644, (ekpubhash + '\n').encode()))
+		return self.put(ekpubhash, hostname, files)
+
+	# Delete the enrollments matching an ekpubhash prefix, returning their
+	# JSON (as op_delete.sh outputs it)
+	def delete(self, ekpubhash):
+		entries = []
+		for key, ekp, hostname in self.store.select(self.db, ekpubhash):
+			entries.append(self.store.entry_json(self.db, key, ekp, hostname))
+			self.store.remove(self.db, key)
+			self.db.execute('INSERT OR REPLACE INTO deleted (key, seq) VALUES (?, ?)',
+				(key, self.seq))
+			self.changed = True
+		return entries
+
+	def set_tofu_pcrs(self, text):
+		self.store.set_meta(self.db, 'tofu_pcrs', text)
+		self.changed = True
+
+# The store for attest-verify, or None if it can't be opened
+def open_index(path):
+	try:
+		return Store(path, 'rw' if os.access(path, os.W_OK) else 'ro')
+	except (sqlite3.Error, StoreError):
+		return None
+
+# Bring a replica up to date with the store behind a change notifier (see
+# repl_notify.py), returning the new upstream head
+def pull(store, url):
+	query = urllib.parse.urlencode({ 'since': store.upstream() or '' })
+	with urllib.request.urlopen(f"{url}/v1/delta?{query}", timeout=300) as r:
+		return store.apply(line for line in r)
+
+# The command-line interface, used by the op_<verb>.sh scripts (with the
+# same output as they have with the directory layout), init_repo.sh and the
+# attestsvc updater;
+#    enroll_store.py <store> create
+#    enroll_store.py <store> add <ekpubhash> <hostname> <dir>
+#    enroll_store.py <store> query <ekpubhash prefix>
+#    enroll_store.py <store> delete <ekpubhash prefix>
+#    enroll_store.py <store> find <hostname suffix>
+#    enroll_store.py <store> head|upstream
+#    enroll_store.py <store> pull <notify URL>
+# A replica is created by its first pull.
+if __name__ == '__main__':
+	cmds = { 'create': 3, 'add': 6, 'query': 4, 'delete': 4, 'find': 4,
+		'head': 3, 'upstream': 3, 'pull': 4 }
+	argv = sys.argv
+	if len(argv) < 3 or cmds.get(argv[2]) != len(argv):
+		print("Usage: enroll_store.py <store> create|add|query|delete|find|head|upstream|pull [args]",
+			file=sys.stderr)
+		sys.exit(1)
+	cmd = argv[2]
+	try:
+		if cmd == 'create':
+			store = Store(argv[1], 'rwc', wal=True)
+		elif cmd == 'pull':
+			store = Store(argv[1], 'rwc')
+		elif cmd in ('add', 'delete'):
+			store = Store(argv[1])
+		else:
+			store = Store(argv[1], 'ro')
+		if cmd == 'add':
+			with store.write() as w:
+				if not w.put_dir(argv[3], argv[4], argv[5]):
+					print("Error, TPM is already enrolled", file=sys.stderr)
+					sys.exit(1)
+		elif cmd == 'query':
+			print(json.dumps(store.query(argv[3])))
+		elif cmd == 'delete':
+			with store.write() as w:
+				print(json.dumps({ 'entries': w.delete(argv[3]) }))
+		elif cmd == 'find':
+			print(json.dumps({ 'hostname_suffix': argv[3],
+				'ekpubhashes': store.find(argv[3]) }))
+		elif cmd in ('create', 'head'):
+			print(store.head())
+		elif cmd == 'upstream':
+			print(store.upstream() or '')
+		elif cmd == 'pull':
+			print(pull(store, argv[3]))
+	except (OSError, ValueError, sqlite3.Error, StoreError) as e:
+		print(f"Error, {argv[1]}: {e}", file=sys.stderr)
+		sys.exit(1)
@@ -0,0 +1,306 @@
+"""
+Counters, gauges and histograms, exposed in the Prometheus text format.
+
+The attestation server runs in several processes (uwsgi workers, or the async
+front end's worker pool), all forked from the one that loads the application,
+so the metrics are kept in a shared memory map that is created before they
+fork. Each process that updates a metric claims a row of the map for itself
+(under a file lock, once), after which its updates are plain stores into its
+own row, with no locking between processes. Rendering sums the rows, so that a
+scrape sees the whole server, and reads the map without taking any lock that
+the request path takes.
+
+Metrics are declared (with all of their label values) before open() is
+called, since they determine the layout of the map. When a process exits, its
+counts stay in its row; once the rows run out, those of dead processes are
+folded into a shared row and reused. Gauges only count for live processes.
+"""
+import fcntl
+import mmap
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+		   0.25, 0.5, 1, 2.5, 5, 10)
+
+# Number of processes that can have rows at once
+MAX_ROWS = 256
+
+def fmt_labels(pairs):
+	if not pairs:
+		return ''
+	return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def fmt_value(v):
+	return str(int(v)) if v == int(v) else repr(v)
+
+class Metric:
+	kind = None
+
+	def __init__(self, registry, name, doc, label, values):
+		self.registry = registry
+		self.name = name
+		self.doc = doc
+		self.label = label
+		self.values = list(values) if label else [ None ]
+		self.offset = 0
+
+	def width(self):
+		return len(self.values)
+
+	def slot(self, value):
+		return self.offset + self.values.index(value)
+
+	def labels(self, value):
+		return [ (self.label, value) ] if self.label else []
+
+	def render(self, sums):
+		out = [ f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}" ]
+		for value in self.values:
+			out.append(f"{self.name}{fmt_labels(self.labels(value))} "
+				   f"{fmt_value(sums[self.slot(value)])}")
+		return out
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def inc(self, value=None, n=1):
+		self.registry.add(self.slot(value), n)
+
+class Gauge(Metric):
+	kind = 'gauge'
+
+	def inc(self, value=None, n=1):
+		self.registry.add(self.slot(value), n)
+
+	def dec(self, value=None, n=1):
+		self.registry.add(self.slot(value), -n)
+
+	# (only meaningful for a gauge that just the one process updates)
+	def set(self, v, value=None):
+		self.registry.store(self.slot(value), v)
+
+	# Count the body of the with statement while it runs
+	@contextmanager
+	def track(self, value=None):
+		self.inc(value)
+		try:
+			yield
+		finally:
+			self.dec(value)
+
+# Each label value has a count for each bucket (not cumulative, that is done
+# when rendering), then the sum and the count of the observations.
+class Histogram(Metric):
+	kind = 'histogram'
+
+	def __init__(self, registry, name, doc, label, values, buckets):
+		super().__init__(registry, name, doc, label, values)
+		self.buckets = tuple(buckets)
+
+	def width(self):
+		return len(self.values) * (len(self.buckets) + 3)
+
+	def slot(self, value):
+		return self.offset + self.values.index(value) * (len(self.buckets) + 3)
+
+	def observe(self, v, value=None):
+		base = self.slot(value)
+		i = 0
+		while i < len(self.buckets) and v > self.buckets[i]:
+			i += 1
+		self.registry.add_many(((base + i, 1), (base + len(self.buckets) + 1, v),
+					(base + len(self.buckets) + 2, 1)))
+
+	# Observe the time taken by the body of the with statement
+	@contextmanager
+	def time(self, value=None):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start, value)
+
+	def render(self, sums):
+		out = [ f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}" ]
+		for value in self.values:
+			base = self.slot(value)
+			labels = self.labels(value)
+			total = 0
+			for i, le in enumerate(self.buckets + (float('inf'),)):
+				total += sums[base + i]
+				le = '+Inf' if le == float('inf') else fmt_value(le)
+				out.append(f"{self.name}_bucket{fmt_labels(labels + [ ('le', le) ])} "
+					   f"{fmt_value(total)}")
+			out.append(f"{self.name}_sum{fmt_labels(labels)} "
+				   f"{fmt_value(sums[base + len(self.buckets) + 1])}")
+			out.append(f"{self.name}_count{fmt_labels(labels)} "
+				   f"{fmt_value(sums[base + len(self.buckets) + 2])}")
+		return out
+
+class Registry:
+	def __init__(self):
+		self.metrics = []
+		self.width = 0
+		self.map = None
+		self.pid = None
+		self.row = None
+		self.lock = threading.Lock()
+		# (held while claiming a row, so that the threads of a process
+		# share the one it claims)
+		self.claiming = threading.Lock()
+		os.register_at_fork(after_in_child=self.forked)
+
+	def register(self, metric):
+		if self.map is not None:
+			raise RuntimeError(f"{metric.name}: metrics already opened")
+		metric.offset = self.width
+		self.width += metric.width()
+		self.metrics.append(metric)
+		return metric
+
+	def counter(self, name, doc, label=None, values=()):
+		return self.register(Counter(self, name, doc, label, values))
+
+	def gauge(self, name, doc, label=None, values=()):
+		return self.register(Gauge(self, name, doc, label, values))
+
+	def histogram(self, name, doc, label=None, values=(), buckets=LATENCY_BUCKETS):
+		return self.register(Histogram(self, name, doc, label, values, buckets))
+
+	# Create the shared map, once all of the metrics have been declared and
+	# before forking. Until this is called, updates are ignored.
+	def open(self):
+		if self.map is not None:
+			return
+		self.file = tempfile.TemporaryFile(prefix='safeboot-metrics')
+		size = 8 * MAX_ROWS * (self.width + 1)
+		os.ftruncate(self.file.fileno(), size)
+		self.map = mmap.mmap(self.file.fileno(), size)
+		self.pids = memoryview(self.map)[0:8 * MAX_ROWS].cast('q')
+		# row 0 holds the counts of processes that have gone away
+		self.pids[0] = -1
+
+	def row_view(self, i):
+		off = 8 * MAX_ROWS + 8 * self.width * i
+		return memoryview(self.map)[off:off + 8 * self.width].cast('d')
+
+	# Claim a row for this process, called on its first update
+	def claim(self, pid):
+		fcntl.lockf(self.file, fcntl.LOCK_EX)
+		try:
+			free = None
+			for i in range(1, MAX_ROWS):
+				if self.pids[i] == 0:
+					free = i
+					break
+			if free is None:
+				free = self.reap()
+			if free is None:
+				return None
+			self.pids[free] = pid
+			return self.row_view(free)
+		finally:
+			fcntl.lockf(self.file, fcntl.LOCK_UN)
+
+	# Fold the rows of dead processes into row 0 (dropping their gauges),
+	# returning one of the freed rows
+	def reap(self):
+		freed = None
+		retired = self.row_view(0)
+		for i in range(1, MAX_ROWS):
+			if alive(self.pids[i]):
+				continue
+			row = self.row_view(i)
+			for m in self.metrics:
+				if isinstance(m, Gauge):
+					continue
+				for j in range(m.offset, m.offset + m.width()):
+					retired[j] += row[j]
+			for j in range(self.width):
+				row[j] = 0
+			self.pids[i] = 0
+			freed = freed or i
+		return freed
+
+	# The locks might have been held by other threads of the parent, which
+	# the child doesn't have
+	def forked(self):
+		self.lock = threading.Lock()
+		self.claiming = threading.Lock()
+
+	def current_row(self):
+		if self.map is None:
+			return None
+		pid = os.getpid()
+		if self.pid != pid:
+			# first update since we were forked (or at all)
+			with self.claiming:
+				if self.pid != pid:
+					self.row = self.claim(pid)
+					self.pid = pid
+		return self.row
+
+	def add(self, slot, n):
+		row = self.current_row()
+		if row is None:
+			return
+		with self.lock:
+			row[slot] += n
+
+	def store(self, slot, v):
+		row = self.current_row()
+		if row is None:
+			return
+		with self.lock:
+			row[slot] = v
+
+	def add_many(self, updates):
+		row = self.current_row()
+		if row is None:
+			return
+		with self.lock:
+			for slot, n in updates:
+				row[slot] += n
+
+	# The metrics in the Prometheus text format
+	def render(self):
+		sums = [ 0.0 ] * self.width
+		if self.map is not None:
+			gauges = [ j for m in self.metrics if isinstance(m, Gauge)
+				   for j in range(m.offset, m.offset + m.width()) ]
+			for i in range(MAX_ROWS):
+				pid = self.pids[i]
+				if pid == 0:
+					continue
+				row = self.row_view(i)
+				for j in range(self.width):
+					sums[j] += row[j]
+				if pid != os.getpid() and not alive(pid):
+					for j in gauges:
+						sums[j] -= row[j]
+		out = []
+		for m in self.metrics:
+			out += m.render(sums)
+		return '\n'.join(out) + '\n'
+
+def alive(pid):
+	if pid <= 0:
+		return False
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+# The registry used by the attestation server and the enrollment service
+registry = Registry()
+
+# The content type of render()'s output
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
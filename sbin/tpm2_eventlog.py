@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+TCG event log parser and PCR replay.
+
+This is a python implementation of the part of `tpm2 eventlog` that the
+attestation server uses; it walks the binary event log (the contents of
+`/sys/kernel/security/tpm0/binary_bios_measurements` that `tpm2-attest quote`
+includes in the quote tarball) and replays the digests into PCR values, without
+producing the YAML text for every event only to have it parsed again.
+
+Both the crypto-agile format (a SHA1-style `Spec ID Event03` header followed
+by TCG_PCR_EVENT2 entries, as per the TCG PC Client Platform Firmware Profile)
+and the older SHA1-only log format are understood. The result has the same
+shape as the `pcrs` section of `tpm2 eventlog` output;
+
+	{ 'sha1': { 0: 0x..., ... }, 'sha256': { 0: 0x..., ... } }
+
+where PCRs that were never extended are left out. Any failure raises
+EventlogError.
+"""
+import hashlib
+import struct
+import sys
+
+from tpm2_quote import hash_algs
+
+EV_NO_ACTION = 0x00000003
+
+SPEC_ID_EVENT03 = b'Spec ID Event03\0'
+STARTUP_LOCALITY = b'StartupLocality\0'
+
+# Number of PCRs in a PC Client TPM
+NUM_PCRS = 24
+
+class EventlogError(Exception):
+	pass
+
+# Parse the events in the log. This is a generator of 4-tuples of
+# (pcr, event type, { alg: digest }, event data) where the digests and data
+# are memoryview slices of the log. The first (SHA1-format) event is
+# returned as well, with its digest under 'sha1'.
+def events(data):
+	data = memoryview(data)
+	end = len(data)
+	if end < 32:
+		raise EventlogError("eventlog: truncated")
+
+	# The first event is always in the SHA1 format; if it is the Spec ID
+	# event then the rest of the log uses the crypto-agile format
+	pcr, etype = struct.unpack_from('<II', data, 0)
+	size = struct.unpack_from('<I', data, 28)[0]
+	if 32 + size > end:
+		raise EventlogError("eventlog: truncated first event")
+	event = data[32:32 + size]
+	yield pcr, etype, { 'sha1': data[8:28] }, event
+	off = 32 + size
+
+	sizes = None
+	if etype == EV_NO_ACTION and bytes(event[0:16]) == SPEC_ID_EVENT03:
+		if size < 28:
+			raise EventlogError("eventlog: truncated Spec ID event")
+		nalgs = struct.unpack_from('<I', event, 24)[0]
+		if 28 + nalgs * 4 > size:
+			raise EventlogError("eventlog: bad Spec ID event")
+		sizes = {}
+		for i in range(nalgs):
+			alg, dsize = struct.unpack_from('<HH', event, 28 + i * 4)
+			sizes[alg] = dsize
+
+	while off < end:
+		if sizes is None:
+			if off + 32 > end:
+				raise EventlogError(f"eventlog: truncated event at {off}")
+			pcr, etype = struct.unpack_from('<II', data, off)
+			digests = { 'sha1': data[off + 8:off + 28] }
+			off += 28
+		else:
+			if off + 12 > end:
+				raise EventlogError(f"eventlog: truncated event at {off}")
+			pcr, etype, count = struct.unpack_from('<III', data, off)
+			off += 12
+			digests = {}
+			for i in range(count):
+				if off + 2 > end:
+					raise EventlogError(f"eventlog: truncated digest at {off}")
+				alg = struct.unpack_from('<H', data, off)[0]
+				if alg not in sizes:
+					raise EventlogError(f"eventlog: unknown digest algorithm {alg:#x} at {off}")
+				dsize = sizes[alg]
+				digests[hash_algs.get(alg, f"{alg:#x}")] = data[off + 2:off + 2 + dsize]
+				off += 2 + dsize
+		if off + 4 > end:
+			raise EventlogError(f"eventlog: truncated event at {off}")
+		size = struct.unpack_from('<I', data, off)[0]
+		off += 4
+		if off + size > end:
+			raise EventlogError(f"eventlog: truncated event data at {off}")
+		yield pcr, etype, digests, data[off:off + size]
+		off += size
+
+# Replay the digests in the log into PCR values, in one pass over the log.
+def replay(data):
+	banks = {}
+	locality = 0
+	for pcr, etype, digests, event in events(data):
+		if etype == EV_NO_ACTION:
+			# not extended into the PCRs; the locality that the TPM
+			# was started from is the initial value of PCR0
+			if bytes(event[0:16]) == STARTUP_LOCALITY and len(event) >= 17:
+				locality = event[16]
+			continue
+		if pcr >= NUM_PCRS:
+			raise EventlogError(f"eventlog: bad PCR index {pcr}")
+		for alg, digest in digests.items():
+			bank = banks.get(alg)
+			if bank is None:
+				bank = banks[alg] = [ None ] * NUM_PCRS
+			value = bank[pcr]
+			if value is None:
+				value = bytearray(len(digest))
+				if pcr == 0:
+					value[-1] = locality
+			try:
+				bank[pcr] = hashlib.new(alg, value + digest).digest()
+			except ValueError:
+				raise EventlogError(f"eventlog: unsupported digest algorithm {alg}")
+
+	pcrs = {}
+	for alg, bank in banks.items():
+		pcrs[alg] = { pcr: int.from_bytes(value, 'big')
+			for pcr, value in enumerate(bank)
+			if value is not None and any(value) }
+	return pcrs
+
+# Print the PCRs in the same format as the `pcrs:` section of `tpm2
+# eventlog`, so that the output can be given to tpm2-pcr-validate.
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: tpm2_eventlog.py eventlog.bin", file=sys.stderr)
+		exit(1)
+	with open(sys.argv[1], 'rb') as f:
+		pcrs = replay(f.read())
+	print("pcrs:")
+	for alg, bank in pcrs.items():
+		print(f"  {alg}:")
+		size = hashlib.new(alg).digest_size
+		for pcr, value in bank.items():
+			print(f"    {pcr} : 0x{value:0{size * 2}X}")
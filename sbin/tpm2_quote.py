@@ -0,0 +1,393 @@
+"""
+In-process TPM2 quote verification.
+
+This is a python implementation of `tpm2-attest quote-verify`, for use by the
+attestation server so that it doesn't have to fork `tpm2 print` and `tpm2
+checkquote` for every request. It parses the TPM2 structures that `tpm2-attest
+quote` puts in the quote tarball (TPMS_ATTEST, TPMT_PUBLIC, TPMT_SIGNATURE and
+the tpm2-tools PCR file), applies the same checks as the shell code, and
+returns the result as a dict with the same shape as the YAML that `tpm2-attest
+verify` prints on stdout;
+
+	{ 'ekhash': '...', 'pcrs': { 'sha256': { 0: 0x..., ... } } }
+
+Any failure raises QuoteError.
+"""
+import hashlib
+import os
+import struct
+import tarfile
+import time
+
+try:
+	from cryptography.exceptions import InvalidSignature
+	from cryptography.hazmat.primitives import hashes
+	from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+	from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+	have_crypto = True
+except ImportError:
+	have_crypto = False
+
+# Expected attributes for the attestation key, in the order that `tpm2 print`
+# displays them. This must match AK_TYPE in sbin/tpm2-attest.
+AK_TYPE = 'fixedtpm|stclear|fixedparent|sensitivedataorigin|userwithauth|restricted|sign'
+
+# Maximum age (in seconds) of a time-based nonce, as per sbin/tpm2-attest. Zero
+# disables the check. sbin/attest-server exports the one that tpm2-attest
+# would use, which might be set in safeboot.conf or local.conf.
+QUOTE_MAX_AGE = int(os.environ.get('QUOTE_MAX_AGE', '30'))
+
+# Constants from the TPM2 specification (Part 2: Structures)
+TPM_GENERATED_VALUE = 0xff544347
+TPM_ST_ATTEST_QUOTE = 0x8018
+
+TPM_ALG_RSA = 0x0001
+TPM_ALG_SHA1 = 0x0004
+TPM_ALG_SHA256 = 0x000b
+TPM_ALG_SHA384 = 0x000c
+TPM_ALG_SHA512 = 0x000d
+TPM_ALG_NULL = 0x0010
+TPM_ALG_RSASSA = 0x0014
+TPM_ALG_RSAPSS = 0x0016
+TPM_ALG_ECDSA = 0x0018
+TPM_ALG_ECC = 0x0023
+
+TPM_ECC_NIST_P256 = 0x0003
+TPM_ECC_NIST_P384 = 0x0004
+TPM_ECC_NIST_P521 = 0x0005
+
+# Hash algorithm IDs to the names used by tpm2-tools (and in our YAML)
+hash_algs = {
+	TPM_ALG_SHA1: 'sha1',
+	TPM_ALG_SHA256: 'sha256',
+	TPM_ALG_SHA384: 'sha384',
+	TPM_ALG_SHA512: 'sha512',
+}
+
+# TPMA_OBJECT bits, in the order that tpm2-tools prints them
+object_attributes = [
+	(0x00000002, 'fixedtpm'),
+	(0x00000004, 'stclear'),
+	(0x00000010, 'fixedparent'),
+	(0x00000020, 'sensitivedataorigin'),
+	(0x00000040, 'userwithauth'),
+	(0x00000080, 'adminwithpolicy'),
+	(0x00000400, 'noda'),
+	(0x00000800, 'encryptedduplication'),
+	(0x00010000, 'restricted'),
+	(0x00020000, 'decrypt'),
+	(0x00040000, 'sign'),
+]
+
+class QuoteError(Exception):
+	pass
+
+# Render TPMA_OBJECT the way `tpm2 print` does, so that the attribute checks
+# can be written exactly the same way as in sbin/tpm2-attest.
+def attributes_str(attrs):
+	return '|'.join(name for bit, name in object_attributes if attrs & bit)
+
+# Cursor over big-endian TPM2 marshalled data.
+class Reader:
+	def __init__(self, data, what):
+		self.buf = memoryview(data)
+		self.off = 0
+		self.what = what
+
+	def take(self, n):
+		if self.off + n > len(self.buf):
+			raise QuoteError(f"{self.what}: truncated")
+		v = self.buf[self.off:self.off + n]
+		self.off += n
+		return v
+
+	def u8(self):
+		return self.take(1)[0]
+
+	def u16(self):
+		return struct.unpack('>H', self.take(2))[0]
+
+	def u32(self):
+		return struct.unpack('>I', self.take(4))[0]
+
+	def u64(self):
+		return struct.unpack('>Q', self.take(8))[0]
+
+	def tpm2b(self):
+		return bytes(self.take(self.u16()))
+
+	def done(self):
+		if self.off != len(self.buf):
+			raise QuoteError(f"{self.what}: {len(self.buf) - self.off} trailing bytes")
+
+# Expand a pcrSelect bitmap into a list of PCR indices
+def select_to_pcrs(select):
+	return [ i * 8 + b for i, byte in enumerate(select) for b in range(8) if byte & (1 << b) ]
+
+# TPML_PCR_SELECTION -> [ (hashalg, [ pcr, ... ]), ... ]
+def parse_pcr_selection(r):
+	sels = []
+	for _ in range(r.u32()):
+		alg = r.u16()
+		sels.append((alg, select_to_pcrs(r.take(r.u8()))))
+	return sels
+
+# Parse a TPMS_ATTEST (the `quote.out` file) that contains a TPMS_QUOTE_INFO.
+def parse_attest(data):
+	r = Reader(data, 'TPMS_ATTEST')
+	if r.u32() != TPM_GENERATED_VALUE:
+		raise QuoteError("TPMS_ATTEST: bad magic")
+	if r.u16() != TPM_ST_ATTEST_QUOTE:
+		raise QuoteError("TPMS_ATTEST: not a quote")
+	a = {}
+	a['qualifiedSigner'] = r.tpm2b()
+	a['extraData'] = r.tpm2b()
+	a['clock'] = r.u64()
+	a['resetCount'] = r.u32()
+	a['restartCount'] = r.u32()
+	a['safe'] = r.u8()
+	a['firmwareVersion'] = r.u64()
+	a['pcrSelect'] = parse_pcr_selection(r)
+	a['pcrDigest'] = r.tpm2b()
+	r.done()
+	return a
+
+# TPMT_SYM_DEF_OBJECT, TPMT_*_SCHEME and TPMT_KDF_SCHEME all have a trailing
+# field only when the algorithm isn't TPM_ALG_NULL. For the symmetric
+# definition that's keyBits+mode, for the schemes it's the hash algorithm.
+def parse_alg_and_details(r, ndetails):
+	alg = r.u16()
+	details = [ r.u16() for _ in range(ndetails) ] if alg != TPM_ALG_NULL else []
+	return alg, details
+
+# Parse a TPMT_PUBLIC (`ak.pub`, from `tpm2 readpublic --format tpmt`). Only
+# RSA and ECC keys are supported.
+def parse_public(data, what='TPMT_PUBLIC', r=None):
+	if r is None:
+		r = Reader(data, what)
+	p = {}
+	p['type'] = r.u16()
+	p['nameAlg'] = r.u16()
+	p['attributes'] = r.u32()
+	p['authPolicy'] = r.tpm2b()
+	p['symmetric'] = parse_alg_and_details(r, 2)
+	if p['type'] == TPM_ALG_RSA:
+		p['scheme'] = parse_alg_and_details(r, 1)
+		p['keyBits'] = r.u16()
+		p['exponent'] = r.u32() or 65537
+		p['modulus'] = r.tpm2b()
+	elif p['type'] == TPM_ALG_ECC:
+		p['scheme'] = parse_alg_and_details(r, 1)
+		p['curveID'] = r.u16()
+		p['kdf'] = parse_alg_and_details(r, 1)
+		p['x'] = r.tpm2b()
+		p['y'] = r.tpm2b()
+	else:
+		raise QuoteError(f"{what}: unsupported key type {p['type']:#x}")
+	r.done()
+	return p
+
+# Parse a TPM2B_PUBLIC (`ek.pub`, from `tpm2 createek`).
+def parse_tpm2b_public(data, what='TPM2B_PUBLIC'):
+	r = Reader(data, what)
+	size = r.u16()
+	if size != len(data) - 2:
+		raise QuoteError(f"{what}: size mismatch")
+	return parse_public(data, what, r)
+
+# Parse a TPMT_SIGNATURE (`quote.sig`)
+def parse_signature(data):
+	r = Reader(data, 'TPMT_SIGNATURE')
+	s = {}
+	s['sigAlg'] = r.u16()
+	s['hashAlg'] = r.u16()
+	if s['sigAlg'] in (TPM_ALG_RSASSA, TPM_ALG_RSAPSS):
+		s['sig'] = r.tpm2b()
+	elif s['sigAlg'] == TPM_ALG_ECDSA:
+		s['r'] = r.tpm2b()
+		s['s'] = r.tpm2b()
+	else:
+		raise QuoteError(f"TPMT_SIGNATURE: unsupported algorithm {s['sigAlg']:#x}")
+	r.done()
+	return s
+
+# Parse the PCR file written by `tpm2 quote --pcr`. This isn't a TPM
+# structure, it is the in-memory TPML_PCR_SELECTION followed by a count and
+# that many in-memory TPML_DIGESTs (8 slots of 2+64 bytes each). Older
+# tpm2-tools write these in host (little-endian) order, newer ones convert the
+# integers to network order, so we sniff the selection count to tell them
+# apart. Returns { 'sha256': { pcr: int }, ... } plus the raw PCR values in
+# selection order (for computing the PCR digest).
+def parse_pcrs(data):
+	if len(data) < 132 + 4:
+		raise QuoteError("quote.pcr: truncated")
+	e = '<' if 0 < struct.unpack_from('<I', data, 0)[0] <= 16 else '>'
+	nsel = struct.unpack_from(e + 'I', data, 0)[0]
+	if not 0 < nsel <= 16:
+		raise QuoteError("quote.pcr: bad selection count")
+	sels = []
+	for i in range(nsel):
+		alg, size = struct.unpack_from(e + 'HB', data, 4 + i * 8)
+		if size > 4:
+			raise QuoteError("quote.pcr: bad selection size")
+		sels.append((alg, select_to_pcrs(data[4 + i * 8 + 3:4 + i * 8 + 3 + size])))
+	off = 132
+	ndigests = struct.unpack_from(e + 'I', data, off)[0]
+	off += 4
+	if len(data) != off + ndigests * 532:
+		raise QuoteError("quote.pcr: size mismatch")
+	values = []
+	for i in range(ndigests):
+		count = struct.unpack_from(e + 'I', data, off)[0]
+		if count > 8:
+			raise QuoteError("quote.pcr: bad digest count")
+		for j in range(count):
+			p = off + 4 + j * 66
+			size = struct.unpack_from(e + 'H', data, p)[0]
+			if size > 64:
+				raise QuoteError("quote.pcr: bad digest size")
+			values.append(bytes(data[p + 2:p + 2 + size]))
+		off += 532
+	pcrs = {}
+	raw = []
+	for alg, indices in sels:
+		bank = pcrs.setdefault(hash_algs.get(alg, f"{alg:#x}"), {})
+		for pcr in indices:
+			if not values:
+				raise QuoteError("quote.pcr: too few digests")
+			v = values.pop(0)
+			bank[pcr] = int.from_bytes(v, 'big')
+			raw.append(v)
+	if values:
+		raise QuoteError("quote.pcr: too many digests")
+	return sels, pcrs, raw
+
+def hash_ctor(alg):
+	if alg not in hash_algs:
+		raise QuoteError(f"unsupported hash algorithm {alg:#x}")
+	return getattr(hashlib, hash_algs[alg])
+
+def crypto_hash(alg):
+	return { 'sha1': hashes.SHA1, 'sha256': hashes.SHA256,
+		 'sha384': hashes.SHA384, 'sha512': hashes.SHA512 }[hash_algs[alg]]()
+
+# Build a `cryptography` public key object from a parsed TPMT_PUBLIC
+def public_key(p):
+	if p['type'] == TPM_ALG_RSA:
+		n = int.from_bytes(p['modulus'], 'big')
+		return rsa.RSAPublicNumbers(p['exponent'], n).public_key()
+	curves = {
+		TPM_ECC_NIST_P256: ec.SECP256R1,
+		TPM_ECC_NIST_P384: ec.SECP384R1,
+		TPM_ECC_NIST_P521: ec.SECP521R1,
+	}
+	if p['curveID'] not in curves:
+		raise QuoteError(f"unsupported ECC curve {p['curveID']:#x}")
+	x = int.from_bytes(p['x'], 'big')
+	y = int.from_bytes(p['y'], 'big')
+	return ec.EllipticCurvePublicNumbers(x, y, curves[p['curveID']]()).public_key()
+
+# Verify a TPMT_SIGNATURE over a message with a parsed TPMT_PUBLIC. This is
+# the signature half of `tpm2 checkquote`.
+def verify_signature(pub, sig, message):
+	key = public_key(pub)
+	h = crypto_hash(sig['hashAlg'])
+	try:
+		if sig['sigAlg'] == TPM_ALG_ECDSA:
+			if pub['type'] != TPM_ALG_ECC:
+				raise QuoteError("ECDSA signature with a non-ECC key")
+			der = encode_dss_signature(int.from_bytes(sig['r'], 'big'),
+						   int.from_bytes(sig['s'], 'big'))
+			key.verify(der, message, ec.ECDSA(h))
+		elif pub['type'] != TPM_ALG_RSA:
+			raise QuoteError("RSA signature with a non-RSA key")
+		elif sig['sigAlg'] == TPM_ALG_RSASSA:
+			key.verify(sig['sig'], message, padding.PKCS1v15(), h)
+		else:
+			key.verify(sig['sig'], message,
+				   padding.PSS(mgf=padding.MGF1(h),
+					       salt_length=padding.PSS.AUTO), h)
+	except InvalidSignature:
+		raise QuoteError("quote signature does not verify")
+
+# Read the files out of a quote tarball (as produced by `tpm2-attest quote`)
+# into a dict of { name: bytes }. `quote` may be a path or a file object.
+def unpack(quote):
+	files = {}
+	try:
+		if isinstance(quote, (str, bytes, os.PathLike)):
+			tf = tarfile.open(quote, mode='r:*')
+		else:
+			tf = tarfile.open(fileobj=quote, mode='r:*')
+		with tf:
+			for m in tf:
+				if not m.isfile():
+					continue
+				files[os.path.normpath(m.name)] = tf.extractfile(m).read()
+	except tarfile.TarError as e:
+		raise QuoteError(f"unable to unpack quote: {e}")
+	if 'ek.pub' not in files:
+		raise QuoteError("quote is missing EK public key")
+	return files
+
+def ekhash(files):
+	return hashlib.sha256(files['ek.pub']).hexdigest()
+
+# This is `tpm2-attest quote-verify`. `files` is the output of unpack(). If
+# `nonce` is None, the nonce in the quote is used and its age is checked
+# against `max_age` (if non-zero). Returns the verified quote as a dict (see
+# the top of this file), or raises QuoteError.
+def verify(files, nonce=None, max_age=None, now=None):
+	for f in ('ak.pub', 'quote.out', 'quote.sig', 'quote.pcr'):
+		if f not in files:
+			raise QuoteError(f"quote is missing {f}")
+	if max_age is None:
+		max_age = QUOTE_MAX_AGE
+
+	attest = parse_attest(files['quote.out'])
+
+	if nonce is None:
+		# if no nonce was specified, read it from the tar file
+		# and check it for freshness compared to the current time
+		if 'nonce' not in files:
+			raise QuoteError("quote is missing nonce")
+		nonce = files['nonce'].decode('ascii', 'replace').strip()
+		try:
+			quote_time = int(nonce, 16)
+		except ValueError:
+			raise QuoteError(f"nonce is not hex: {nonce}")
+		verify_time = int(now if now is not None else time.time())
+		if max_age != 0 and verify_time - quote_time > max_age:
+			raise QuoteError(f"Old nonce: {quote_time} > {verify_time} + {max_age}")
+
+	# Read the attributes from the ak.pub and ensure that they if `stclear`
+	# is not set, then an attacker might have a persistent version of this
+	# key and they could reboot into an untrusted state.
+	ak = parse_public(files['ak.pub'], 'ak.pub')
+	if not attributes_str(ak['attributes']).startswith(AK_TYPE):
+		raise QuoteError(f"ak.pub: incorrect key attributes {attributes_str(ak['attributes'])}")
+
+	sig = parse_signature(files['quote.sig'])
+	verify_signature(ak, sig, files['quote.out'])
+
+	try:
+		qualification = bytes.fromhex(nonce)
+	except ValueError:
+		raise QuoteError(f"nonce is not hex: {nonce}")
+	if attest['extraData'] != qualification:
+		raise QuoteError(f"unable to verify quote with '{nonce}'")
+
+	# The PCR values are not signed; check them against the digest that is.
+	sels, pcrs, raw = parse_pcrs(files['quote.pcr'])
+	if sels != attest['pcrSelect']:
+		raise QuoteError("quote.pcr selection does not match the quote")
+	h = hash_ctor(sig['hashAlg'])()
+	for v in raw:
+		h.update(v)
+	if h.digest() != attest['pcrDigest']:
+		raise QuoteError("PCR digest does not match the quote")
+
+	return {
+		'ekhash': ekhash(files),
+		'pcrs': pcrs,
+	}
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+In-process sealing of attestation responses.
+
+This is a python implementation of `tpm2-attest seal`, for use by the
+attestation server so that it doesn't have to fork `tpm2-attest` (and through
+it `tar`, `openssl` and `tpm2 makecredential --tcti none`) for every request.
+The response is the same tarball that the shell code produces, so attesting
+hosts unseal it with `tpm2-attest unseal` as before;
+
+	credential.bin	a random 32 byte key, wrapped by TPM2_MakeCredential for
+			the EK and the name of the AK, in the file format of
+			`tpm2 makecredential` (see credential_file())
+	cipher.bin	the secrets, encrypted with that key as per
+			aead_encrypt in functions.sh
+	ak.ctx		the AK context, as sent in the quote
+
+Any failure raises SealError.
+"""
+import hashlib
+import hmac
+import io
+import os
+import struct
+import tarfile
+import time
+
+import tpm2_quote
+
+try:
+	from cryptography.hazmat.primitives.asymmetric import padding
+	from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+	try:
+		from cryptography.hazmat.decrepit.ciphers.modes import CFB
+	except ImportError:
+		CFB = modes.CFB
+	have_crypto = True
+except ImportError:
+	have_crypto = False
+
+class SealError(Exception):
+	pass
+
+# Constants from the TPM2 specification (Part 2: Structures)
+TPM_ALG_AES = 0x0006
+TPM_ALG_CFB = 0x0043
+
+# The header of the files written by tpm2-tools
+TPM2_TOOLS_MAGIC = 0xbadcc0de
+TPM2_TOOLS_VERSION = 1
+
+# KDFa from the TPM2 specification (Part 1, 11.4.10.2); the SP800-108 counter
+# mode KDF with HMAC, producing 'bits' bits of key.
+def kdfa(alg, key, label, context_u, context_v, bits):
+	digest = tpm2_quote.hash_ctor(alg)
+	out = b''
+	counter = 0
+	while len(out) * 8 < bits:
+		counter += 1
+		out += hmac.new(key, struct.pack('>I', counter) + label + b'\0' +
+			context_u + context_v + struct.pack('>I', bits), digest).digest()
+	return out[0:(bits + 7) // 8]
+
+# TPM2_MakeCredential (Part 3, 12.6) done in software, as `tpm2 makecredential
+# --tcti none` does. 'ek' is the parsed EK public key, 'name' the name of the
+# AK and 'secret' the credential to wrap. Only RSA EKs with an AES-CFB
+# symmetric algorithm (as in the default EK templates) are supported. Returns
+# the TPM2B_ID_OBJECT and TPM2B_ENCRYPTED_SECRET contents (without their size
+# fields) and takes the seed from 'rand' (for testing).
+def make_credential(ek, name, secret, rand=os.urandom):
+	if ek['type'] != tpm2_quote.TPM_ALG_RSA:
+		raise SealError("EK is not an RSA key")
+	sym_alg, sym_details = ek['symmetric']
+	if sym_alg != TPM_ALG_AES or sym_details[1] != TPM_ALG_CFB:
+		raise SealError("EK symmetric algorithm is not AES-CFB")
+	name_alg = ek['nameAlg']
+	digest = tpm2_quote.hash_ctor(name_alg)
+	if len(secret) > digest().digest_size:
+		raise SealError("credential is too large")
+
+	# the seed is shared with the TPM by encrypting it to the EK
+	seed = rand(digest().digest_size)
+	h = tpm2_quote.crypto_hash(name_alg)
+	try:
+		encrypted_seed = tpm2_quote.public_key(ek).encrypt(seed,
+			padding.OAEP(mgf=padding.MGF1(h), algorithm=h, label=b'IDENTITY\0'))
+	except ValueError as e:
+		raise SealError(f"unable to encrypt seed to EK: {e}")
+
+	# the credential (a TPM2B_DIGEST) is encrypted with a key derived from
+	# the seed and the AK's name, and integrity protected with another
+	sym_key = kdfa(name_alg, seed, b'STORAGE', name, b'', sym_details[0])
+	hmac_key = kdfa(name_alg, seed, b'INTEGRITY', b'', b'', digest().digest_size * 8)
+	enc = Cipher(algorithms.AES(sym_key), CFB(bytes(16))).encryptor()
+	enc_identity = enc.update(struct.pack('>H', len(secret)) + secret) + enc.finalize()
+	integrity = hmac.new(hmac_key, enc_identity + name, digest).digest()
+
+	credential = struct.pack('>H', len(integrity)) + integrity + enc_identity
+	return credential, encrypted_seed
+
+# TPM2_ActivateCredential (Part 3, 12.5), the inverse of make_credential(),
+# done in software with the EK's private key (a `cryptography` RSA private
+# key). This is only for testing the above.
+def activate_credential(ek, ek_key, name, credential, encrypted_seed):
+	name_alg = ek['nameAlg']
+	digest = tpm2_quote.hash_ctor(name_alg)
+	h = tpm2_quote.crypto_hash(name_alg)
+	seed = ek_key.decrypt(encrypted_seed,
+		padding.OAEP(mgf=padding.MGF1(h), algorithm=h, label=b'IDENTITY\0'))
+	size = struct.unpack_from('>H', credential, 0)[0]
+	integrity, enc_identity = credential[2:2 + size], credential[2 + size:]
+	hmac_key = kdfa(name_alg, seed, b'INTEGRITY', b'', b'', digest().digest_size * 8)
+	if not hmac.compare_digest(integrity, hmac.new(hmac_key, enc_identity + name, digest).digest()):
+		raise SealError("credential does not verify")
+	sym_key = kdfa(name_alg, seed, b'STORAGE', name, b'', ek['symmetric'][1][0])
+	dec = Cipher(algorithms.AES(sym_key), CFB(bytes(16))).decryptor()
+	identity = dec.update(enc_identity) + dec.finalize()
+	return identity[2:2 + struct.unpack_from('>H', identity, 0)[0]]
+
+# The credential and encrypted seed as written to `--credential-blob` by
+# `tpm2 makecredential`, and read by `tpm2 activatecredential`
+def credential_file(credential, encrypted_seed):
+	return struct.pack('>II', TPM2_TOOLS_MAGIC, TPM2_TOOLS_VERSION) + \
+		struct.pack('>H', len(credential)) + credential + \
+		struct.pack('>H', len(encrypted_seed)) + encrypted_seed
+
+def parse_credential_file(data):
+	r = tpm2_quote.Reader(data, 'credential.bin')
+	if (r.u32(), r.u32()) != (TPM2_TOOLS_MAGIC, TPM2_TOOLS_VERSION):
+		raise SealError("credential.bin: bad header")
+	credential = r.tpm2b()
+	encrypted_seed = r.tpm2b()
+	r.done()
+	return credential, encrypted_seed
+
+# aead_encrypt from functions.sh: a 16 byte confounder and the plaintext,
+# AES-256-CBC with a zero IV and a key derived by `openssl enc -iter 1 -md
+# SHA256 -nosalt` from the hex of 'key', followed by the HMAC-SHA-256 (keyed
+# with the SHA-256 of 'key') of the ciphertext. 'plaintext' may be any
+# bytes-like object.
+def aead_keys(key):
+	enc_key = hashlib.pbkdf2_hmac('sha256', key.hex().encode(), b'', 1, 32)
+	mac_key = hashlib.sha256(key).digest()
+	return enc_key, mac_key
+
+def aead_encrypt(key, plaintext, rand=os.urandom):
+	enc_key, mac_key = aead_keys(key)
+	enc = Cipher(algorithms.AES(enc_key), modes.CBC(bytes(16))).encryptor()
+	pad = 16 - (16 + len(plaintext)) % 16
+	ciphertext = enc.update(rand(16)) + enc.update(plaintext) + \
+		enc.update(bytes([pad]) * pad) + enc.finalize()
+	return ciphertext + hmac.new(mac_key, ciphertext, hashlib.sha256).digest()
+
+# aead_decrypt from functions.sh, the inverse of the above
+def aead_decrypt(key, data):
+	enc_key, mac_key = aead_keys(key)
+	if len(data) < 64 or (len(data) - 32) % 16 != 0:
+		raise SealError("ciphertext is too short")
+	ciphertext, mac = data[:-32], data[-32:]
+	if not hmac.compare_digest(mac, hmac.new(mac_key, ciphertext, hashlib.sha256).digest()):
+		raise SealError("ciphertext does not verify")
+	dec = Cipher(algorithms.AES(enc_key), modes.CBC(bytes(16))).decryptor()
+	plaintext = dec.update(ciphertext) + dec.finalize()
+	pad = plaintext[-1]
+	if not 1 <= pad <= 16 or plaintext[-pad:] != bytes([pad]) * pad:
+		raise SealError("bad padding")
+	return plaintext[16:-pad]
+
+def tar_files(members):
+	out = io.BytesIO()
+	now = int(time.time())
+	with tarfile.open(fileobj=out, mode='w', format=tarfile.GNU_FORMAT) as tf:
+		for name, data in members:
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			info.mtime = now
+			info.mode = 0o644
+			tf.addfile(info, io.BytesIO(data))
+	return out.getvalue()
+
+# This is `tpm2-attest seal`. `files` is the output of tpm2_quote.unpack()
+# and 'plaintext' the secrets to seal (any bytes-like object). Returns the
+# response tarball.
+def seal(files, plaintext):
+	for name in ('ek.pub', 'ak.pub', 'ak.ctx'):
+		if name not in files:
+			raise SealError(f"quote is missing {name}")
+	try:
+		ek = tpm2_quote.parse_tpm2b_public(files['ek.pub'], 'ek.pub')
+		tpm2_quote.public_key(ek)
+	except (tpm2_quote.QuoteError, ValueError) as e:
+		raise SealError(f"unable to parse EK: {e}")
+
+	# the same "name" as `tpm2-attest seal` uses for the AK, so that the
+	# TPM will only release the key to an AK that it generated
+	name = b'\x00\x0b' + hashlib.sha256(files['ak.pub']).digest()
+
+	key = os.urandom(32)
+	credential, encrypted_seed = make_credential(ek, name, key)
+	cipher = aead_encrypt(key, plaintext)
+	return tar_files([
+		('credential.bin', credential_file(credential, encrypted_seed)),
+		('cipher.bin', cipher),
+		('ak.ctx', files['ak.ctx']),
+	])
+
+if __name__ == '__main__':
+	import sys
+
+	# Commands for testing against the shell implementations;
+	#	tpm2_seal.py seal quote.tar < secret > sealed.tar
+	#	tpm2_seal.py activate quote.tar ek.pem < sealed.tar > secret.key
+	#	tpm2_seal.py aead-encrypt key-file < plaintext > ciphertext
+	#	tpm2_seal.py aead-decrypt key-file < ciphertext > plaintext
+	# where `activate` unwraps the key in credential.bin with the private
+	# key of a software EK, standing in for `tpm2 activatecredential`.
+	cmds = { 'seal': 3, 'activate': 4, 'aead-encrypt': 3, 'aead-decrypt': 3 }
+	if len(sys.argv) < 2 or cmds.get(sys.argv[1]) != len(sys.argv):
+		print("Usage: tpm2_seal.py seal|activate|aead-encrypt|aead-decrypt file...", file=sys.stderr)
+		sys.exit(1)
+	data = sys.stdin.buffer.read()
+	try:
+		if sys.argv[1] == 'seal':
+			out = seal(tpm2_quote.unpack(sys.argv[2]), data)
+		elif sys.argv[1] == 'activate':
+			from cryptography.hazmat.primitives.serialization import load_pem_private_key
+			files = tpm2_quote.unpack(sys.argv[2])
+			ek = tpm2_quote.parse_tpm2b_public(files['ek.pub'], 'ek.pub')
+			with open(sys.argv[3], 'rb') as f:
+				ek_key = load_pem_private_key(f.read(), None)
+			with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+				blob = tf.extractfile('credential.bin').read()
+			name = b'\x00\x0b' + hashlib.sha256(files['ak.pub']).digest()
+			out = activate_credential(ek, ek_key, name, *parse_credential_file(blob))
+		else:
+			with open(sys.argv[2], 'rb') as f:
+				key = f.read()
+			if sys.argv[1] == 'aead-encrypt':
+				out = aead_encrypt(key, data)
+			else:
+				out = aead_decrypt(key, data)
+	except (SealError, tpm2_quote.QuoteError) as e:
+		print(f"{sys.argv[2]}: {e}", file=sys.stderr)
+		sys.exit(1)
+	sys.stdout.buffer.write(out)
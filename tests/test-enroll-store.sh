@@ -0,0 +1,143 @@
+#!/bin/bash
+# Replicate a single-file enrollment store (sbin/enroll_store.py) through the
+# change notifier (hcp/enrollsvc/repl_notify.py), and check that the replica
+# looks up the same enrollments as the store it replicates
+set -e -o pipefail
+export LC_ALL=C
+
+die() { echo "$@" >&2 ; exit 1 ; }
+warn() { echo "$@" >&2 ; }
+
+DIR="`dirname $0`"
+export PYTHONPATH="$DIR/../hcp/enrollsvc:$DIR/../sbin:$DIR/../hcp/python${PYTHONPATH:+:$PYTHONPATH}"
+
+rm -rf /tmp/enroll-store && mkdir /tmp/enroll-store
+
+warn "--- Full and incremental deltas, tombstones and prepared enrollments"
+python3 - /tmp/enroll-store <<'PY' \
+|| die "enroll_store: replication checks failed"
+import hashlib, io, json, sys, tarfile, threading
+import enroll_index, enroll_store, repl_notify
+from enroll_store import Store, StoreError
+
+top = sys.argv[1]
+src = Store(f'{top}/src.db', 'rwc', wal=True)
+rep = Store(f'{top}/rep.db', 'rwc')
+
+def serve(store):
+	watcher = repl_notify.HeadWatcher({ '': store.path }, lambda path: store.head())
+	server = repl_notify.Server(0, watcher, store)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return f"http://127.0.0.1:{server.server_address[1]}"
+
+def ekpubhash(i):
+	return hashlib.sha256(b'ek%d' % i).hexdigest()
+
+GOLDEN = b'pcrs:\n  sha256:\n    0: 0x' + b'ab' * 32 + b'\n'
+
+def enroll(store, i, pcrs=GOLDEN):
+	files = [ ('secret', 0o600, b'secret %d' % i), ('sub/other', 0o644, b'other') ]
+	if pcrs is not None:
+		files.append(('pcrs', 0o644, pcrs))
+	with store.write() as w:
+		if not w.put(ekpubhash(i), f'host{i}.example.com', files):
+			sys.exit(f"{i}: already enrolled")
+
+def members(bundle):
+	with tarfile.open(fileobj=io.BytesIO(bytes(bundle))) as tf:
+		return sorted((m.name, tf.extractfile(m).read() if m.isfile() else None)
+			for m in tf)
+
+# What attest-verify sees of every enrollment, and what find sees
+def view(store):
+	out = {}
+	for i in range(8):
+		e = store.lookup(ekpubhash(i))
+		if e is None:
+			continue
+		pcrs = e.pcrs.digest if isinstance(e.pcrs, enroll_index.PCRSet) else type(e.pcrs).__name__
+		out[i] = (e.flags, pcrs, members(store.bundle(ekpubhash(i), e)))
+	return out, store.find('example.com'), store.read_tofu_pcrs()
+
+# Pull, checking that the delta is (or isn't) a full one
+def check(what, full):
+	if next(src.delta(rep.upstream()))['full'] != full:
+		sys.exit(f"{what}: expected {'a full' if full else 'an incremental'} delta")
+	head = enroll_store.pull(rep, url)
+	if head != src.head() or rep.upstream() != head:
+		sys.exit(f"{what}: replica is at {head}, not {src.head()}")
+	if view(rep) != view(src):
+		sys.exit(f"{what}: replica differs\n{view(rep)}\n{view(src)}")
+	delta = list(src.delta(head))
+	if len(delta) != 2 or delta[0]['full']:
+		sys.exit(f"{what}: the replica isn't up to date: {delta}")
+
+url = serve(src)
+for i in range(4):
+	enroll(src, i)
+enroll(src, 4, pcrs=None)
+enroll(src, 5, pcrs=b'pcrs: [\n')
+with src.write() as w:
+	w.set_tofu_pcrs('- 0\n- 1\n')
+check("first pull", full=True)
+
+# the prepared golden PCRs, each set stored once
+e = rep.lookup(ekpubhash(0))
+if not e.flags & enroll_index.PCRS or not isinstance(e.pcrs, enroll_index.PCRSet):
+	sys.exit("golden PCRs weren't prepared")
+if rep.conn().execute('SELECT COUNT(*) FROM pcrsets').fetchone()[0] != 1:
+	sys.exit("golden PCR sets aren't shared")
+if not isinstance(rep.lookup(ekpubhash(5)).pcrs, enroll_index.Unusable):
+	sys.exit("bad golden PCRs weren't prepared as unusable")
+
+# an incremental delta has only the changes, and the deletions
+since = src.head()
+with src.write() as w:
+	if len(w.delete(ekpubhash(1)[0:32])) != 1:
+		sys.exit("delete didn't")
+enroll(src, 6)
+delta = list(src.delta(since))
+if delta[0]['full'] or [ d.get('put') or d.get('delete') for d in delta[1:-1] ] != \
+		[ ekpubhash(6)[0:32], ekpubhash(1)[0:32] ]:
+	sys.exit(f"incremental delta: {delta}")
+check("incremental pull", full=False)
+if rep.lookup(ekpubhash(1)) is not None:
+	sys.exit("tombstone wasn't applied")
+
+# re-enrolling a deleted TPM drops its tombstone
+enroll(src, 1)
+check("re-enrollment", full=False)
+
+# an incomplete delta changes nothing
+before = view(rep)
+upstream = rep.upstream()
+with src.write() as w:
+	w.delete(ekpubhash(2)[0:32])
+enroll(src, 7)
+lines = [ json.dumps(d) for d in src.delta(upstream) ]
+try:
+	rep.apply(lines[:-1])
+	sys.exit("incomplete delta was applied")
+except StoreError:
+	pass
+if view(rep) != before or rep.upstream() != upstream:
+	sys.exit("incomplete delta wasn't rolled back")
+check("pull after an incomplete delta", full=False)
+
+# another store (a new origin) can't send an incremental delta, it sends all
+# of itself, and the replica ends up with only its enrollments
+other = Store(f'{top}/other.db', 'rwc', wal=True)
+enroll(other, 3)
+src, url = other, serve(other)
+check("pull from another store", full=True)
+if sorted(view(rep)[0]) != [ 3 ]:
+	sys.exit(f"full delta left enrollments behind: {sorted(view(rep)[0])}")
+PY
+
+warn "--- Command line find"
+python3 "$DIR/../sbin/enroll_store.py" /tmp/enroll-store/src.db find example.com \
+> /tmp/enroll-store/find.json \
+|| die "enroll_store: find failed"
+python3 -c 'import json, sys; sys.exit(len(json.load(open(sys.argv[1]))["ekpubhashes"]) != 7)' \
+	/tmp/enroll-store/find.json \
+|| die "enroll_store: find found the wrong enrollments"
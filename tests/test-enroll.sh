@@ -95,6 +95,9 @@ fi >> "${d}/attest-enroll.conf"
 
 policy_pcr11_unext=(tpm2 policypcr '--pcr-list=sha256:11')
 
+# Extra attest-enroll options for make_client
+enroll_args=()
+
 declare -A TCTIs
 start_port=9880
 start_swtpm() {
@@ -153,7 +156,8 @@ make_client() {
 	(
 		(($# == 1)) || unset TPM2TOOLS_TCTI
 		TPM2TOOLS_TCTI="${TCTIs[_self_]}"	\
-		attest-enroll -C "${d}/attest-enroll.conf" "$1" < "${d}/${1}/ek.pub"
+		attest-enroll -C "${d}/attest-enroll.conf" "${enroll_args[@]}" \
+			"$1" < "${d}/${1}/ek.pub"
 	)
 
 	echo "Checking that PEM also works"
@@ -258,6 +262,28 @@ for i in foo bar baz; do
 	done
 done
 
+# Enroll a client with its test0 taken from a pool of pre-generated secrets,
+# filled in test mode so that we know what it should get: the first entry
+# made with that seed, which a second pool filled with the same seed has too.
+echo "Checking that pre-generated secrets are used, once"
+attest-enroll -C "${d}/attest-enroll.conf"				\
+	-V GENPROG_POOL="${d}/pool" -V GENPROG_POOL_SEED=test -P gentest0=2
+enroll_args=(-V GENPROG_POOL="${d}/pool")
+make_client qux
+enroll_args=()
+[[ $(ls "${d}/pool/gentest0") = 000000000001.enc ]]			\
+|| die "qux did not use (just) the oldest pool entry"
+attest-enroll -C "${d}/attest-enroll.conf"				\
+	-V GENPROG_POOL="${d}/pool2" -V GENPROG_POOL_SEED=test -P gentest0=1
+aead_decrypt	"${d}/pool2/gentest0/000000000000.enc"			\
+		"${d}/pool2.key"					\
+		"${d}/pool.tar"
+tar -xOf "${d}/pool.tar" ./test0 | sha256 > "${d}/digest"
+ekpub=$(cat "${d}/db/hostname2ekpub/qux")
+cmp "${d}/db/${ekpub:0:2}/${ekpub}/test0pub" "${d}/digest"		\
+|| die "qux did not get the pre-generated test0"
+rm -f "${d}/pool.tar" "${d}/digest"
+
 # Now test initramfs bootscript:
 echo "Checking that initramfs bootscript works (direct, no attestation)"
 for i in foo bar baz; do
@@ -0,0 +1,139 @@
+#!/bin/bash
+# Check that the enrollment database's group committer
+# (hcp/enrollsvc/group_commit.py) fails each write on its own, fails and rolls
+# back the whole group when the commit fails, and keeps going after either
+set -e -o pipefail
+export LC_ALL=C
+
+die() { echo "$@" >&2 ; exit 1 ; }
+warn() { echo "$@" >&2 ; }
+
+DIR="`dirname $0`"
+export PYTHONPATH="$DIR/../hcp/enrollsvc:$DIR/../sbin:$DIR/../hcp/python${PYTHONPATH:+:$PYTHONPATH}"
+export GIT_AUTHOR_NAME=test GIT_AUTHOR_EMAIL=test@example.com
+export GIT_COMMITTER_NAME=test GIT_COMMITTER_EMAIL=test@example.com
+
+rm -rf /tmp/group-commit && mkdir -p /tmp/group-commit/repo/ekpubhash
+touch /tmp/group-commit/repo/ekpubhash/do_not_remove
+git -C /tmp/group-commit/repo init -q
+git -C /tmp/group-commit/repo add -A
+git -C /tmp/group-commit/repo commit -q -m "initial"
+
+warn "--- Group commit to a repo, and to a store"
+python3 - /tmp/group-commit 2> /tmp/group-commit/log <<'PY' \
+|| { cat /tmp/group-commit/log >&2 ; die "group_commit: checks failed" ; }
+import hashlib, os, subprocess, sys, threading
+import add_batch, db_worker, enroll_store, group_commit, hn2ek
+
+top = sys.argv[1]
+repo = f"{top}/repo"
+
+# (the repo lock isn't what's being tested, and procmail's lockfile needn't
+# be installed to test the rest)
+class RepoLock:
+	def __init__(self, path):
+		pass
+	def acquire(self):
+		pass
+	def abandon(self):
+		pass
+	def release(self):
+		pass
+add_batch.RepoLock = RepoLock
+
+# An entry, as attest-enroll would have generated it
+def entry(i):
+	e = add_batch.Entry(None, f"host{i}.example.com")
+	e.ekpubhash = hashlib.sha256(b'ek%d' % i).hexdigest()
+	e.outdir = f"{top}/out{i}"
+	os.makedirs(e.outdir, exist_ok=True)
+	for name, data in (('hostname', e.hostname), ('secret', f"secret {i}")):
+		with open(os.path.join(e.outdir, name), 'w') as f:
+			f.write(data + '\n')
+	return e
+
+# Submit writes together, so that they are committed as one group
+def group(committer, writes):
+	results = [ None ] * len(writes)
+	def one(k):
+		results[k] = committer.submit(writes[k])[0]
+	threads = [ threading.Thread(target=one, args=(k,), daemon=True)
+		for k in range(len(writes)) ]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join(10)
+		if t.is_alive():
+			sys.exit("a write was never committed")
+	return results
+
+def git(*args):
+	return subprocess.run([ 'git', '-C', repo ] + list(args), check=True,
+		stdout=subprocess.PIPE, text=True).stdout
+
+def commits():
+	return int(git('rev-list', '--count', 'HEAD'))
+
+def expect(what, got, want):
+	if got != want:
+		sys.exit(f"{what}: {got}, expected {want}")
+
+db = db_worker.EnrollDB(repo)
+committer = group_commit.GroupCommitter(db, f"{top}/lock", 0.5, 16)
+table = hn2ek.Hn2ek(repo)
+
+# a duplicate add fails on its own, and the rest share a commit
+adds = [ group_commit.Add(entry(i)) for i in (0, 1, 2, 0) ]
+expect("adds", group(committer, adds), [ 0, 0, 0, 1 ])
+expect("commits", commits(), 2)
+expect("hn2ek", sorted(table.find('example.com')),
+	sorted(hashlib.sha256(b'ek%d' % i).hexdigest()[0:32] for i in (0, 1, 2)))
+expect("deleting nothing", group(committer, [ group_commit.Delete('ffffff') ]),
+	[ 0 ])
+expect("commits", commits(), 2)
+
+# a commit that fails rolls back the working tree and fails every write
+commit = add_batch.commit
+def failing(repo_path, message):
+	add_batch.commit = commit
+	raise subprocess.CalledProcessError(1, 'git commit')
+add_batch.commit = failing
+expect("failed group", group(committer, [ group_commit.Add(entry(3)),
+	group_commit.Delete(hashlib.sha256(b'ek1').hexdigest()[0:8]) ]), [ 1, 1 ])
+expect("commits", commits(), 2)
+expect("working tree", git('status', '--porcelain'), '')
+expect("hn2ek", len(table.find('example.com')), 3)
+
+# anything else that goes wrong fails the group, not the committer
+def broken(path):
+	add_batch.RepoLock = RepoLock
+	raise RuntimeError("no lock")
+add_batch.RepoLock = broken
+expect("group without a lock", group(committer, [ group_commit.Add(entry(3)) ]),
+	[ 1 ])
+expect("later group", group(committer, [ group_commit.Add(entry(3)),
+	group_commit.Delete(hashlib.sha256(b'ek1').hexdigest()[0:8]) ]), [ 0, 0 ])
+expect("commits", commits(), 3)
+expect("hn2ek", len(table.find('example.com')), 3)
+
+# the same with a store, where a group is a transaction
+store = enroll_store.Store(f"{top}/store.db", 'rwc', wal=True)
+db = db_worker.EnrollDB(repo, store=store)
+committer = group_commit.GroupCommitter(db, None, 0.5, 16)
+adds = [ group_commit.Add(entry(i)) for i in (0, 1, 0) ]
+expect("store adds", group(committer, adds), [ 0, 0, 1 ])
+head = store.head()
+put_dir = enroll_store.Writer.put_dir
+def failing_put(w, *args):
+	enroll_store.Writer.put_dir = put_dir
+	raise OSError("disk full")
+enroll_store.Writer.put_dir = failing_put
+expect("failed store group", group(committer, [
+	group_commit.Delete(hashlib.sha256(b'ek0').hexdigest()[0:8]),
+	group_commit.Add(entry(2)) ]), [ 1, 1 ])
+expect("store head", store.head(), head)
+expect("store find", len(store.find('example.com')), 2)
+expect("later store group", group(committer, [ group_commit.Add(entry(2)) ]),
+	[ 0 ])
+expect("store find", len(store.find('example.com')), 3)
+PY
@@ -0,0 +1,130 @@
+#!/bin/bash
+# Drive the chunked hostname-to-ekpubhash table (hcp/enrollsvc/hn2ek.py) with
+# small chunks through migration, splits and emptied chunks, and check it
+# against a plain set of its entries
+set -e -o pipefail
+export LC_ALL=C
+
+die() { echo "$@" >&2 ; exit 1 ; }
+warn() { echo "$@" >&2 ; }
+
+DIR="`dirname $0`"
+export PYTHONPATH="$DIR/../hcp/enrollsvc${PYTHONPATH:+:$PYTHONPATH}"
+
+rm -rf /tmp/hn2ek && mkdir -p /tmp/hn2ek/a /tmp/hn2ek/b
+
+warn "--- Migration, splits and emptied chunks"
+python3 - /tmp/hn2ek <<'PY' \
+|| die "hn2ek: table checks failed"
+import os, random, sys
+import hn2ek
+
+hn2ek.CHUNK_MAX = 8
+top = sys.argv[1]
+rand = random.Random(1)
+
+def entry(i):
+	host = f"host{i}.{rand.choice('abc')}.example.com"
+	return f"{host[::-1]} {rand.getrandbits(128):032x}"
+
+SUFFIXES = [ '', 'example.com', 'a.example.com', 'b.example.com', '1.c.example.com',
+	'nowhere.com' ]
+
+def expected(entries, suffix):
+	return [ e.split(' ', 1)[1] for e in sorted(entries) if e.startswith(suffix[::-1]) ]
+
+# The layout that lets readers go without a lock
+def check_layout(table, entries):
+	chunks = table.manifest()
+	if not chunks or chunks[0][0] != '' or chunks != sorted(chunks):
+		sys.exit(f"bad manifest {chunks}")
+	found = []
+	for k, (low, name) in enumerate(chunks):
+		lines = table.chunk(name)
+		if lines != sorted(set(lines)) or len(lines) > hn2ek.CHUNK_MAX:
+			sys.exit(f"bad chunk {name}: {lines}")
+		if k != 0 and not lines:
+			sys.exit(f"empty chunk {name} left in the manifest")
+		high = chunks[k + 1][0] if k + 1 < len(chunks) else None
+		if any(l < low or (high is not None and l >= high) for l in lines):
+			sys.exit(f"chunk {name} has entries outside [{low}, {high})")
+		found += lines
+	if found != sorted(entries):
+		sys.exit("the chunks don't hold the table")
+	names = { name for _, name in chunks } | { hn2ek.MANIFEST }
+	if set(os.listdir(table.dir)) != names:
+		sys.exit(f"stray files {set(os.listdir(table.dir)) - names}")
+
+def check_find(table, entries):
+	for suffix in SUFFIXES:
+		if table.find(suffix) != expected(entries, suffix):
+			sys.exit(f"find {suffix!r}: {table.find(suffix)} != {expected(entries, suffix)}")
+
+# Every file is replaced atomically, so check that a reader that comes along
+# between any two of them finds all of the entries that are in the table both
+# before and after the change (it may also see those being added or removed)
+def during(table, before, after):
+	write_atomic = hn2ek.write_atomic
+	def check(path, lines):
+		write_atomic(path, lines)
+		seen = set(table.scan(''))
+		missing = (before & after) - seen
+		if missing:
+			sys.exit(f"a reader would miss {sorted(missing)}")
+	hn2ek.write_atomic = check
+	return write_atomic
+
+# the flat file (sorted, as the old op_add.sh left it) is searched until it is
+# migrated
+a = hn2ek.Hn2ek(f"{top}/a")
+entries = { entry(i) for i in range(30) }
+with open(a.flat_path, 'w') as f:
+	f.writelines(l + '\n' for l in sorted(entries))
+check_find(a, entries)
+a.migrate()
+if os.path.exists(a.flat_path):
+	sys.exit("flat file wasn't removed")
+check_layout(a, entries)
+check_find(a, entries)
+
+# adds (some of them already there) that split chunks, and removes (some of
+# them not there) that empty them
+for n in range(200):
+	before = set(entries)
+	if rand.random() < 0.5:
+		new = { entry(rand.randrange(1000)) for _ in range(rand.randrange(1, 20)) }
+		new |= set(rand.sample(sorted(entries), min(2, len(entries))))
+		entries |= new
+		restore = during(a, before, entries)
+		a.add_many(e.split(' ') for e in new)
+	else:
+		gone = set(rand.sample(sorted(entries), min(len(entries), rand.randrange(1, 25))))
+		gone.add(entry(2000))
+		entries -= gone
+		restore = during(a, before, entries)
+		removed = a.remove(gone)
+		if removed != len(before) - len(entries):
+			sys.exit(f"remove said {removed}, not {len(before) - len(entries)}")
+	hn2ek.write_atomic = restore
+	check_layout(a, entries)
+	check_find(a, entries)
+
+# emptied down to the first chunk, and back
+a.remove(set(entries))
+entries = set()
+check_layout(a, entries)
+check_find(a, entries)
+entries = { entry(i) for i in range(40) }
+a.add_many(e.split(' ') for e in entries)
+check_layout(a, entries)
+check_find(a, entries)
+
+# the shards of a database are found in one order
+b = hn2ek.Hn2ek(f"{top}/b")
+others = { entry(i) for i in range(100, 140) }
+b.add_many(e.split(' ') for e in others)
+for suffix in SUFFIXES:
+	if hn2ek.find_many([ a.repo_path, b.repo_path ], suffix) != \
+			expected(entries | others, suffix):
+		sys.exit(f"find_many {suffix!r} is out of order")
+PY